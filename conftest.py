@@ -0,0 +1,15 @@
+"""
+	リポジトリ直下からpytestを実行する場合の設定
+
+	各プロジェクトは同じモジュール名(main, models)とテーブル名を使うので、一つのプロセスでは
+	読み込めない(先に読み込んだ方のmainが使われる)。プロジェクトのディレクトリは直接収集せず、
+	test_projects.pyがディレクトリごとに別のプロセスでpytestを実行する
+"""
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+
+# テストを持つディレクトリ(conftest.pyのある場所)
+PROJECTS = sorted(path.parent for path in ROOT.glob("ex34ver02/**/conftest.py"))
+
+collect_ignore = [str(path) for path in PROJECTS]
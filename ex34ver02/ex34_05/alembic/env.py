@@ -2,21 +2,53 @@ from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
+from sqlalchemy.engine import make_url
 
 from alembic import context
 
 import os
+import re
 from sqlmodel import SQLModel
 import models
+from search import FTS_TABLE, TRGM_INDEX
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
-database_url = os.environ["DATABASE_URL"]
-config.set_main_option("sqlalchemy.url", database_url)
+database_url = make_url(os.environ["DATABASE_URL"])
+# マイグレーションは同期ドライバで実行(アプリ側は非同期ドライバに読み替える)
+if database_url.get_driver_name() in ("asyncpg", "aiosqlite"):
+    database_url = database_url.set(drivername=database_url.get_backend_name())
+config.set_main_option(
+    "sqlalchemy.url",
+    database_url.render_as_string(hide_password=False).replace("%", "%%")
+)
 # データベースのURLを指定
 
 
+# 検索用のオブジェクト(FTS5の仮想テーブルとその内部テーブル、トライグラムのインデックス)は
+# SQLでマイグレーションを書いているので、自動生成の比較から外す
+# itemdbを分割した場合(b58f2e7c0a94)のパーティションと名前の記録、一意でなくなる名前のインデックスも同様
+PARTITION_TABLE = re.compile(r"itemdb_p\d+")
+partitioned = False
+
+
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return not (name.startswith(FTS_TABLE) or name == "itemdb_names" or PARTITION_TABLE.fullmatch(name))
+    if type_ == "index":
+        return name != TRGM_INDEX and not (partitioned and name == "ix_itemdb_name_live")
+    return True
+
+
+def is_partitioned(connection) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+    relkind = connection.exec_driver_sql("SELECT relkind FROM pg_class WHERE relname = 'itemdb'").scalar()
+    connection.rollback()   # マイグレーションのトランザクションはalembicが開始する
+    return relkind == "p"
+
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
@@ -50,6 +82,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -71,9 +104,12 @@ def run_migrations_online() -> None:
         poolclass=pool.NullPool,
     )
 
+    global partitioned
     with connectable.connect() as connection:
+        partitioned = is_partitioned(connection)
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata,
+            include_name=include_name
         )
 
         with context.begin_transaction():
@@ -0,0 +1,30 @@
+"""refresh token expires index
+
+Revision ID: 3a9c6e1b7d45
+Revises: f2a7c5d8e316
+Create Date: 2026-10-18 21:12:40.318562
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3a9c6e1b7d45'
+down_revision: Union[str, Sequence[str], None] = 'f2a7c5d8e316'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 期限切れのトークンの削除用(Postgresでは書き込みを止めずに作成)
+    with op.get_context().autocommit_block():
+        op.create_index('ix_refreshtokendb_expires_at', 'refreshtokendb', ['expires_at'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_refreshtokendb_expires_at', table_name='refreshtokendb', postgresql_concurrently=True)
@@ -0,0 +1,57 @@
+"""item name search
+
+Revision ID: 5c0e8f3b7a21
+Revises: a2d84c6e1f37
+Create Date: 2026-10-18 16:05:27.518390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0e8f3b7a21'
+down_revision: Union[str, Sequence[str], None] = 'a2d84c6e1f37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name == 'sqlite':
+        # itemdbを外部コンテンツとするFTS5(trigram)、トリガーで同期し既存の行は再構築で取り込む
+        op.execute(
+            "CREATE VIRTUAL TABLE itemdb_fts USING fts5("
+            "name, content='itemdb', content_rowid='id', tokenize='trigram')"
+        )
+        op.execute(
+            "CREATE TRIGGER itemdb_fts_ai AFTER INSERT ON itemdb BEGIN "
+            "INSERT INTO itemdb_fts(rowid, name) VALUES (new.id, new.name); END"
+        )
+        op.execute(
+            "CREATE TRIGGER itemdb_fts_ad AFTER DELETE ON itemdb BEGIN "
+            "INSERT INTO itemdb_fts(itemdb_fts, rowid, name) VALUES ('delete', old.id, old.name); END"
+        )
+        op.execute(
+            "CREATE TRIGGER itemdb_fts_au AFTER UPDATE OF name ON itemdb BEGIN "
+            "INSERT INTO itemdb_fts(itemdb_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+            "INSERT INTO itemdb_fts(rowid, name) VALUES (new.id, new.name); END"
+        )
+        op.execute("INSERT INTO itemdb_fts(itemdb_fts) VALUES ('rebuild')")
+    else:
+        # 拡張の作成には権限が必要(無い場合は事前に管理者が作成しておく)
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        with op.get_context().autocommit_block():
+            op.execute("CREATE INDEX CONCURRENTLY ix_itemdb_name_trgm ON itemdb USING gin (name gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'sqlite':
+        for trigger in ('itemdb_fts_ai', 'itemdb_fts_ad', 'itemdb_fts_au'):
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE itemdb_fts")
+    else:
+        op.execute("DROP INDEX CONCURRENTLY ix_itemdb_name_trgm")
@@ -0,0 +1,72 @@
+"""soft delete
+
+Revision ID: 6e3b9a1d4f72
+Revises: 9d1f4b6a2c58
+Create Date: 2026-10-18 18:05:37.418920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6e3b9a1d4f72'
+down_revision: Union[str, Sequence[str], None] = '9d1f4b6a2c58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+LIVE = sa.text('deleted_at IS NULL')
+DELETED = sa.text('deleted_at IS NOT NULL')
+
+
+def replace_index(name: str, table: str, columns: list[str], unique: bool, where) -> None:
+    # Postgresでは新しいインデックスを作成してから入れ替え、インデックスの無い時間を作らない
+    if op.get_context().dialect.name == 'postgresql':
+        op.create_index(f'{name}_new', table, columns, unique=unique, postgresql_where=where, postgresql_concurrently=True)
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+        op.execute(f'ALTER INDEX {name}_new RENAME TO {name}')
+    else:
+        op.drop_index(name, table_name=table)
+        op.create_index(name, table, columns, unique=unique, sqlite_where=where)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # NULL許容の列の追加は既存の行を書き換えない
+    op.add_column('userdb', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('itemdb', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+
+    # 一意制約と一覧用のインデックスを、論理削除されていない行だけの部分インデックスにする
+    with op.get_context().autocommit_block():
+        op.create_index('ix_userdb_username_live', 'userdb', ['username'], unique=True, postgresql_where=LIVE, sqlite_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_userdb_deleted_at', 'userdb', ['deleted_at'], unique=False, postgresql_where=DELETED, sqlite_where=DELETED, postgresql_concurrently=True)
+        op.create_index('ix_itemdb_name_live', 'itemdb', ['name'], unique=True, postgresql_where=LIVE, sqlite_where=LIVE, postgresql_concurrently=True)
+        op.create_index('ix_itemdb_deleted_at', 'itemdb', ['deleted_at'], unique=False, postgresql_where=DELETED, sqlite_where=DELETED, postgresql_concurrently=True)
+        op.drop_index(op.f('ix_userdb_username'), table_name='userdb', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_itemdb_name'), table_name='itemdb', postgresql_concurrently=True)
+        replace_index('ix_itemdb_user_id_price', 'itemdb', ['user_id', 'price', 'id'], False, LIVE)
+        replace_index('ix_itemdb_price', 'itemdb', ['price', 'id'], False, LIVE)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 論理削除済みの行は物理削除してから元の一意制約に戻す
+    op.execute(
+        'DELETE FROM itemdb WHERE deleted_at IS NOT NULL '
+        'OR user_id IN (SELECT id FROM userdb WHERE deleted_at IS NOT NULL)'
+    )
+    op.execute('DELETE FROM userdb WHERE deleted_at IS NOT NULL')
+    op.drop_index('ix_itemdb_price', table_name='itemdb')
+    op.create_index('ix_itemdb_price', 'itemdb', ['price', 'id'], unique=False)
+    op.drop_index('ix_itemdb_user_id_price', table_name='itemdb')
+    op.create_index('ix_itemdb_user_id_price', 'itemdb', ['user_id', 'price', 'id'], unique=False)
+    op.create_index(op.f('ix_itemdb_name'), 'itemdb', ['name'], unique=True)
+    op.create_index(op.f('ix_userdb_username'), 'userdb', ['username'], unique=True)
+    op.drop_index('ix_itemdb_deleted_at', table_name='itemdb')
+    op.drop_index('ix_itemdb_name_live', table_name='itemdb')
+    op.drop_index('ix_userdb_deleted_at', table_name='userdb')
+    op.drop_index('ix_userdb_username_live', table_name='userdb')
+    op.drop_column('itemdb', 'deleted_at')
+    op.drop_column('userdb', 'deleted_at')
@@ -0,0 +1,42 @@
+"""item stats
+
+Revision ID: 9d1f4b6a2c58
+Revises: 5c0e8f3b7a21
+Create Date: 2026-10-18 17:20:11.640215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d1f4b6a2c58'
+down_revision: Union[str, Sequence[str], None] = '5c0e8f3b7a21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('itemstatsdb',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('item_count', sa.Integer(), nullable=False),
+    sa.Column('price_total', sa.BigInteger(), nullable=False),
+    sa.Column('price_min', sa.Integer(), nullable=True),
+    sa.Column('price_max', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['userdb.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # 既存のアイテムから集計を作成
+    op.execute(
+        "INSERT INTO itemstatsdb (user_id, item_count, price_total, price_min, price_max) "
+        "SELECT user_id, count(*), sum(price), min(price), max(price) FROM itemdb GROUP BY user_id"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('itemstatsdb')
@@ -0,0 +1,36 @@
+"""item filter indexes
+
+Revision ID: a2d84c6e1f37
+Revises: e7a35f0c9d18
+Create Date: 2026-10-18 15:12:40.204817
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a2d84c6e1f37'
+down_revision: Union[str, Sequence[str], None] = 'e7a35f0c9d18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # (user_id, id)はuser_idの単独インデックスを兼ねる(外部キーの削除にも使われる)ので、作成後に置き換える
+    with op.get_context().autocommit_block():
+        op.create_index('ix_itemdb_user_id_id', 'itemdb', ['user_id', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_itemdb_user_id_price', 'itemdb', ['user_id', 'price', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_itemdb_price', 'itemdb', ['price', 'id'], unique=False, postgresql_concurrently=True)
+        op.drop_index(op.f('ix_itemdb_user_id'), table_name='itemdb', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index(op.f('ix_itemdb_user_id'), 'itemdb', ['user_id'], unique=False)
+    op.drop_index('ix_itemdb_price', table_name='itemdb')
+    op.drop_index('ix_itemdb_user_id_price', table_name='itemdb')
+    op.drop_index('ix_itemdb_user_id_id', table_name='itemdb')
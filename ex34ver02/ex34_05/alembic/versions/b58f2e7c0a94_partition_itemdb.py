@@ -0,0 +1,139 @@
+"""partition itemdb
+
+Revision ID: b58f2e7c0a94
+Revises: 6e3b9a1d4f72
+Create Date: 2026-10-18 19:02:51.730164
+
+Postgresのみ: itemdbをuser_idのハッシュで分割したテーブルに作り直す(SQLiteでは何もしない)
+ - パーティション数は alembic -x partitions=32 upgrade head で指定(既定は16)
+ - 全行をコピーするので、大きなテーブルではメンテナンス時間中に実行する
+ - 主キーはパーティションキーを含める必要があるため(id, user_id)になる
+   (ORMはidを主キーとして扱うままで、idはシーケンスで一意)
+ - 名前の一意性はパーティションをまたいで保証できないので、使用中の名前をitemdb_namesに
+   トリガーで記録する。既に使われている名前の行はINSERTで黙って飛ばされる
+   (アプリの登録はON CONFLICT DO NOTHINGとRETURNINGで結果を判定しているので、動作は変わらない)
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b58f2e7c0a94'
+down_revision: Union[str, Sequence[str], None] = '6e3b9a1d4f72'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = 'id, user_id, name, price, deleted_at'
+
+TABLE = """
+CREATE TABLE itemdb (
+    id INTEGER NOT NULL DEFAULT nextval('itemdb_id_seq'),
+    user_id INTEGER NOT NULL,
+    name VARCHAR NOT NULL,
+    price INTEGER NOT NULL,
+    deleted_at TIMESTAMP WITH TIME ZONE,
+    CONSTRAINT itemdb_pkey PRIMARY KEY ({primary_key}),
+    CONSTRAINT itemdb_user_id_fkey FOREIGN KEY (user_id) REFERENCES userdb (id) ON DELETE CASCADE
+){partition_by}
+"""
+
+# 名前は元のテーブルと同じ(一意のインデックスは分割したテーブルでは作れないので通常のインデックス)
+INDEXES = [
+    "CREATE INDEX ix_itemdb_user_id_id ON itemdb (user_id, id)",
+    "CREATE INDEX ix_itemdb_user_id_price ON itemdb (user_id, price, id) WHERE deleted_at IS NULL",
+    "CREATE INDEX ix_itemdb_price ON itemdb (price, id) WHERE deleted_at IS NULL",
+    "CREATE {unique}INDEX ix_itemdb_name_live ON itemdb (name) WHERE deleted_at IS NULL",
+    "CREATE INDEX ix_itemdb_deleted_at ON itemdb (deleted_at) WHERE deleted_at IS NOT NULL",
+    "CREATE INDEX ix_itemdb_name_trgm ON itemdb USING gin (name gin_trgm_ops)"
+]
+
+# 使用中の(論理削除されていない)名前の記録
+NAME_TRIGGERS = [
+    "CREATE TABLE itemdb_names (name VARCHAR NOT NULL, CONSTRAINT itemdb_names_pkey PRIMARY KEY (name))",
+    "INSERT INTO itemdb_names (name) SELECT name FROM itemdb WHERE deleted_at IS NULL",
+    """
+    CREATE FUNCTION itemdb_names_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF NEW.deleted_at IS NULL THEN
+            INSERT INTO itemdb_names (name) VALUES (NEW.name) ON CONFLICT DO NOTHING;
+            IF NOT FOUND THEN
+                RETURN NULL;
+            END IF;
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE FUNCTION itemdb_names_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF OLD.deleted_at IS NULL AND (NEW.deleted_at IS NOT NULL OR NEW.name <> OLD.name) THEN
+            DELETE FROM itemdb_names WHERE name = OLD.name;
+        END IF;
+        IF NEW.deleted_at IS NULL AND (OLD.deleted_at IS NOT NULL OR NEW.name <> OLD.name) THEN
+            INSERT INTO itemdb_names (name) VALUES (NEW.name);
+        END IF;
+        RETURN NEW;
+    END $$
+    """,
+    """
+    CREATE FUNCTION itemdb_names_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF OLD.deleted_at IS NULL THEN
+            DELETE FROM itemdb_names WHERE name = OLD.name;
+        END IF;
+        RETURN OLD;
+    END $$
+    """,
+    "CREATE TRIGGER itemdb_names_insert BEFORE INSERT ON itemdb "
+    "FOR EACH ROW EXECUTE FUNCTION itemdb_names_insert()",
+    "CREATE TRIGGER itemdb_names_update BEFORE UPDATE OF name, deleted_at ON itemdb "
+    "FOR EACH ROW EXECUTE FUNCTION itemdb_names_update()",
+    "CREATE TRIGGER itemdb_names_delete AFTER DELETE ON itemdb "
+    "FOR EACH ROW EXECUTE FUNCTION itemdb_names_delete()"
+]
+
+
+def rebuild_itemdb(partitions: int | None) -> None:
+    # 元のテーブルを退避して作り直し、行をコピーしてから退避したテーブルを削除する
+    # (シーケンスは元のテーブルと共に消えないよう、所有を外してから付け替える)
+    op.execute('ALTER TABLE itemdb RENAME TO itemdb_old')
+    op.execute('ALTER TABLE itemdb_old RENAME CONSTRAINT itemdb_pkey TO itemdb_old_pkey')
+    op.execute('ALTER SEQUENCE itemdb_id_seq OWNED BY NONE')
+    if partitions:
+        op.execute(TABLE.format(primary_key='id, user_id', partition_by=' PARTITION BY HASH (user_id)'))
+        for remainder in range(partitions):
+            op.execute(
+                f'CREATE TABLE itemdb_p{remainder} PARTITION OF itemdb '
+                f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})'
+            )
+    else:
+        op.execute(TABLE.format(primary_key='id', partition_by=''))
+    op.execute('ALTER SEQUENCE itemdb_id_seq OWNED BY itemdb.id')
+    op.execute(f'INSERT INTO itemdb ({COLUMNS}) SELECT {COLUMNS} FROM itemdb_old')
+    op.execute('DROP TABLE itemdb_old')
+
+    for statement in INDEXES:
+        op.execute(statement.format(unique='' if partitions else 'UNIQUE '))
+    op.execute('ANALYZE itemdb')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    partitions = int(context.get_x_argument(as_dictionary=True).get('partitions', 16))
+    rebuild_itemdb(partitions)
+    for statement in NAME_TRIGGERS:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    for trigger in ('itemdb_names_insert', 'itemdb_names_update', 'itemdb_names_delete'):
+        op.execute(f'DROP TRIGGER {trigger} ON itemdb')
+        op.execute(f'DROP FUNCTION {trigger}()')
+    op.execute('DROP TABLE itemdb_names')
+    rebuild_itemdb(None)
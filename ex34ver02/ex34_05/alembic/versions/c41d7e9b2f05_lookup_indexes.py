@@ -0,0 +1,35 @@
+"""lookup indexes
+
+Revision ID: c41d7e9b2f05
+Revises: 8b2e6d4f1a93
+Create Date: 2026-10-18 11:26:50.731642
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41d7e9b2f05'
+down_revision: Union[str, Sequence[str], None] = '8b2e6d4f1a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 稼働中のテーブルをロックしないよう、PostgresではCONCURRENTLYで作成
+    # (既に重複したデータがある場合は、先に解消しておく)
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_userdb_username'), 'userdb', ['username'], unique=True, postgresql_concurrently=True)
+        op.create_index(op.f('ix_itemdb_name'), 'itemdb', ['name'], unique=True, postgresql_concurrently=True)
+        op.create_index(op.f('ix_itemdb_user_id'), 'itemdb', ['user_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_itemdb_user_id'), table_name='itemdb')
+    op.drop_index(op.f('ix_itemdb_name'), table_name='itemdb')
+    op.drop_index(op.f('ix_userdb_username'), table_name='userdb')
@@ -0,0 +1,57 @@
+"""cascade user delete
+
+Revision ID: e7a35f0c9d18
+Revises: c41d7e9b2f05
+Create Date: 2026-10-18 13:02:09.418377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a35f0c9d18'
+down_revision: Union[str, Sequence[str], None] = 'c41d7e9b2f05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = ('itemdb', 'refreshtokendb')
+
+# SQLiteの外部キーには名前が無いため、作り直す際の命名規則
+NAMING = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+
+def replace_user_fk(ondelete: str | None) -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        # SQLiteは制約を変更できないので、テーブルを作り直す
+        for table in TABLES:
+            name = f'fk_{table}_user_id_userdb'
+            with op.batch_alter_table(table, naming_convention=NAMING) as batch_op:
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, 'userdb', ['user_id'], ['id'], ondelete=ondelete)
+        return
+
+    # NOT VALIDで作成し(DROP CONSTRAINTのACCESS EXCLUSIVEロックは短時間で済む)、
+    # 一度コミットしてロックを外してから、書き込みを止めないVALIDATEで検証する
+    for table in TABLES:
+        name = f'{table}_user_id_fkey'
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(
+            name, table, 'userdb', ['user_id'], ['id'],
+            ondelete=ondelete, postgresql_not_valid=True
+        )
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {table}_user_id_fkey')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    replace_user_fk('CASCADE')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    replace_user_fk(None)
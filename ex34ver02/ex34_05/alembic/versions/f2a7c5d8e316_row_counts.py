@@ -0,0 +1,44 @@
+"""row counts
+
+Revision ID: f2a7c5d8e316
+Revises: b58f2e7c0a94
+Create Date: 2026-10-18 19:48:26.051733
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2a7c5d8e316'
+down_revision: Union[str, Sequence[str], None] = 'b58f2e7c0a94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('rowcountdb',
+    sa.Column('table_name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('row_count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name', 'shard')
+    )
+    # 既存の(論理削除されていない)行数を一つのshardに入れる
+    op.execute(
+        "INSERT INTO rowcountdb (table_name, shard, row_count) "
+        "SELECT 'userdb', 0, count(*) FROM userdb WHERE deleted_at IS NULL"
+    )
+    op.execute(
+        "INSERT INTO rowcountdb (table_name, shard, row_count) "
+        "SELECT 'itemdb', 0, count(*) FROM itemdb WHERE deleted_at IS NULL "
+        "AND user_id NOT IN (SELECT id FROM userdb WHERE deleted_at IS NOT NULL)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('rowcountdb')
@@ -0,0 +1,114 @@
+"""
+	同期セッションと非同期セッションの負荷比較
+
+	以前の構成(async defの中で同期Sessionを使う)を再現したアプリと、
+	現在のAsyncSessionのアプリに同じ件数・同じ並列数でGET /items?limit=Nを投げ、
+	スループットとレイテンシを比較する
+	(両方のアプリが同じN行を返すよう、現在のアプリのレスポンスキャッシュは無効にする)
+
+	使い方:
+	 python bench_async.py --items 2000 --limit 500 --concurrency 32 --requests 20
+	 DATABASE_URL=postgresql://... python bench_async.py	(Postgresで比較)
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+def build_sync_app(url: str):
+	# 変更前の構成: 同期エンジンとSessionをasync defのエンドポイントで使う
+	from fastapi import FastAPI, Depends, Query
+	from sqlmodel import Session, create_engine, select
+	from typing import Annotated
+	from models import ItemDB, ItemResponse
+
+	engine = create_engine(url)
+	app = FastAPI()
+
+	def get_session():
+		with Session(engine) as session:
+			yield session
+
+	@app.get("/items")
+	async def handle_all_items(
+		session: Annotated[Session, Depends(get_session)],
+		limit: Annotated[int, Query(ge=1)]
+	) -> list[ItemResponse]:
+		return session.exec(select(ItemDB).order_by(ItemDB.id).limit(limit)).all()
+
+	return app
+
+async def load(app, concurrency: int, requests: int, limit: int) -> tuple[float, list[float]]:
+	import httpx
+
+	latencies = []
+	transport = httpx.ASGITransport(app=app)
+	async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+		async def worker():
+			for _ in range(requests):
+				start = time.perf_counter()
+				res = await client.get("/items", params={"limit": limit})
+				res.raise_for_status()
+				assert len(res.json()) == limit
+				latencies.append((time.perf_counter() - start) * 1000)
+
+		start = time.perf_counter()
+		await asyncio.gather(*(worker() for _ in range(concurrency)))
+		return time.perf_counter() - start, latencies
+
+def report(name: str, elapsed: float, latencies: list[float]):
+	latencies.sort()
+	p99 = latencies[int(len(latencies) * 0.99) - 1]
+	print(
+		f"{name:<6} {len(latencies) / elapsed:>9.1f} "
+		f"{statistics.median(latencies):>9.1f} {p99:>9.1f}"
+	)
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare sync Session vs AsyncSession under concurrent load")
+	parser.add_argument("--items", type=int, default=2000)
+	parser.add_argument("--limit", type=int, default=500, help="rows per response (at most MAX_PAGE_SIZE)")
+	parser.add_argument("--concurrency", type=int, default=32)
+	parser.add_argument("--requests", type=int, default=20, help="requests per concurrent client")
+	args = parser.parse_args()
+
+	# DATABASE_URLが無ければ一時ファイルのSQLiteを使う
+	if "DATABASE_URL" not in os.environ:
+		os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+	os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+	os.environ.setdefault("ALGORITHM", "HS256")
+	os.environ["RESPONSE_CACHE_TTL"] = "0"	# 毎回DBから読ませる
+	url = os.environ["DATABASE_URL"]
+
+	from sqlmodel import SQLModel, Session, create_engine, delete
+	from models import UserDB, ItemDB
+	import main as app_main
+
+	# テストデータの投入(同期ドライバ)
+	sync_engine = create_engine(url)
+	SQLModel.metadata.create_all(sync_engine)
+	with Session(sync_engine) as session:
+		session.exec(delete(ItemDB).where(ItemDB.name.startswith("bench-")))
+		session.exec(delete(UserDB).where(UserDB.username == "bench"))
+		user = UserDB(username="bench", password="-", email=None, disabled=False)
+		session.add(user)
+		session.flush()
+		session.add_all(
+			ItemDB(user_id=user.id, name=f"bench-{n}", price=n)
+			for n in range(args.items)
+		)
+		session.commit()
+
+	limit = min(args.limit, args.items, app_main.MAX_PAGE_SIZE)
+	print(f"{args.items} items, {limit} rows per response, {args.concurrency} clients x {args.requests} requests")
+	print(f"{'mode':<6} {'req/s':>9} {'p50_ms':>9} {'p99_ms':>9}")
+	elapsed, latencies = asyncio.run(load(build_sync_app(url), args.concurrency, args.requests, limit))
+	report("sync", elapsed, latencies)
+	elapsed, latencies = asyncio.run(load(app_main.app, args.concurrency, args.requests, limit))
+	report("async", elapsed, latencies)
+
+if __name__ == "__main__":
+	main()
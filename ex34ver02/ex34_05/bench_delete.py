@@ -0,0 +1,91 @@
+"""
+	ユーザー削除のベンチマーク
+
+	アイテム数ごとに、以下の方法でユーザーを削除する時間を比較する
+	 - orm:  最初の方法(アイテムをORMに読み込み1件ずつDELETE)
+	 - bulk: 一括削除(DELETE ... WHERE user_id = :id、アイテム数に比例する)
+	 - soft: 現在のDELETE /users(ユーザーの論理削除とトークン・集計の削除のみ、アイテムは後で
+	         purge_workerが小さなバッチで物理削除するので、応答時間はアイテム数に依らない)
+
+	使い方:
+	 python bench_delete.py --counts 10 100 1000 10000
+	 DATABASE_URL=postgresql://... python bench_delete.py	(Postgresで比較)
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from sqlmodel import SQLModel, Session, create_engine, delete, select, update
+from sqlalchemy.orm import selectinload
+
+from models import UserDB, ItemDB, ItemStatsDB, RefreshTokenDB
+
+def seed(engine, count: int) -> int:
+	with Session(engine) as session:
+		user = UserDB(username=f"bench-{time.time_ns()}", password="-", email=None, disabled=False)
+		session.add(user)
+		session.flush()
+		session.add_all(
+			ItemDB(user_id=user.id, name=f"{user.username}-{n}", price=n)
+			for n in range(count)
+		)
+		session.commit()
+		return user.id
+
+def delete_orm(engine, user_id: int):
+	# 変更前: アイテムを全て読み込んで1件ずつ削除
+	with Session(engine) as session:
+		statement = select(UserDB).where(UserDB.id == user_id).options(selectinload(UserDB.items))
+		db_user = session.exec(statement).one()
+		for item in db_user.items:
+			session.delete(item)
+		session.exec(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id))
+		session.delete(db_user)
+		session.commit()
+
+def delete_bulk(engine, user_id: int):
+	# 読み込まずに一括削除
+	with Session(engine) as session:
+		session.exec(delete(ItemDB).where(ItemDB.user_id == user_id))
+		session.exec(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id))
+		session.exec(delete(UserDB).where(UserDB.id == user_id))
+		session.commit()
+
+def delete_soft(engine, user_id: int):
+	# 現在: 論理削除のみ(main.pyのhandle_delete_usersと同じ文、アイテムには触れない)
+	with Session(engine) as session:
+		session.exec(
+			update(UserDB)
+			.where(UserDB.id == user_id, UserDB.deleted_at.is_(None))
+			.values(deleted_at=datetime.now(timezone.utc))
+		)
+		session.exec(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == user_id))
+		session.exec(delete(ItemStatsDB).where(ItemStatsDB.user_id == user_id))
+		session.commit()
+
+def measure(engine, func, count: int) -> float:
+	user_id = seed(engine, count)
+	start = time.perf_counter()
+	func(engine, user_id)
+	return (time.perf_counter() - start) * 1000
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark DELETE /users latency against item count")
+	parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000, 10000])
+	args = parser.parse_args()
+
+	url = os.getenv("DATABASE_URL") or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+	engine = create_engine(url)
+	SQLModel.metadata.create_all(engine)
+
+	print(f"{'items':>8} {'orm_ms':>10} {'bulk_ms':>10} {'soft_ms':>10}")
+	for count in args.counts:
+		orm_ms = measure(engine, delete_orm, count)
+		bulk_ms = measure(engine, delete_bulk, count)
+		soft_ms = measure(engine, delete_soft, count)
+		print(f"{count:>8} {orm_ms:>10.1f} {bulk_ms:>10.1f} {soft_ms:>10.1f}")
+
+if __name__ == "__main__":
+	main()
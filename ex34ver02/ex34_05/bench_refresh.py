@@ -0,0 +1,80 @@
+"""
+	リフレッシュトークンのベンチマーク
+
+	長時間動くクライアント群が30分ごとにアクセストークンを更新する場合の
+	CPU時間を、パスワードでの再ログインとリフレッシュトークンで比較する
+	(ハッシュ計算もこのプロセスで数えるため、スレッドプールで実行する)
+
+	使い方:
+	 python bench_refresh.py --clients 50 --hours 8
+"""
+import argparse
+import os
+import tempfile
+import time
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare CPU cost of password re-login vs refresh tokens")
+	parser.add_argument("--clients", type=int, default=50)
+	parser.add_argument("--hours", type=float, default=8)
+	args = parser.parse_args()
+
+	# mainを読み込む前にベンチマーク用の設定にする
+	workdir = tempfile.mkdtemp()
+	os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+	os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+	os.environ.setdefault("ALGORITHM", "HS256")
+	os.environ["HASH_EXECUTOR"] = "thread"
+	os.environ["LOGIN_USER_BURST"] = "1000000"
+	os.environ["LOGIN_IP_BURST"] = "1000000"
+
+	from fastapi.testclient import TestClient
+	from sqlmodel import SQLModel, create_engine
+	import main as app_main
+
+	# テーブルは同期ドライバで作成
+	SQLModel.metadata.create_all(create_engine(os.environ["DATABASE_URL"]))
+	with TestClient(app_main.app) as client:
+		run(client, args)
+
+def run(client, args):
+	# クライアントごとにユーザーを作成し、最初のログインを済ませる
+	refresh_tokens = []
+	for n in range(args.clients):
+		client.post("/users/register", json={"username": f"client{n}", "password": "secret"})
+		res = client.post("/token", data={"username": f"client{n}", "password": "secret"})
+		refresh_tokens.append(res.json()["refresh_token"])
+
+	renewals = int(args.hours * 2)	# 30分ごとに更新
+
+	# パスワードでの再ログイン
+	start_cpu, start_wall = time.process_time(), time.perf_counter()
+	for _ in range(renewals):
+		for n in range(args.clients):
+			res = client.post("/token", data={"username": f"client{n}", "password": "secret"})
+			assert res.status_code == 200, res.text
+	password_cpu = time.process_time() - start_cpu
+	password_wall = time.perf_counter() - start_wall
+
+	# リフレッシュトークンでの更新
+	start_cpu, start_wall = time.process_time(), time.perf_counter()
+	for _ in range(renewals):
+		for n in range(args.clients):
+			res = client.post(
+				"/token",
+				data={"grant_type": "refresh_token", "refresh_token": refresh_tokens[n]}
+			)
+			assert res.status_code == 200, res.text
+			refresh_tokens[n] = res.json()["refresh_token"]
+	refresh_cpu = time.process_time() - start_cpu
+	refresh_wall = time.perf_counter() - start_wall
+
+	total = renewals * args.clients
+	print(f"{args.clients} clients x {renewals} renewals = {total} token requests")
+	print(f"{'mode':<10} {'cpu_s':>8} {'wall_s':>8} {'cpu_ms/req':>11}")
+	print(f"{'password':<10} {password_cpu:>8.2f} {password_wall:>8.2f} {password_cpu / total * 1000:>11.2f}")
+	print(f"{'refresh':<10} {refresh_cpu:>8.2f} {refresh_wall:>8.2f} {refresh_cpu / total * 1000:>11.2f}")
+	print(f"CPU reduction: {(1 - refresh_cpu / password_cpu) * 100:.1f}%")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,113 @@
+"""
+	アイテム名検索のベンチマーク
+
+	指定件数のアイテムを投入し、検索用インデックス(SQLiteはFTS5、Postgresはpg_trgm)を
+	使ったGET /items/searchのSQLと、インデックスを使わない部分一致(LIKE '%q%')の
+	レイテンシを比較する
+
+	使い方:
+	 python bench_search.py --items 1000000
+	 DATABASE_URL=postgresql://... python bench_search.py	(Postgresで比較)
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlmodel import SQLModel, Session, create_engine, delete, insert, select
+
+from models import UserDB, ItemDB
+from search import search_statement
+
+# 実データに近づけるため、音節を組み合わせた語彙から名前を作る
+SYLLABLES = ["ka", "ri", "to", "ne", "su", "mo", "la", "pi", "ro", "chi", "ba", "en", "or", "ta", "mi", "gu"]
+
+def vocabulary(rng: random.Random, size: int) -> list[str]:
+	words = set()
+	while len(words) < size:
+		words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+	return sorted(words)
+
+def queries(words: list[str]) -> list[str]:
+	# 完全な単語、単語の一部、1文字抜けた綴り、存在しない語
+	rng = random.Random(1)
+	picked = rng.sample(words, 8)
+	return (
+		picked[:3]
+		+ [word[1:5] for word in picked[3:5] if len(word) >= 5]
+		+ [word[:2] + word[3:] for word in picked[5:8]]
+		+ ["xyzq"]
+	)
+
+def seed(engine, count: int, words: list[str]):
+	rng = random.Random(0)
+	with Session(engine) as session:
+		session.exec(delete(ItemDB).where(ItemDB.name.startswith("bench-")))
+		session.exec(delete(UserDB).where(UserDB.username == "bench"))
+		user = UserDB(username="bench", password="-", email=None, disabled=False)
+		session.add(user)
+		session.flush()
+		for start in range(0, count, 10000):
+			session.execute(insert(ItemDB), [
+				{
+					"user_id": user.id,
+					"name": f"bench-{' '.join(rng.sample(words, 2))}-{n}",
+					"price": n
+				}
+				for n in range(start, min(start + 10000, count))
+			])
+		session.commit()
+
+def search(session: Session, dialect: str, query: str, limit: int) -> list[ItemDB]:
+	# GET /items/searchと同じ手順(部分一致→足りなければあいまい検索)
+	db_items = session.exec(search_statement(dialect, query, limit)).all()
+	if len(db_items) < limit:
+		db_items = session.exec(search_statement(dialect, query, limit, fuzzy=True)).all()
+	return db_items
+
+def measure(engine, build, queries: list[str], repeat: int) -> list[float]:
+	latencies = []
+	with Session(engine) as session:
+		for query in queries:
+			for _ in range(repeat):
+				start = time.perf_counter()
+				build(session, query)
+				latencies.append((time.perf_counter() - start) * 1000)
+	return sorted(latencies)
+
+def report(name: str, latencies: list[float]):
+	p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+	print(f"{name:<8} {statistics.median(latencies):>9.1f} {p99:>9.1f}")
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark item name search against a plain LIKE scan")
+	parser.add_argument("--items", type=int, default=1000000)
+	parser.add_argument("--limit", type=int, default=20)
+	parser.add_argument("--repeat", type=int, default=5, help="runs per query")
+	args = parser.parse_args()
+
+	url = os.getenv("DATABASE_URL") or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+	engine = create_engine(url)
+	SQLModel.metadata.create_all(engine)	# searchをimportしているので検索用のインデックスも作られる
+
+	words = vocabulary(random.Random(0), 20000)
+	start = time.perf_counter()
+	seed(engine, args.items, words)
+	print(f"seeded {args.items} items in {time.perf_counter() - start:.1f}s")
+
+	dialect = engine.dialect.name
+	print(f"{'mode':<8} {'p50_ms':>9} {'p99_ms':>9}")
+	report("search", measure(engine, lambda session, q: search(session, dialect, q, args.limit), queries(words), args.repeat))
+	report("like", measure(
+		engine,
+		lambda session, q: session.exec(
+			select(ItemDB).where(ItemDB.name.icontains(q, autoescape=True)).order_by(ItemDB.id).limit(args.limit)
+		).all(),
+		queries(words),
+		args.repeat
+	))
+
+if __name__ == "__main__":
+	main()
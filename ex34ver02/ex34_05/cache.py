@@ -0,0 +1,612 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+class CacheError(Exception):
+	"""キャッシュサーバーがエラーを返した"""
+
+# キャッシュが使えない場合はエラーを数えて、キャッシュ無しとして続行する
+BACKEND_ERRORS = (CacheError, OSError, asyncio.TimeoutError, sqlite3.Error)
+
+class CacheBackend(ABC):
+	"""キャッシュの保存先(値はバイト列、タグのバージョンは期限無しのカウンター)"""
+
+	name = "backend"
+
+	@abstractmethod
+	async def get_many(self, keys: list[str]) -> list[bytes | None]:
+		...
+
+	@abstractmethod
+	async def set(self, key: str, value: bytes, ttl: float):
+		...
+
+	@abstractmethod
+	async def add(self, key: str, value: bytes, ttl: float) -> bool:
+		# 存在しない場合のみ保存(ロック用)
+		...
+
+	@abstractmethod
+	async def delete(self, key: str):
+		...
+
+	@abstractmethod
+	async def incr(self, key: str) -> int:
+		...
+
+	@abstractmethod
+	async def counters(self, keys: list[str]) -> list[int]:
+		...
+
+	async def clear(self):
+		pass
+
+	async def close(self):
+		pass
+
+	def evictions_for(self, prefix: str) -> int | None:
+		# 上限を超えて追い出したキーのうち、prefixで始まるものの数(数えられない保存先はNone)
+		return None
+
+	def snapshot(self) -> dict:
+		return {}
+
+def key_prefix(key: str) -> str:
+	# 追い出した数を数える単位("principal:..."なら"principal:")
+	head, sep, _ = key.partition(":")
+	return head + sep
+
+class MemoryCacheBackend(CacheBackend):
+	"""プロセス内のLRU(ワーカー間では共有されない)"""
+
+	name = "memory"
+
+	def __init__(self, max_size: int = 10_000):
+		self.max_size = max_size
+		self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+		# タグのバージョンは値と別に、同じ件数までのLRUで持つ
+		# 値は全タグで共有する増分で、追い出したタグには追い出した中の最大値(_floor)を返す
+		# (保存時のバージョンと一致するのは、追い出すまで無効化されていなかった場合だけ)
+		self._counters: OrderedDict[str, int] = OrderedDict()
+		self._clock = 0
+		self._floor = 0
+		self.evictions = 0
+		self._evicted: dict[str, int] = {}
+
+	def _get(self, key: str) -> bytes | None:
+		entry = self._entries.get(key)
+		if entry is None:
+			return None
+		if entry[0] <= time.time():
+			del self._entries[key]
+			return None
+		self._entries.move_to_end(key)
+		return entry[1]
+
+	async def get_many(self, keys: list[str]) -> list[bytes | None]:
+		return [self._get(key) for key in keys]
+
+	async def set(self, key: str, value: bytes, ttl: float):
+		if self.max_size <= 0:
+			return
+		self._entries.pop(key, None)
+		self._entries[key] = (time.time() + ttl, value)
+		while len(self._entries) > self.max_size:
+			evicted, _ = self._entries.popitem(last=False)
+			self.evictions += 1
+			prefix = key_prefix(evicted)
+			self._evicted[prefix] = self._evicted.get(prefix, 0) + 1
+
+	async def add(self, key: str, value: bytes, ttl: float) -> bool:
+		if self._get(key) is not None:
+			return False
+		await self.set(key, value, ttl)
+		return True
+
+	async def delete(self, key: str):
+		self._entries.pop(key, None)
+
+	async def incr(self, key: str) -> int:
+		self._clock += 1
+		self._counters[key] = self._clock
+		self._counters.move_to_end(key)
+		while len(self._counters) > max(self.max_size, 1):
+			_, value = self._counters.popitem(last=False)
+			self._floor = max(self._floor, value)
+		return self._clock
+
+	async def counters(self, keys: list[str]) -> list[int]:
+		values = []
+		for key in keys:
+			if key in self._counters:
+				self._counters.move_to_end(key)
+			values.append(self._counters.get(key, self._floor))
+		return values
+
+	async def clear(self):
+		self._entries.clear()
+		self._counters.clear()
+		self._floor = self._clock	# 破棄前に保存した値とは一致させない
+
+	def evictions_for(self, prefix: str) -> int | None:
+		return self._evicted.get(prefix, 0)
+
+	def snapshot(self) -> dict:
+		return {
+			"size": len(self._entries),
+			"max_size": self.max_size,
+			"evictions": self.evictions,
+			"tags": len(self._counters)
+		}
+
+class SharedMemoryCacheBackend(CacheBackend):
+	"""同じホストのワーカーで共有する、tmpfs(/dev/shm)上のSQLiteファイル
+	SQLiteの呼び出し(他のプロセスの書き込み中はロック待ちになる)はスレッドで実行し、イベントループを止めない"""
+
+	name = "shm"
+
+	def __init__(self, path: str, max_size: int = 100_000):
+		self.path = path
+		self.max_size = max_size
+		self.evictions = 0
+		self._conn: sqlite3.Connection | None = None
+		self._lock = threading.Lock()	# 接続は一つなので、スレッドから同時に使わない
+		self._writes = 0
+		self._evicted: dict[str, int] = {}	# このプロセスが追い出した数
+
+	def _db(self) -> sqlite3.Connection:
+		# 接続はプロセスごとに開く(fork前に開いた接続は使わない)
+		if self._conn is None:
+			conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=OFF")	# 消えても困らないデータなので同期しない
+			conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)")
+			conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_expires ON entries (expires)")
+			conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+			self._conn = conn
+		return self._conn
+
+	async def _run(self, func, *args):
+		def run():
+			with self._lock:
+				return func(self._db(), *args)
+		return await asyncio.to_thread(run)
+
+	async def get_many(self, keys: list[str]) -> list[bytes | None]:
+		def get_many(db: sqlite3.Connection):
+			placeholders = ",".join("?" * len(keys))
+			rows = db.execute(
+				f"SELECT key, value FROM entries WHERE key IN ({placeholders}) AND expires > ?",
+				[*keys, time.time()]
+			)
+			return dict(rows.fetchall())
+		found = await self._run(get_many)
+		return [found.get(key) for key in keys]
+
+	async def set(self, key: str, value: bytes, ttl: float):
+		def set(db: sqlite3.Connection):
+			db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+			self._evict(db)
+		await self._run(set)
+
+	async def add(self, key: str, value: bytes, ttl: float) -> bool:
+		# 期限切れの行は上書きできる
+		def add(db: sqlite3.Connection):
+			now = time.time()
+			cursor = db.execute(
+				"INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE "
+				"SET value = excluded.value, expires = excluded.expires WHERE entries.expires <= ?",
+				(key, value, now + ttl, now)
+			)
+			return cursor.rowcount == 1
+		return await self._run(add)
+
+	async def delete(self, key: str):
+		await self._run(lambda db: db.execute("DELETE FROM entries WHERE key = ?", (key,)))
+
+	async def incr(self, key: str) -> int:
+		def incr(db: sqlite3.Connection):
+			return db.execute(
+				"INSERT INTO counters VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1 RETURNING value",
+				(key,)
+			).fetchone()[0]
+		return await self._run(incr)
+
+	async def counters(self, keys: list[str]) -> list[int]:
+		def counters(db: sqlite3.Connection):
+			placeholders = ",".join("?" * len(keys))
+			return dict(db.execute(f"SELECT key, value FROM counters WHERE key IN ({placeholders})", keys).fetchall())
+		found = await self._run(counters)
+		return [found.get(key, 0) for key in keys]
+
+	def _evict(self, db: sqlite3.Connection):
+		# 書き込み100回ごとに、期限切れと上限を超えた分(期限の近い順)を削除
+		self._writes += 1
+		if self._writes % 100:
+			return
+		db.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+		excess = db.execute("SELECT count(*) FROM entries").fetchone()[0] - self.max_size
+		if excess > 0:
+			keys = [row[0] for row in db.execute(
+				"DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires LIMIT ?) RETURNING key",
+				(excess,)
+			).fetchall()]
+			self.evictions += len(keys)
+			for key in keys:
+				prefix = key_prefix(key)
+				self._evicted[prefix] = self._evicted.get(prefix, 0) + 1
+
+	async def clear(self):
+		def clear(db: sqlite3.Connection):
+			db.execute("DELETE FROM entries")
+			db.execute("DELETE FROM counters")
+		await self._run(clear)
+
+	async def close(self):
+		def close():
+			with self._lock:
+				if self._conn is not None:
+					self._conn.close()
+					self._conn = None
+		await asyncio.to_thread(close)
+
+	def evictions_for(self, prefix: str) -> int | None:
+		return self._evicted.get(prefix, 0)
+
+	def snapshot(self) -> dict:
+		return {"path": self.path, "max_size": self.max_size, "evictions": self.evictions}
+
+def encode_command(*args) -> bytes:
+	parts = [f"*{len(args)}\r\n".encode()]
+	for arg in args:
+		if not isinstance(arg, bytes):
+			arg = str(arg).encode()
+		parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+	return b"".join(parts)
+
+async def read_reply(reader: asyncio.StreamReader):
+	line = await reader.readline()
+	if not line:
+		raise ConnectionError("Connection closed by cache server")
+	kind, data = line[:1], line[1:-2]
+	if kind == b"+":
+		return data.decode()
+	if kind == b"-":
+		raise CacheError(data.decode())
+	if kind == b":":
+		return int(data)
+	if kind == b"$":
+		if data == b"-1":
+			return None
+		value = await reader.readexactly(int(data) + 2)
+		return value[:-2]
+	if kind == b"*":
+		if data == b"-1":
+			return None
+		return [await read_reply(reader) for _ in range(int(data))]
+	raise CacheError(f"Unexpected reply: {line!r}")
+
+class RedisCacheBackend(CacheBackend):
+	"""Redisプロトコル(RESP)のサーバー、ホストをまたいで共有する"""
+
+	name = "redis"
+
+	def __init__(self, url: str, prefix: str = "ex34:", timeout: float = 1.0, max_idle: int = 8):
+		parsed = urlparse(url)
+		self.host = parsed.hostname or "localhost"
+		self.port = parsed.port or 6379
+		self.password = parsed.password
+		self.db = int(parsed.path.lstrip("/") or 0)
+		self.prefix = prefix
+		self.timeout = timeout
+		self.max_idle = max_idle
+		self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+		self.connects = 0
+
+	async def _connect(self):
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+		self.connects += 1
+		connection = (reader, writer)
+		if self.password:
+			await self._send(connection, "AUTH", self.password)
+		if self.db:
+			await self._send(connection, "SELECT", self.db)
+		return connection
+
+	async def _send(self, connection, *args):
+		reader, writer = connection
+		writer.write(encode_command(*args))
+		await writer.drain()
+		return await asyncio.wait_for(read_reply(reader), self.timeout)
+
+	async def execute(self, *args):
+		connection = self._idle.pop() if self._idle else await self._connect()
+		try:
+			reply = await self._send(connection, *args)
+		except BaseException:
+			# 応答の途中で失敗した接続は再利用しない
+			connection[1].close()
+			raise
+		if len(self._idle) < self.max_idle:
+			self._idle.append(connection)
+		else:
+			connection[1].close()
+		return reply
+
+	async def get_many(self, keys: list[str]) -> list[bytes | None]:
+		return await self.execute("MGET", *(self.prefix + key for key in keys))
+
+	async def set(self, key: str, value: bytes, ttl: float):
+		await self.execute("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+	async def add(self, key: str, value: bytes, ttl: float) -> bool:
+		return await self.execute("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)), "NX") == "OK"
+
+	async def delete(self, key: str):
+		await self.execute("DEL", self.prefix + key)
+
+	async def incr(self, key: str) -> int:
+		return await self.execute("INCR", self.prefix + key)
+
+	async def counters(self, keys: list[str]) -> list[int]:
+		values = await self.execute("MGET", *(self.prefix + key for key in keys))
+		return [int(value) if value is not None else 0 for value in values]
+
+	async def clear(self):
+		# 他の用途と共有しているサーバーでも、接頭辞の付いたキーだけを消す
+		cursor = "0"
+		while True:
+			cursor, keys = await self.execute("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000)
+			cursor = cursor.decode() if isinstance(cursor, bytes) else str(cursor)
+			if keys:
+				await self.execute("DEL", *keys)
+			if cursor == "0":
+				return
+
+	async def close(self):
+		while self._idle:
+			self._idle.pop()[1].close()
+
+	def snapshot(self) -> dict:
+		return {"host": self.host, "port": self.port, "connects": self.connects, "idle": len(self._idle)}
+
+def cache_backend_from_env() -> CacheBackend:
+	kind = os.getenv("CACHE_BACKEND", "memory")
+	max_size = int(os.getenv("CACHE_SIZE", 10_000))
+	if kind == "memory":
+		return MemoryCacheBackend(max_size)
+	if kind == "shm":
+		return SharedMemoryCacheBackend(os.getenv("CACHE_SHM_PATH", "/dev/shm/ex34_cache.db"), max_size)
+	if kind == "redis":
+		return RedisCacheBackend(os.getenv("CACHE_URL", "redis://localhost:6379/0"))
+	raise ValueError(f"Unsupported cache backend: {kind}")
+
+class Cache:
+	"""バックエンドの上に、タグ(バージョン)による無効化と、同時にミスした場合の計算の共有を載せる"""
+
+	def __init__(self, backend: CacheBackend, lock_ttl: float = 10.0, lock_wait: float = 2.0):
+		self.backend = backend
+		self.lock_ttl = lock_ttl	# 計算中の印の期限(計算したプロセスが落ちた場合に備える)
+		self.lock_wait = lock_wait	# 他のプロセスの計算結果を待つ上限
+		self._inflight: dict[str, asyncio.Future] = {}
+		self.hits = 0
+		self.misses = 0
+		self.stale = 0
+		self.coalesced = 0
+		self.errors = 0
+
+	async def versions(self, tags) -> dict[str, int]:
+		# 値を計算する前に取得しておき、set()に渡す(計算中の無効化を取りこぼさない)
+		tags = list(tags)
+		if not tags:
+			return {}
+		try:
+			values = await self.backend.counters([f"tag:{tag}" for tag in tags])
+		except BACKEND_ERRORS:
+			self.errors += 1
+			return {tag: -1 for tag in tags}	# 保存されても一致しない
+		return dict(zip(tags, values))
+
+	async def get(self, key: str) -> bytes | None:
+		try:
+			raw = (await self.backend.get_many([key]))[0]
+		except BACKEND_ERRORS:
+			self.errors += 1
+			raw = None
+		if raw is None:
+			self.misses += 1
+			return None
+
+		# 保存時からタグのバージョンが進んでいれば無効
+		header, _, value = raw.partition(b"\n")
+		stored = json.loads(header)
+		if stored and await self.versions(stored) != stored:
+			self.stale += 1
+			self.misses += 1
+			return None
+		self.hits += 1
+		return value
+
+	async def set(self, key: str, value: bytes, ttl: float, versions: dict[str, int] | None = None):
+		if ttl <= 0:
+			return
+		raw = json.dumps(versions or {}, separators=(",", ":")).encode() + b"\n" + value
+		try:
+			await self.backend.set(key, raw, ttl)
+		except BACKEND_ERRORS:
+			self.errors += 1
+
+	async def delete(self, key: str):
+		try:
+			await self.backend.delete(key)
+		except BACKEND_ERRORS:
+			self.errors += 1
+
+	async def invalidate(self, *tags: str):
+		for tag in tags:
+			try:
+				await self.backend.incr(f"tag:{tag}")
+			except BACKEND_ERRORS:
+				self.errors += 1
+
+	async def get_or_set(self, key: str, loader, ttl: float, tags=()) -> bytes:
+		value = await self.get(key)
+		if value is not None:
+			return value
+
+		# 同じプロセスで同時にミスした場合は、一つの計算結果を共有する
+		if key in self._inflight:
+			self.coalesced += 1
+			return await asyncio.shield(self._inflight[key])
+		future = asyncio.get_running_loop().create_future()
+		self._inflight[key] = future
+		try:
+			value = await self._load(key, loader, ttl, tags)
+			future.set_result(value)
+			return value
+		except BaseException as e:
+			future.set_exception(e)
+			future.exception()	# 待っている呼び出しが無くても警告を出さない
+			raise
+		finally:
+			del self._inflight[key]
+
+	async def _load(self, key: str, loader, ttl: float, tags) -> bytes:
+		versions = await self.versions(tags)
+		lock = f"lock:{key}"
+		try:
+			locked = await self.backend.add(lock, b"1", self.lock_ttl)
+		except BACKEND_ERRORS:
+			self.errors += 1
+			locked = True
+
+		# 他のプロセスが計算中なら、結果が保存されるまで少し待つ
+		if not locked:
+			deadline = time.monotonic() + self.lock_wait
+			while time.monotonic() < deadline:
+				await asyncio.sleep(0.02)
+				value = await self.get(key)
+				if value is not None:
+					self.coalesced += 1
+					return value
+
+		value = await loader()
+		await self.set(key, value, ttl, versions)
+		if locked:
+			await self.delete(lock)
+		return value
+
+	async def clear(self):
+		await self.backend.clear()
+
+	def snapshot(self) -> dict:
+		return {
+			"backend": self.backend.name,
+			"hits": self.hits,
+			"misses": self.misses,
+			"stale": self.stale,
+			"coalesced": self.coalesced,
+			"errors": self.errors,
+			**self.backend.snapshot()
+		}
+
+class PrincipalCache:
+	"""トークンのダイジェストをキーに、デコード済みのクレームとユーザーのスナップショットを保持する"""
+
+	def __init__(self, cache: Cache, ttl: float):
+		self.cache = cache
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	@staticmethod
+	def digest(token: str) -> str:
+		# トークンそのものはキャッシュに残さない
+		return "principal:" + hashlib.sha256(token.encode()).hexdigest()
+
+	async def versions(self, user_id: int) -> dict[str, int]:
+		return await self.cache.versions([f"user:{user_id}"])
+
+	async def get(self, token: str) -> tuple[dict, dict] | None:
+		value = await self.cache.get(self.digest(token))
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		entry = json.loads(value)
+		return entry["claims"], entry["user"]
+
+	async def set(self, token: str, claims: dict, user: dict, versions: dict[str, int]):
+		# 有効期限はTTLとトークンのexpの早い方
+		ttl = self.ttl
+		if "exp" in claims:
+			ttl = min(ttl, float(claims["exp"]) - time.time())
+		value = json.dumps({"claims": claims, "user": user}).encode()
+		await self.cache.set(self.digest(token), value, ttl, versions)
+
+	async def invalidate_user(self, user_id: int):
+		# ユーザーに紐づく全トークンのエントリを無効化
+		await self.cache.invalidate(f"user:{user_id}")
+		self.invalidations += 1
+
+	def snapshot(self) -> dict:
+		# evictionsは上限を超えて追い出された認証のエントリの数(redisではサーバー側で数えるのでNone)
+		return {
+			"ttl": self.ttl,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.cache.backend.evictions_for("principal:"),
+			"invalidations": self.invalidations
+		}
+
+class ResponseCache:
+	"""一覧系のGETのレスポンス(シリアライズ済みのバイト列)を、データのタグと共に保持する"""
+
+	def __init__(self, cache: Cache, ttl: float):
+		self.cache = cache
+		self.ttl = ttl	# レプリカの遅延で古い結果が入った場合でも、この秒数で消える
+		self.hits = 0
+		self.misses = 0
+		self.not_modified = 0
+
+	async def versions(self, tags) -> dict[str, int]:
+		return await self.cache.versions(tags)
+
+	async def bump(self, *tags: str):
+		# 書き込み時にバージョンを進め、古いバージョンのエントリを参照されなくする
+		await self.cache.invalidate(*tags)
+
+	async def get(self, key: str) -> tuple[bytes, list, bytes] | None:
+		value = await self.cache.get("response:" + key)
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		header, _, body = value.partition(b"\n")
+		meta = json.loads(header)
+		headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in meta["headers"]]
+		return meta["etag"].encode(), headers, body
+
+	async def set(self, key: str, versions: dict[str, int], etag: bytes, headers: list, body: bytes):
+		meta = {
+			"etag": etag.decode(),
+			"headers": [(name.decode("latin-1"), value.decode("latin-1")) for name, value in headers]
+		}
+		value = json.dumps(meta).encode() + b"\n" + body
+		await self.cache.set("response:" + key, value, self.ttl, versions)
+
+	def snapshot(self) -> dict:
+		return {
+			"ttl": self.ttl,
+			"hits": self.hits,
+			"misses": self.misses,
+			"not_modified": self.not_modified
+		}
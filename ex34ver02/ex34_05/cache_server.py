@@ -0,0 +1,119 @@
+"""
+	開発・テスト用の簡易キャッシュサーバー
+
+	RedisCacheBackendが使うコマンド(PING, GET, MGET, SET EX/PX/NX, DEL, INCR, SCAN, FLUSHDB)だけを
+	Redisプロトコル(RESP)で受け付ける、一つのプロセス内のメモリに保存するだけのサーバー
+	本番ではRedis(または互換サーバー)を使う
+
+	使い方:
+	 python cache_server.py --port 6380
+	 CACHE_BACKEND=redis CACHE_URL=redis://localhost:6380/0 uvicorn main:app --workers 4
+"""
+import argparse
+import asyncio
+import fnmatch
+import time
+
+class CacheServer:
+	def __init__(self):
+		self.data: dict[bytes, tuple[float | None, bytes]] = {}
+
+	def _get(self, key: bytes) -> bytes | None:
+		entry = self.data.get(key)
+		if entry is None:
+			return None
+		if entry[0] is not None and entry[0] <= time.time():
+			del self.data[key]
+			return None
+		return entry[1]
+
+	def command(self, args: list[bytes]):
+		name = args[0].upper()
+		if name == b"PING":
+			return "PONG"
+		if name == b"GET":
+			return self._get(args[1])
+		if name == b"MGET":
+			return [self._get(key) for key in args[1:]]
+		if name == b"SET":
+			key, value, options = args[1], args[2], [arg.upper() for arg in args[3:]]
+			expires = None
+			if b"PX" in options:
+				expires = time.time() + int(args[3 + options.index(b"PX") + 1]) / 1000
+			elif b"EX" in options:
+				expires = time.time() + int(args[3 + options.index(b"EX") + 1])
+			if b"NX" in options and self._get(key) is not None:
+				return None
+			self.data[key] = (expires, value)
+			return "OK"
+		if name == b"DEL":
+			return sum(self.data.pop(key, None) is not None for key in args[1:])
+		if name == b"INCR":
+			value = int(self._get(args[1]) or 0) + 1
+			self.data[args[1]] = (None, str(value).encode())
+			return value
+		if name == b"SCAN":
+			# 一度で全件を返す(カーソルは常に0)
+			pattern = args[args.index(b"MATCH") + 1].decode() if b"MATCH" in args else "*"
+			keys = [key for key in list(self.data) if self._get(key) is not None and fnmatch.fnmatchcase(key.decode(), pattern)]
+			return [b"0", keys]
+		if name == b"FLUSHDB":
+			self.data.clear()
+			return "OK"
+		if name in (b"AUTH", b"SELECT"):
+			return "OK"
+		return Exception(f"ERR unknown command '{name.decode()}'")
+
+def encode_reply(value) -> bytes:
+	if value is None:
+		return b"$-1\r\n"
+	if isinstance(value, Exception):
+		return f"-{value}\r\n".encode()
+	if isinstance(value, str):
+		return f"+{value}\r\n".encode()
+	if isinstance(value, int):
+		return f":{value}\r\n".encode()
+	if isinstance(value, bytes):
+		return b"$%d\r\n%s\r\n" % (len(value), value)
+	return f"*{len(value)}\r\n".encode() + b"".join(encode_reply(item) for item in value)
+
+async def read_command(reader: asyncio.StreamReader) -> list[bytes] | None:
+	line = await reader.readline()
+	if not line:
+		return None
+	args = []
+	for _ in range(int(line[1:-2])):
+		size = int((await reader.readline())[1:-2])
+		args.append((await reader.readexactly(size + 2))[:-2])
+	return args
+
+async def start_server(host: str = "127.0.0.1", port: int = 0) -> asyncio.Server:
+	server = CacheServer()
+
+	async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		try:
+			while (args := await read_command(reader)) is not None:
+				writer.write(encode_reply(server.command(args)))
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	return await asyncio.start_server(handle, host, port)
+
+async def serve(host: str, port: int):
+	server = await start_server(host, port)
+	print(f"listening on {host}:{server.sockets[0].getsockname()[1]}")
+	async with server:
+		await server.serve_forever()
+
+def main():
+	parser = argparse.ArgumentParser(description="Minimal RESP cache server for development and tests")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=6380)
+	args = parser.parse_args()
+	asyncio.run(serve(args.host, args.port))
+
+if __name__ == "__main__":
+	main()
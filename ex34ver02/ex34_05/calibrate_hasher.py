@@ -0,0 +1,80 @@
+"""
+	Argon2のパラメータ較正
+
+	このマシンの1コアあたりのハッシュ/検証時間を計測し、
+	目標時間内で最も強いパラメータを.env用の設定として出力する
+
+	使い方:
+	 python calibrate_hasher.py --target-ms 250
+"""
+import argparse
+import statistics
+import time
+
+from hashing import build_hasher
+
+MEMORY_COSTS = [19456, 32768, 47104, 65536, 131072]	# KiB
+TIME_COSTS = [1, 2, 3, 4, 6]
+
+def measure(func, samples: int) -> float:
+	# 中央値(ミリ秒)
+	results = []
+	for _ in range(samples):
+		start = time.perf_counter()
+		func()
+		results.append((time.perf_counter() - start) * 1000)
+	return statistics.median(results)
+
+def calibrate(target_ms: float, parallelism: int, samples: int) -> dict | None:
+	best = None
+	print(f"{'memory_cost':>12} {'time_cost':>10} {'hash_ms':>9} {'verify_ms':>10}")
+
+	for memory_cost in MEMORY_COSTS:
+		for time_cost in TIME_COSTS:
+			hasher = build_hasher(time_cost, memory_cost, parallelism)
+			hashed = hasher.hash("calibration")
+			hash_ms = measure(lambda: hasher.hash("calibration"), samples)
+			verify_ms = measure(lambda: hasher.verify("calibration", hashed), samples)
+			print(f"{memory_cost:>12} {time_cost:>10} {hash_ms:>9.1f} {verify_ms:>10.1f}")
+
+			# 目標時間を超えたら、より重い時間コストは計測しない
+			if max(hash_ms, verify_ms) > target_ms:
+				break
+
+			# 目標内でメモリ×時間コストが最大のものを採用
+			strength = memory_cost * time_cost
+			if best is None or strength > best["memory_cost"] * best["time_cost"]:
+				best = {
+					"time_cost": time_cost,
+					"memory_cost": memory_cost,
+					"parallelism": parallelism,
+					"hash_ms": hash_ms,
+					"verify_ms": verify_ms
+				}
+	return best
+
+def main():
+	parser = argparse.ArgumentParser(description="Calibrate Argon2 parameters for this machine")
+	parser.add_argument("--target-ms", type=float, default=250, help="latency budget per hash/verify")
+	parser.add_argument(
+		"--parallelism",
+		type=int,
+		default=1,
+		help="lanes per hash (1 keeps one hash per pool worker core)"
+	)
+	parser.add_argument("--samples", type=int, default=5)
+	args = parser.parse_args()
+
+	best = calibrate(args.target_ms, args.parallelism, args.samples)
+	if best is None:
+		print(f"\nNo parameters fit within {args.target_ms}ms")
+		return 1
+
+	print(f"\n# {best['hash_ms']:.1f}ms hash / {best['verify_ms']:.1f}ms verify per core")
+	print(f"ARGON2_TIME_COST={best['time_cost']}")
+	print(f"ARGON2_MEMORY_COST={best['memory_cost']}")
+	print(f"ARGON2_PARALLELISM={best['parallelism']}")
+	return 0
+
+if __name__ == "__main__":
+	raise SystemExit(main())
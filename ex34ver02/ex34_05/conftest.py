@@ -1,36 +1,60 @@
 import os
 import pytest
-from sqlmodel import SQLModel, Session, create_engine
-from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 import models
 from fastapi.testclient import TestClient
 
 # 環境変数をテスト用に予め指定
-os.environ["DATABASE_URL"] = "sqlite://"
+os.environ["DATABASE_URL"] = "sqlite://"	# インメモリ(aiosqliteで接続)
 os.environ["SECRET_KEY"] = "dummy"
 os.environ["ALGORITHM"] = "HS256"
+os.environ["PURGE_INTERVAL"] = "0"	# 物理削除はテストから直接実行
 
 # 環境変数を上書きした上で、mainを呼び出す
-from main import app, get_session
+from main import app, cache, login_throttle
+from database import engine	# インメモリではStaticPoolで一つの接続を使いまわす
 
-# get_sessionを上書きするengineの作成
-SQLITE_URL = "sqlite://"
-engine = create_engine(
-	SQLITE_URL,
-	connect_args={"check_same_thread": False},	# 複数スレッドでの実行を許可
-	poolclass=StaticPool	# これを付けないと、create_allで作ったテーブルに接続できない
-)
-# インメモリでは接続が切れた時点でデータが消えるので、一つの接続を使いまわす
+async def create_tables():
+	async with engine.begin() as conn:
+		await conn.run_sync(SQLModel.metadata.create_all)
 
-def override_get_session():
-	with Session(engine) as session:
-		yield session
+async def drop_tables():
+	async with engine.begin() as conn:
+		await conn.run_sync(SQLModel.metadata.drop_all)
 
 # pytestが呼び出すテスト用client関数を作成
 @pytest.fixture
 def client():	# 名前はclientで固定
-	SQLModel.metadata.create_all(engine)	# テーブルを作成
-	app.dependency_overrides[get_session] = override_get_session	# get_sessionをインメモリに書き換え
-	yield TestClient(app)					# 叩くアプリを指定し、testclientを作成
-	SQLModel.metadata.drop_all(engine)		# 終了時にテーブルを削除
-	app.dependency_overrides.clear()		# get_sessionの上書きを解除
+	# withで開くと、テスト中は一つのイベントループでアプリが動く
+	with TestClient(app) as client:
+		client.portal.call(create_tables)	# テーブルを作成
+		yield client						# 叩くアプリを指定し、testclientを作成
+		client.portal.call(drop_tables)		# 終了時にテーブルを削除
+		client.portal.call(cache.clear)		# 認証・レスポンスなどのキャッシュを破棄
+		client.portal.call(login_throttle.reset)	# ログイン試行の記録を破棄
+
+# テストから直接DBを操作する場合に使う関数(アプリと同じイベントループで実行)
+@pytest.fixture
+def run_db(client):
+	def run(func):
+		async def call():
+			async with AsyncSession(engine, expire_on_commit=False) as session:
+				return await func(session)
+		return client.portal.call(call)
+	return run
+
+# ユーザーを登録してログインし、認証ヘッダーを返す関数
+@pytest.fixture
+def login(client):
+	def login(username: str, password: str = "secret") -> dict:
+		client.post(
+			"/users/register",
+			json={"username": username, "password": password}
+		)
+		res = client.post(
+			"/token",
+			data={"username": username, "password": password}
+		)
+		return {"Authorization": f"Bearer {res.json()['access_token']}"}
+	return login
@@ -0,0 +1,73 @@
+import json
+import random
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import delete, insert, select
+
+from models import ItemDB, RowCountDB, UserDB
+from purge import live_items
+
+# 加算先の行数(同時に書き込むトランザクションが同じ行のロックを待たないように分ける)
+COUNTER_SHARDS = 16
+
+def add_counts_statement(dialect: str, deltas: dict[str, int]):
+	# テーブルごとの増減を、ランダムに選んだshardに加える(行が無ければ作成)
+	shard = random.randrange(COUNTER_SHARDS)
+	statement = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(RowCountDB).values([
+		{"table_name": table_name, "shard": shard, "row_count": delta}
+		for table_name, delta in deltas.items()
+	])
+	return statement.on_conflict_do_update(
+		index_elements=["table_name", "shard"],
+		set_={"row_count": RowCountDB.__table__.c.row_count + statement.excluded.row_count}
+	)
+
+def recount_statements() -> dict:
+	# テーブルごとの論理削除されていない行数を数え直す(ずれた場合の確認・修復用、全件を走査する)
+	return {
+		"userdb": select(func.count()).select_from(UserDB).where(UserDB.deleted_at.is_(None)),
+		"itemdb": select(func.count()).select_from(ItemDB).where(*live_items())
+	}
+
+def rebuild_counts_statements(counts: dict[str, int]) -> list:
+	# shardを一つにまとめて、数え直した行数に置き換える
+	return [
+		delete(RowCountDB).where(RowCountDB.table_name.in_(list(counts))),
+		insert(RowCountDB).values([
+			{"table_name": table_name, "shard": 0, "row_count": count}
+			for table_name, count in counts.items()
+		])
+	]
+
+async def exact_count(session, table_name: str) -> int:
+	# 主キーの先頭で引けるshardの行を合計するだけ
+	statement = select(func.coalesce(func.sum(RowCountDB.row_count), 0)).where(RowCountDB.table_name == table_name)
+	return int((await session.exec(statement)).one())
+
+async def table_estimate(session, table_name: str) -> int | None:
+	# Postgresの統計情報(reltuples)の行数、分割したテーブルはパーティションの合計
+	# (論理削除済みの行も含む、一度もANALYZEされていなければNone)
+	if session.bind.dialect.name != "postgresql":
+		return None
+	statement = text(
+		"SELECT reltuples FROM pg_class WHERE relkind = 'r' AND ("
+		"oid = CAST(:table AS regclass) OR "
+		"oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)))"
+	)
+	rows = (await session.exec(statement, params={"table": table_name})).scalars().all()
+	if not rows or any(row < 0 for row in rows):
+		return None
+	return int(sum(rows))
+
+async def plan_estimate(session, statement) -> int | None:
+	# 絞り込みを含む問い合わせの件数を、実行せずにプランナの推定値で得る
+	if session.bind.dialect.name != "postgresql":
+		return None
+	# 値は埋め込んでドライバにそのまま渡す(textでは値の中の":"がパラメータと解釈される)
+	compiled = statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+	connection = await session.connection()
+	plan = (await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+	if isinstance(plan, str):
+		plan = json.loads(plan)
+	return int(plan[0]["Plan"]["Plan Rows"])
@@ -0,0 +1,287 @@
+import os
+import time
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from fastapi import Request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+load_dotenv()
+
+# DATABASE_URLのスキームから非同期ドライバを選ぶ(alembicは同期ドライバのまま使う)
+ASYNC_DRIVERS = {
+	"postgresql": "postgresql+asyncpg",
+	"sqlite": "sqlite+aiosqlite"
+}
+
+def to_async_url(url: str | URL) -> URL:
+	url = make_url(url)
+	if url.get_driver_name() in ("asyncpg", "aiosqlite"):
+		return url
+	backend = url.get_backend_name()
+	if backend not in ASYNC_DRIVERS:
+		raise ValueError(f"Unsupported database: {backend}")
+	return url.set(drivername=ASYNC_DRIVERS[backend])
+
+def is_sqlite_memory(url: URL) -> bool:
+	return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+# チェックアウト待ち時間のヒストグラムの境界(ミリ秒)
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+
+class PoolStats:
+	def __init__(self):
+		self.checkouts = 0
+		self.wait_total_ms = 0.0
+		self.wait_max_ms = 0.0
+		self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+		self.timeouts = 0
+		self.errors = 0
+		self.disconnects = 0
+
+	def observe(self, wait_ms: float):
+		self.checkouts += 1
+		self.wait_total_ms += wait_ms
+		self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+		for n, bound in enumerate(WAIT_BUCKETS_MS):
+			if wait_ms <= bound:
+				self.wait_buckets[n] += 1
+				return
+		self.wait_buckets[-1] += 1
+
+	def snapshot(self, pool) -> dict:
+		result = {"pool": type(pool).__name__}
+
+		# 現在の利用状況(QueuePool系のみ)
+		if isinstance(pool, QueuePool):
+			result.update({
+				"size": pool.size(),
+				"checked_out": pool.checkedout(),
+				"checked_in": pool.checkedin(),
+				"overflow": pool.overflow(),
+				"max_overflow": pool._max_overflow,
+				"timeout": pool.timeout()
+			})
+
+		labels = [f"le_{bound}" for bound in WAIT_BUCKETS_MS] + ["inf"]
+		result.update({
+			"checkouts": self.checkouts,
+			"wait_ms_total": self.wait_total_ms,
+			"wait_ms_max": self.wait_max_ms,
+			"wait_ms_histogram": dict(zip(labels, self.wait_buckets)),
+			"timeouts": self.timeouts,
+			"errors": self.errors,
+			"disconnects": self.disconnects
+		})
+		return result
+
+def instrumented_pool(stats: PoolStats) -> type[AsyncAdaptedQueuePool]:
+	# 再作成(recreate)されても同じ統計に記録されるよう、クラスごと作る
+	class InstrumentedPool(AsyncAdaptedQueuePool):
+		def _do_get(self):
+			start = time.perf_counter()
+			try:
+				return super()._do_get()
+			except exc.TimeoutError:
+				stats.timeouts += 1
+				raise
+			finally:
+				stats.observe((time.perf_counter() - start) * 1000)
+	return InstrumentedPool
+
+def parse_bool(value: str) -> bool:
+	return value.lower() in ("1", "true", "yes", "on")
+
+# 接続プールの設定(未指定の項目はSQLAlchemyの既定値)
+POOL_ENV = {
+	"pool_size": ("DB_POOL_SIZE", int),
+	"max_overflow": ("DB_MAX_OVERFLOW", int),
+	"pool_timeout": ("DB_POOL_TIMEOUT", float),
+	"pool_recycle": ("DB_POOL_RECYCLE", int),
+	"pool_pre_ping": ("DB_POOL_PRE_PING", parse_bool)
+}
+
+def pool_options_from_env() -> dict:
+	options = {}
+	for option, (name, convert) in POOL_ENV.items():
+		value = os.getenv(name)
+		if value:
+			options[option] = convert(value)
+	return options
+
+pool_stats: dict[str, PoolStats] = {}
+
+# リクエストごとのSQL発行数(ミドルウェアでリストをセットし、イベントで加算)
+query_count: ContextVar[list[int] | None] = ContextVar("query_count", default=None)
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+	counter = query_count.get()
+	if counter is not None:
+		counter[0] += 1
+
+def create_engine_from_url(
+	url: str | URL,
+	name: str = "primary",
+	pool_options: dict | None = None
+) -> AsyncEngine:
+	url = to_async_url(url)
+	stats = pool_stats.setdefault(name, PoolStats())
+	if pool_options is None:
+		pool_options = pool_options_from_env()
+
+	# インメモリSQLiteは接続ごとに別のDBになるので、一つの接続を使いまわす
+	if is_sqlite_memory(url):
+		engine = create_async_engine(
+			url,
+			connect_args={"check_same_thread": False},
+			poolclass=StaticPool,
+			pool_pre_ping=pool_options.get("pool_pre_ping", False)
+		)
+	else:
+		engine = create_async_engine(
+			url,
+			poolclass=instrumented_pool(stats),
+			**pool_options
+		)
+
+	event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+
+	# SQLiteの設定は接続ごとに行う
+	#  - 外部キー制約を有効にする(物理削除はON DELETE CASCADEに頼る)
+	#  - LIKEをPostgresと同じく大文字・小文字を区別させる(前方一致の絞り込みの結果をそろえる)
+	if url.get_backend_name() == "sqlite":
+		@event.listens_for(engine.sync_engine, "connect")
+		def set_sqlite_pragmas(dbapi_connection, connection_record):
+			cursor = dbapi_connection.cursor()
+			cursor.execute("PRAGMA foreign_keys=ON")
+			cursor.execute("PRAGMA case_sensitive_like=ON")
+			cursor.close()
+
+	# 接続エラーの記録(制約違反などのSQLのエラーは数えない)
+	@event.listens_for(engine.sync_engine, "handle_error")
+	def count_errors(context):
+		connection_error = (exc.OperationalError, exc.InterfaceError, OSError)
+		if context.is_disconnect or isinstance(
+			context.sqlalchemy_exception or context.original_exception,
+			connection_error
+		):
+			stats.errors += 1
+		if context.is_disconnect:
+			stats.disconnects += 1
+
+	return engine
+
+DATABASE_URL = os.environ["DATABASE_URL"]
+engine = create_engine_from_url(DATABASE_URL)
+
+# commit後に属性を再読込しない(非同期では遅延読み込みができないため)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def get_session():
+	async with SessionLocal() as session:
+		yield session
+
+class ReplicaSet:
+	def __init__(self, engines: dict[str, AsyncEngine], retry_after: float):
+		self.engines = engines
+		self.retry_after = retry_after	# 接続できなかったレプリカを外しておく秒数
+		self.down_until: dict[str, float] = {}
+		self.turn = 0
+		self.reads = {name: 0 for name in engines}
+		self.failures = {name: 0 for name in engines}
+		self.fallbacks = 0
+
+	def candidates(self) -> list[str]:
+		# 停止中のものを除き、貸出中の接続が少ない順(同数ならラウンドロビン)
+		names = list(self.engines)
+		if not names:
+			return []
+		start = self.turn % len(names)
+		self.turn += 1
+		now = time.monotonic()
+		live = [name for name in names[start:] + names[:start] if self.down_until.get(name, 0) <= now]
+		return sorted(live, key=lambda name: checked_out(self.engines[name].pool))
+
+	async def open(self) -> AsyncSession:
+		for name in self.candidates():
+			session = AsyncSession(self.engines[name], expire_on_commit=False)
+			try:
+				await session.connection()	# 接続できるか確認(SQLは発行しない)
+			except (exc.DBAPIError, OSError):
+				await session.close()
+				self.failures[name] += 1
+				self.down_until[name] = time.monotonic() + self.retry_after
+				continue
+			self.reads[name] += 1
+			return session
+
+		# 使えるレプリカが無ければプライマリから読む
+		if self.engines:
+			self.fallbacks += 1
+		return SessionLocal()
+
+	def snapshot(self) -> dict:
+		now = time.monotonic()
+		return {
+			"replicas": {
+				name: {
+					"reads": self.reads[name],
+					"failures": self.failures[name],
+					"down": self.down_until.get(name, 0) > now
+				}
+				for name in self.engines
+			},
+			"fallbacks": self.fallbacks
+		}
+
+def checked_out(pool) -> int:
+	return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+# 読み取り専用のレプリカ(カンマ区切りで複数指定可、未指定ならプライマリのみ)
+REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URL", "").split(",") if url.strip()]
+replicas = ReplicaSet(
+	{
+		f"replica{n}": create_engine_from_url(url, name=f"replica{n}")
+		for n, url in enumerate(REPLICA_URLS, start=1)
+	},
+	retry_after=float(os.getenv("DB_REPLICA_RETRY", 30))
+)
+
+# 書き込み後しばらくはプライマリから読む(レプリカの遅延で自分の書き込みが見えないのを防ぐ)
+READ_STICKY_SECONDS = float(os.getenv("READ_STICKY_SECONDS", 5))
+STICKY_COOKIE = "db_primary_until"
+
+def is_sticky(request: Request) -> bool:
+	try:
+		return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+	except ValueError:
+		return False
+
+def sticky_cookie() -> str:
+	until = time.time() + READ_STICKY_SECONDS
+	return f"{STICKY_COOKIE}={until:.3f}; Max-Age={int(READ_STICKY_SECONDS) + 1}; Path=/; HttpOnly; SameSite=Lax"
+
+# GETのエンドポイント用のセッション
+async def get_read_session(request: Request):
+	if is_sticky(request):
+		session = SessionLocal()
+	else:
+		session = await replicas.open()
+	async with session:
+		yield session
+
+def pool_snapshot() -> dict:
+	result = {"primary": pool_stats["primary"].snapshot(engine.pool)}
+	for name, replica in replicas.engines.items():
+		result[name] = pool_stats[name].snapshot(replica.pool)
+	return result
+
+def dialect_insert(session: AsyncSession, table):
+	# ON CONFLICTを使うため、接続先の方言のinsertを選ぶ
+	if session.bind.dialect.name == "postgresql":
+		return postgresql.insert(table)
+	return sqlite.insert(table)
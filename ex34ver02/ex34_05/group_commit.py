@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+# バッチの大きさのヒストグラムの境界
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+class GroupCommitter:
+	"""短い時間内に届いた書き込みをまとめて一つのトランザクションで処理する(group commit)"""
+
+	def __init__(self, flush, window: float, max_batch: int):
+		self.flush = flush	# 要求のリストを受け取り、同じ順で結果(または例外)のリストを返すasync関数
+		self.window = window	# 最初の要求からバッチを締め切るまでの秒数
+		self.max_batch = max(1, max_batch)
+		self._pending: list[tuple[object, asyncio.Future, float]] = []
+		self._timer: asyncio.TimerHandle | None = None
+		self._tasks: set[asyncio.Task] = set()
+		self.batches = 0
+		self.items = 0
+		self.failures = 0
+		self.wait_total_ms = 0.0
+		self.wait_max_ms = 0.0
+		self.batch_buckets = [0] * (len(BATCH_BUCKETS) + 1)
+
+	async def submit(self, request):
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self._pending.append((request, future, time.perf_counter()))
+
+		# 上限に達したらすぐに、そうでなければ締め切りで処理する
+		if len(self._pending) >= self.max_batch:
+			self._start()
+		elif self._timer is None:
+			self._timer = loop.call_later(self.window, self._start)
+		return await asyncio.shield(future)
+
+	def _start(self):
+		if self._timer is not None:
+			self._timer.cancel()
+			self._timer = None
+		batch, self._pending = self._pending, []
+		if batch:
+			task = asyncio.create_task(self._run(batch))
+			self._tasks.add(task)
+			task.add_done_callback(self._tasks.discard)
+
+	async def _run(self, batch: list):
+		# 待たせた時間(要求から処理開始まで)を記録
+		start = time.perf_counter()
+		for _, _, queued in batch:
+			wait_ms = (start - queued) * 1000
+			self.wait_total_ms += wait_ms
+			self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+		self._observe(len(batch))
+
+		try:
+			results = await self.flush([request for request, _, _ in batch])
+		except Exception as e:
+			self.failures += 1
+			results = [e] * len(batch)
+
+		for (_, future, _), result in zip(batch, results):
+			if future.done():
+				continue
+			if isinstance(result, Exception):
+				future.set_exception(result)
+			else:
+				future.set_result(result)
+
+	def _observe(self, size: int):
+		self.batches += 1
+		self.items += size
+		for n, bound in enumerate(BATCH_BUCKETS):
+			if size <= bound:
+				self.batch_buckets[n] += 1
+				return
+		self.batch_buckets[-1] += 1
+
+	async def close(self):
+		# 残っている要求を処理してから終了
+		self._start()
+		if self._tasks:
+			await asyncio.gather(*self._tasks, return_exceptions=True)
+
+	def snapshot(self) -> dict:
+		labels = [f"le_{bound}" for bound in BATCH_BUCKETS] + ["inf"]
+		return {
+			"window_ms": self.window * 1000,
+			"max_batch": self.max_batch,
+			"batches": self.batches,
+			"items": self.items,
+			"failures": self.failures,
+			"batch_size_avg": self.items / self.batches if self.batches else 0,
+			"batch_size_histogram": dict(zip(labels, self.batch_buckets)),
+			"wait_ms_total": self.wait_total_ms,
+			"wait_ms_max": self.wait_max_ms
+		}
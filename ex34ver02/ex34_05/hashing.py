@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+
+load_dotenv()	# ワーカープロセスでも同じ設定を読む
+
+def build_hasher(
+	time_cost: int | None = None,
+	memory_cost: int | None = None,
+	parallelism: int | None = None
+) -> PasswordHash:
+	# 未指定の値はpwdlibの推奨値を使う
+	params = {
+		"time_cost": time_cost,
+		"memory_cost": memory_cost,
+		"parallelism": parallelism
+	}
+	params = {key: value for key, value in params.items() if value is not None}
+	if not params:
+		return PasswordHash.recommended()
+	return PasswordHash((Argon2Hasher(**params),))
+
+def _env_int(name: str) -> int | None:
+	value = os.getenv(name)
+	return int(value) if value else None
+
+# 変更時は既存のハッシュをログイン時に再ハッシュして移行する
+HASHER = build_hasher(
+	time_cost=_env_int("ARGON2_TIME_COST"),
+	memory_cost=_env_int("ARGON2_MEMORY_COST"),
+	parallelism=_env_int("ARGON2_PARALLELISM")
+)
+DUMMY = HASHER.hash("dummy_hash")	# 存在しないユーザー用の疑似ハッシュ
+
+# 待ち行列での優先度(小さいほど先に処理)
+LOGIN = 0
+REGISTER = 1
+
+class HashQueueFull(Exception):
+	def __init__(self, retry_after: int):
+		super().__init__("Hash queue is full")
+		self.retry_after = retry_after
+
+# ワーカー側で実行する関数(プロセスプールに渡すためトップレベルに置く)
+def _verify(password: str, hashed: str) -> bool:
+	return HASHER.verify(password, hashed)
+
+def _verify_and_update(password: str, hashed: str) -> tuple[bool, str | None]:
+	return HASHER.verify_and_update(password, hashed)
+
+def _hash(password: str) -> str:
+	return HASHER.hash(password)
+
+def hash_batch(passwords: list[str]) -> list[str]:
+	# 一括インポート用(プロセスプールのワーカーで実行)
+	return [HASHER.hash(password) for password in passwords]
+
+def _timed(func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	return result, time.perf_counter() - start
+
+class HashPool:
+	"""Argon2の計算をイベントループの外で行う、上限付きの待ち行列を持つワーカープール"""
+
+	def __init__(self, workers: int, max_queue: int, executor: str = "process"):
+		self.workers = max(1, workers)
+		self.max_queue = max(0, max_queue)
+		self.executor_kind = executor
+		self._executor: Executor | None = None
+		self._running = 0
+		self._waiters: list[tuple[int, int, asyncio.Future]] = []
+		self._seq = itertools.count()
+		self.rejected = 0
+		self._stats: dict[str, dict[str, float]] = {}
+
+	def _get_executor(self) -> Executor:
+		# 最初の利用時にプールを作成
+		if self._executor is None:
+			if self.executor_kind == "thread":
+				self._executor = ThreadPoolExecutor(self.workers)
+			else:
+				# forkはイベントループのスレッドやロックの状態まで複製するので、forkserver(無ければspawn)で起動
+				method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+				self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+		return self._executor
+
+	def shutdown(self):
+		if self._executor is not None:
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._executor = None
+
+	def _retry_after(self) -> int:
+		# 平均計算時間と待ち行列の長さから、空きが出るまでの秒数を見積もる
+		count = sum(s["count"] for s in self._stats.values())
+		total = sum(s["hash_time_total"] for s in self._stats.values())
+		average = total / count if count else 0.1
+		return max(1, math.ceil((len(self._waiters) + 1) * average / self.workers))
+
+	async def _acquire(self, priority: int):
+		# 空きがあればそのまま実行
+		if self._running < self.workers and not self._waiters:
+			self._running += 1
+			return
+
+		# 待ち行列が満杯なら受け付けない
+		if len(self._waiters) >= self.max_queue:
+			self.rejected += 1
+			raise HashQueueFull(self._retry_after())
+
+		waiter = asyncio.get_running_loop().create_future()
+		entry = (priority, next(self._seq), waiter)
+		heapq.heappush(self._waiters, entry)
+		try:
+			await waiter
+		except asyncio.CancelledError:
+			if waiter.done() and not waiter.cancelled():
+				self._release()	# 枠を受け取った後のキャンセルは次に譲る
+			elif entry in self._waiters:	# _releaseが既に取り出した場合は残っていない
+				self._waiters.remove(entry)
+				heapq.heapify(self._waiters)
+			raise
+
+	def _release(self):
+		# 優先度の高い待ちに枠をそのまま引き渡す
+		while self._waiters:
+			_, _, waiter = heapq.heappop(self._waiters)
+			if not waiter.done():
+				waiter.set_result(None)
+				return
+		self._running -= 1
+
+	def _record(self, name: str, waited: float, elapsed: float):
+		stats = self._stats.setdefault(name, {
+			"count": 0,
+			"queue_wait_total": 0.0,
+			"queue_wait_max": 0.0,
+			"hash_time_total": 0.0,
+			"hash_time_max": 0.0
+		})
+		stats["count"] += 1
+		stats["queue_wait_total"] += waited
+		stats["queue_wait_max"] = max(stats["queue_wait_max"], waited)
+		stats["hash_time_total"] += elapsed
+		stats["hash_time_max"] = max(stats["hash_time_max"], elapsed)
+
+	async def run(self, priority: int, func, *args):
+		enqueued = time.perf_counter()
+		await self._acquire(priority)
+		waited = time.perf_counter() - enqueued
+		try:
+			future = self._get_executor().submit(_timed, func, *args)
+			result, elapsed = await asyncio.wrap_future(future)
+		finally:
+			self._release()
+		self._record(func.__name__.lstrip("_"), waited, elapsed)
+		return result
+
+	async def verify(self, password: str, hashed: str, priority: int = LOGIN) -> bool:
+		return await self.run(priority, _verify, password, hashed)
+
+	async def verify_and_update(
+		self,
+		password: str,
+		hashed: str,
+		priority: int = LOGIN
+	) -> tuple[bool, str | None]:
+		# 検証に成功し、パラメータが古ければ新しいハッシュも返す
+		return await self.run(priority, _verify_and_update, password, hashed)
+
+	async def hash(self, password: str, priority: int = REGISTER) -> str:
+		return await self.run(priority, _hash, password)
+
+	def snapshot(self) -> dict:
+		return {
+			"workers": self.workers,
+			"executor": self.executor_kind,
+			"running": self._running,
+			"queued": len(self._waiters),
+			"max_queue": self.max_queue,
+			"rejected": self.rejected,
+			"operations": {name: dict(stats) for name, stats in self._stats.items()}
+		}
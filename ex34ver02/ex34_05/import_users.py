@@ -0,0 +1,250 @@
+"""
+	ユーザーの一括インポート
+
+	CSV(username,password,email,disabled)またはNDJSONのユーザーを読み込み、
+	パスワードをプロセスプールでハッシュ化して(main.pyと同じHASHERの設定)
+	PostgresではCOPY、それ以外ではexecutemanyでuserdbに登録する
+
+	バッチごとにコミットし、完了したバッチ数を状態ファイルに記録するので、
+	中断した場合は --resume で続きから再開できる
+	(バッチ内で重複したユーザー名と、登録済みのユーザー名の行は飛ばして報告する)
+
+	使い方:
+	 python import_users.py users.csv
+	 python import_users.py users.ndjson --batch-size 2000 --workers 8 --resume
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, create_engine, select
+
+from counts import add_counts_statement
+from hashing import hash_batch
+from models import User, UserDB
+
+COLUMNS = ["username", "password", "email", "disabled"]
+
+def read_users(path: str, file_format: str):
+	# (行番号, 行データ)を順に返す
+	with open(path, newline="", encoding="utf-8") as f:
+		if file_format == "csv":
+			for line, row in enumerate(csv.DictReader(f), start=2):
+				yield line, {key: value for key, value in row.items() if value not in (None, "")}
+		else:
+			for line, raw in enumerate(f, start=1):
+				if raw.strip():
+					yield line, raw
+
+def parse_user(raw, file_format: str) -> User:
+	if file_format == "csv":
+		return User.model_validate(raw)
+	return User.model_validate_json(raw)
+
+def hash_passwords(executor: Executor, passwords: list[str], workers: int) -> list[str]:
+	# ワーカー数に分割して並列にハッシュ化
+	size = max(1, -(-len(passwords) // workers))
+	chunks = [passwords[n:n + size] for n in range(0, len(passwords), size)]
+	return [hashed for chunk in executor.map(hash_batch, chunks) for hashed in chunk]
+
+def copy_rows(session: Session, rows: list[dict]):
+	# PostgresのCOPYで一度に流し込む
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	for row in rows:
+		writer.writerow([
+			row["username"],
+			row["password"],
+			"" if row["email"] is None else row["email"],
+			"t" if row["disabled"] else "f"
+		])
+	buffer.seek(0)
+	cursor = session.connection().connection.cursor()
+	cursor.copy_expert(
+		f"COPY userdb ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '')",
+		buffer
+	)
+
+def load_rows(session: Session, rows: list[dict], use_copy: bool):
+	if use_copy:
+		copy_rows(session, rows)
+	else:
+		session.execute(insert(UserDB), rows)
+
+def load_state(path: str) -> int:
+	if not os.path.exists(path):
+		return 0
+	with open(path) as f:
+		return json.load(f)["completed_batches"]
+
+def save_state(path: str, completed: int):
+	# 書き込み途中で落ちても壊れないよう置き換えで保存
+	with open(f"{path}.tmp", "w") as f:
+		json.dump({"completed_batches": completed}, f)
+	os.replace(f"{path}.tmp", path)
+
+def batches(iterable, size: int):
+	iterator = iter(iterable)
+	while batch := list(islice(iterator, size)):
+		yield batch
+
+def existing_usernames(session: Session, usernames: list[str]) -> set[str]:
+	statement = select(UserDB.username).where(
+		UserDB.username.in_(usernames),
+		UserDB.deleted_at.is_(None)
+	)
+	return set(session.exec(statement).all())
+
+def load_batch(session: Session, rows: list[tuple[int, dict]], use_copy: bool) -> list[int]:
+	# バッチを登録してコミットし、登録済みのユーザー名だったため飛ばした行番号を返す
+	# (--skip-existing無しの場合や、他の登録と競合した場合は一意制約違反から判定し、除いて再実行)
+	# COPYは生のカーソルで実行するので、DBAPIの例外(psycopg2.IntegrityError)のまま届く
+	integrity_errors = (IntegrityError, session.bind.dialect.dbapi.IntegrityError)
+	skipped = []
+	while rows:
+		try:
+			load_rows(session, [row for _, row in rows], use_copy)
+			# 行数(rowcountdb)も同じトランザクションで加算
+			session.execute(add_counts_statement(session.bind.dialect.name, {"userdb": len(rows)}))
+			session.commit()
+			break
+		except integrity_errors:
+			session.rollback()
+			found = existing_usernames(session, [row["username"] for _, row in rows])
+			if not found:
+				raise
+			skipped += [line for line, row in rows if row["username"] in found]
+			rows = [(line, row) for line, row in rows if row["username"] not in found]
+	return skipped
+
+@dataclass
+class ImportStats:
+	imported: int = 0
+	invalid: int = 0
+	duplicate: int = 0
+	existing: int = 0
+	hash_seconds: float = 0.0
+	load_seconds: float = 0.0
+
+def import_users(
+	engine,
+	executor: Executor,
+	path: str,
+	file_format: str,
+	batch_size: int,
+	workers: int,
+	resume: bool = False,
+	skip_existing: bool = False
+) -> ImportStats:
+	state_path = f"{path}.import-state"
+	skip = load_state(state_path) if resume else 0
+	use_copy = engine.dialect.name == "postgresql"
+	stats = ImportStats()
+	started = time.perf_counter()
+
+	for number, batch in enumerate(batches(read_users(path, file_format), batch_size)):
+		if number < skip:
+			continue
+
+		# 行の検証(同じバッチ内で重複したユーザー名は最初の行だけ登録)
+		users = []
+		seen = set()
+		for line, raw in batch:
+			try:
+				user = parse_user(raw, file_format)
+			except ValidationError as e:
+				stats.invalid += 1
+				print(f"line {line}: {e.errors()[0]['msg']}", file=sys.stderr)
+				continue
+			if user.username in seen:
+				stats.duplicate += 1
+				print(f"line {line}: duplicate username {user.username!r} skipped", file=sys.stderr)
+				continue
+			seen.add(user.username)
+			users.append((line, user))
+
+		with Session(engine) as session:
+			# 登録済みのユーザー名を除外
+			if skip_existing and users:
+				found = existing_usernames(session, [user.username for _, user in users])
+				stats.existing += sum(user.username in found for _, user in users)
+				users = [(line, user) for line, user in users if user.username not in found]
+
+			# パスワードのハッシュ化
+			start = time.perf_counter()
+			hashed = hash_passwords(executor, [user.password for _, user in users], workers)
+			stats.hash_seconds += time.perf_counter() - start
+
+			# バッチ単位で登録・コミット
+			start = time.perf_counter()
+			rows = [
+				(line, {**user.model_dump(include=set(COLUMNS)), "password": password})
+				for (line, user), password in zip(users, hashed)
+			]
+			skipped = load_batch(session, rows, use_copy)
+			stats.load_seconds += time.perf_counter() - start
+
+		for line in skipped:
+			print(f"line {line}: username already exists, skipped", file=sys.stderr)
+		stats.existing += len(skipped)
+		stats.imported += len(rows) - len(skipped)
+		save_state(state_path, number + 1)
+		elapsed = time.perf_counter() - started
+		print(
+			f"batch {number + 1}: {stats.imported} imported, {stats.invalid} invalid, "
+			f"{stats.imported / elapsed:.0f} users/s",
+			file=sys.stderr
+		)
+	return stats
+
+def main():
+	parser = argparse.ArgumentParser(description="Bulk import users into userdb")
+	parser.add_argument("path")
+	parser.add_argument("--format", choices=["csv", "ndjson"], help="defaults to the file extension")
+	parser.add_argument("--batch-size", type=int, default=1000)
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--resume", action="store_true", help="skip batches committed by a previous run")
+	parser.add_argument("--skip-existing", action="store_true", help="skip usernames already in userdb")
+	args = parser.parse_args()
+
+	load_dotenv()
+	file_format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+
+	# インポートは同期ドライバで行う(PostgresならCOPYを使う)
+	url = make_url(os.environ["DATABASE_URL"])
+	url = url.set(drivername=url.get_backend_name())
+	engine = create_engine(url)
+
+	started = time.perf_counter()
+	with ProcessPoolExecutor(args.workers) as executor:
+		stats = import_users(
+			engine, executor, args.path, file_format, args.batch_size, args.workers,
+			resume=args.resume, skip_existing=args.skip_existing
+		)
+
+	# スループットの集計
+	elapsed = time.perf_counter() - started
+	imported = stats.imported
+	print(f"imported: {imported}")
+	print(f"invalid: {stats.invalid}")
+	print(f"skipped duplicate: {stats.duplicate}")
+	print(f"skipped existing: {stats.existing}")
+	print(f"hash time: {stats.hash_seconds:.2f}s ({imported / stats.hash_seconds if stats.hash_seconds else 0:.0f} users/s)")
+	print(f"load time: {stats.load_seconds:.2f}s ({imported / stats.load_seconds if stats.load_seconds else 0:.0f} users/s)")
+	print(f"total: {elapsed:.2f}s ({imported / elapsed if elapsed else 0:.0f} users/s)")
+	return 0
+
+if __name__ == "__main__":
+	raise SystemExit(main())
@@ -29,51 +29,262 @@
 
 
 """
-from fastapi import FastAPI, Depends, HTTPException, Response, Path
-from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from sqlmodel import Session, create_engine, select
+from fastapi import FastAPI, Depends, HTTPException, Response, Path, Request, Form, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.security import OAuth2PasswordBearer
+from sqlmodel import select, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
 import os
-from typing import Annotated
-from pwdlib import PasswordHash
+import logging
+import hashlib
+import json
+import secrets
+from urllib.parse import parse_qsl, urlencode
+from typing import Annotated, Literal
 from datetime import datetime, timezone, timedelta
+from contextlib import asynccontextmanager
 import jwt
 from jwt.exceptions import InvalidTokenError
 
-from models import User, Item, UserResponse, ItemResponse, UserDB, ItemDB, Token
+from pydantic import ValidationError
+from models import (
+	User, Item, UserResponse, ItemResponse, UserDB, ItemDB, Token, RefreshTokenDB, BulkItemResult,
+	ItemStatsDB, ItemStats
+)
+from hashing import DUMMY, LOGIN, REGISTER, HashPool, HashQueueFull
+from group_commit import GroupCommitter
+from cache import Cache, PrincipalCache, ResponseCache, cache_backend_from_env
+from throttle import CacheThrottleBackend, LoginThrottle, MemoryThrottleBackend
+from database import (
+	SessionLocal, get_session, get_read_session, replicas, sticky_cookie, is_sticky,
+	pool_snapshot, query_count, dialect_insert, parse_bool
+)
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, apply_keyset, next_page, prefix_filter
+from search import MIN_QUERY_LENGTH, MAX_QUERY_LENGTH, search_statement
+from stats import add_items_statement, remove_items_statement, to_response
+from purge import PurgeWorker, live_items
+from counts import add_counts_statement, exact_count, plan_estimate, table_estimate
 
 load_dotenv()
-app = FastAPI()
-oauth2 = OAuth2PasswordBearer(tokenUrl="token")
 
-HASHER = PasswordHash.recommended()
-DUMMY = HASHER.hash("dummy_hash")
-DATABASE_URL = os.environ["DATABASE_URL"]
 KEY = os.environ["SECRET_KEY"]
 ALGORITHM = os.environ["ALGORITHM"]
+TOKEN_VERSION = 2	# 1: subのみ, 2: uidを含む
+ACCESS_TOKEN_EXPIRE = timedelta(minutes=30)
+REFRESH_TOKEN_EXPIRE = timedelta(days=float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 14)))
+
+# ハッシュ計算用のワーカープール(既定はCPUコア数)
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+hash_pool = HashPool(
+	workers=HASH_WORKERS,
+	max_queue=int(os.getenv("HASH_QUEUE_SIZE", HASH_WORKERS * 16)),
+	executor=os.getenv("HASH_EXECUTOR", "process")
+)
+
+# キャッシュの保存先(CACHE_BACKEND=memory|shm|redis、ワーカー間で共有する場合はshmかredis)
+cache = Cache(cache_backend_from_env())
+
+# 認証済みユーザーのキャッシュ
+principal_cache = PrincipalCache(cache, ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", 60)))
+
+# ログイン試行の制限(ハッシュ計算の前に評価する、キャッシュがshmかredisならワーカー間で共有)
+login_throttle = LoginThrottle(
+	backend=MemoryThrottleBackend() if cache.backend.name == "memory" else CacheThrottleBackend(cache.backend),
+	limits={
+		"user": (float(os.getenv("LOGIN_USER_RATE", 0.2)), float(os.getenv("LOGIN_USER_BURST", 5))),
+		"ip": (float(os.getenv("LOGIN_IP_RATE", 1)), float(os.getenv("LOGIN_IP_BURST", 20)))
+	},
+	lockout_threshold=int(os.getenv("LOGIN_LOCKOUT_THRESHOLD", 5)),
+	lockout_base=float(os.getenv("LOGIN_LOCKOUT_BASE", 1)),
+	lockout_max=float(os.getenv("LOGIN_LOCKOUT_MAX", 900))
+)
+
+# 論理削除した行の物理削除(PURGE_INTERVAL=0で無効、複数ワーカーで動かしても重複しない)
+purge_worker = PurgeWorker(
+	SessionLocal,
+	interval=float(os.getenv("PURGE_INTERVAL", 60)),
+	batch_size=int(os.getenv("PURGE_BATCH_SIZE", 500)),
+	pause=float(os.getenv("PURGE_BATCH_PAUSE", 0.1)),
+	grace=float(os.getenv("PURGE_GRACE", 0))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	if purge_worker.interval > 0:
+		purge_worker.start()
+	yield
+	await purge_worker.close()
+	if item_committer is not None:
+		await item_committer.close()
+	hash_pool.shutdown()
+	await cache.backend.close()
+
+app = FastAPI(lifespan=lifespan)
+logger = logging.getLogger(__name__)
+
+# 1リクエストあたりのSQL発行数の上限(超えた場合は警告し、統計に残す)
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", 20))
+query_budget_stats = {"over_budget": 0, "max_queries": {}}
+
+class QueryBudgetMiddleware:
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope["type"] != "http":
+			await self.app(scope, receive, send)
+			return
+
+		counter = [0]
+		token = query_count.set(counter)
+		try:
+			await self.app(scope, receive, send)
+		finally:
+			query_count.reset(token)
+
+			# ルートごとの最大発行数を記録
+			route = scope.get("route")
+			path = f"{scope['method']} {route.path if route else scope['path']}"
+			max_queries = query_budget_stats["max_queries"]
+			max_queries[path] = max(max_queries.get(path, 0), counter[0])
+			if counter[0] > QUERY_BUDGET:
+				query_budget_stats["over_budget"] += 1
+				logger.warning("%s issued %d queries (budget %d)", path, counter[0], QUERY_BUDGET)
+
+# 書き込みに成功したクライアントには、しばらくプライマリから読ませるCookieを返す
+class ReadYourWritesMiddleware:
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS") or not replicas.engines:
+			await self.app(scope, receive, send)
+			return
+
+		async def send_with_cookie(message):
+			if message["type"] == "http.response.start" and message["status"] < 400:
+				headers = list(message.get("headers", []))
+				headers.append((b"set-cookie", sticky_cookie().encode()))
+				message = {**message, "headers": headers}
+			await send(message)
+
+		await self.app(scope, receive, send_with_cookie)
+
+# 一覧系のGETのレスポンスキャッシュ(ルートごとに結果が依存するデータのタグを指定)
+CACHED_ROUTES = {
+	"/users": ("users", "items"),
+	"/items": ("items",),
+	"/items/stats": ("items",)
+}
+RESPONSE_CACHE_MAX_AGE = int(os.getenv("RESPONSE_CACHE_MAX_AGE", 0))
+response_cache = ResponseCache(cache, ttl=float(os.getenv("RESPONSE_CACHE_TTL", 30)))
+
+def cache_control() -> bytes:
+	# max-age=0なら、CDNやブラウザは毎回ETagで再検証する(変更が無ければ304)
+	if RESPONSE_CACHE_MAX_AGE > 0:
+		return f"public, max-age={RESPONSE_CACHE_MAX_AGE}".encode()
+	return b"public, max-age=0, must-revalidate"
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+	if if_none_match.strip() == "*":
+		return True
+	return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+class ResponseCacheMiddleware:
+	def __init__(self, app):
+		self.app = app
+
+	async def __call__(self, scope, receive, send):
+		tags = CACHED_ROUTES.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "GET" else None
+		if tags is None or response_cache.ttl <= 0:	# RESPONSE_CACHE_TTL=0で無効
+			await self.app(scope, receive, send)
+			return
+
+		# キーはパスと正規化したクエリ文字列、データのバージョンは処理前に取得して共に保存する
+		# (処理中に書き込みがあれば、保存した結果は古いバージョンとして参照されない)
+		query = urlencode(sorted(parse_qsl(scope["query_string"].decode(), keep_blank_values=True)))
+		key = f"{scope['path']}?{query}"
+		versions = await response_cache.versions(tags)
+		request = Request(scope)
+
+		# 書き込み直後のクライアントはキャッシュを使わず、プライマリの結果で更新する
+		entry = None if is_sticky(request) else await response_cache.get(key)
+		if entry is None:
+			start, chunks = None, []
+
+			async def capture(message):
+				nonlocal start
+				if message["type"] == "http.response.start":
+					start = message
+				else:
+					chunks.append(message.get("body", b""))
+
+			await self.app(scope, receive, capture)
+			body = b"".join(chunks)
+			if start["status"] != 200:
+				await send(start)
+				await send({"type": "http.response.body", "body": body})
+				return
+			etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'.encode()
+			headers = [
+				(name, value) for name, value in start.get("headers", [])
+				if name not in (b"content-length", b"set-cookie")
+			]
+			await response_cache.set(key, versions, etag, headers, body)
+		else:
+			etag, headers, body = entry
+
+		headers = headers + [(b"etag", etag), (b"cache-control", cache_control())]
+		if etag_matches(request.headers.get("if-none-match", ""), etag.decode()):
+			response_cache.not_modified += 1
+			await send({"type": "http.response.start", "status": 304, "headers": headers})
+			await send({"type": "http.response.body", "body": b""})
+			return
+		headers.append((b"content-length", str(len(body)).encode()))
+		await send({"type": "http.response.start", "status": 200, "headers": headers})
+		await send({"type": "http.response.body", "body": body})
+
+app.add_middleware(QueryBudgetMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(ResponseCacheMiddleware)
+oauth2 = OAuth2PasswordBearer(tokenUrl="token")
 
-engine = create_engine(DATABASE_URL)
-
-def get_session():
-	with Session(engine) as session:
-		yield session
+# ハッシュの待ち行列が満杯の時は503で再試行を促す
+@app.exception_handler(HashQueueFull)
+async def handle_hash_queue_full(request: Request, exc: HashQueueFull):
+	return JSONResponse(
+		status_code=503,
+		content={"detail": "Server is busy"},
+		headers={"Retry-After": str(exc.retry_after)}
+	)
 
-def auth_users(
+async def auth_users(
 	username: str,
 	password: str,
-	session: Session
+	session: AsyncSession
 ) -> UserDB | None:
 
-	# ユーザーデータの取得
-	statement = select(UserDB).where(UserDB.username == username)
-	db_user = session.exec(statement).first()
+	# ユーザーデータの取得(削除済みのユーザーは除く)
+	statement = select(UserDB).where(UserDB.username == username, UserDB.deleted_at.is_(None))
+	db_user = (await session.exec(statement)).first()
 	if not db_user:
-		HASHER.verify(password, DUMMY)	# 疑似検証
+		await hash_pool.verify(password, DUMMY, LOGIN)	# 疑似検証
 		return None
 
 	# ハッシュの検証
-	if not HASHER.verify(password, db_user.password):
+	valid, updated = await hash_pool.verify_and_update(password, db_user.password, LOGIN)
+	if not valid:
 		return None
+
+	# パラメータ変更後の初回ログインで再ハッシュ
+	if updated:
+		db_user.password = updated
+		session.add(db_user)
+		await session.commit()
 	return db_user
 
 def create_token(
@@ -91,10 +302,7 @@ def create_token(
 	token = jwt.encode(copy_sub, KEY, ALGORITHM)
 	return token
 
-def get_cur_users(
-	token: Annotated[str, Depends(oauth2)],
-	session: Annotated[Session, Depends(get_session)]
-) -> UserDB:
+def decode_token(token: str) -> dict:
 	error_detail = HTTPException(
 		status_code=401,
 		detail="Authentication failed",
@@ -104,161 +312,691 @@ def get_cur_users(
 	# トークンをデコード
 	try:
 		payload = jwt.decode(token, KEY, [ALGORITHM])
-		username = payload.get("sub")
-		if not username:
+		if not payload.get("sub"):
 			raise error_detail
 	except InvalidTokenError:
 		raise error_detail
+	return payload
+
+async def get_cur_users(
+	token: Annotated[str, Depends(oauth2)],
+	session: Annotated[AsyncSession, Depends(get_session)]
+) -> UserDB:
+	error_detail = HTTPException(
+		status_code=401,
+		detail="Authentication failed",
+		headers={"WWW-Authenticate": "Bearer"}
+	)
+
+	# キャッシュ済みならDBを参照しない(復元したユーザーはパスワードを持たない)
+	cached = await principal_cache.get(token)
+	if cached:
+		return UserDB(**cached[1])
+
+	payload = decode_token(token)
+	username = payload["sub"]
+	user_id = payload.get("uid")
+
+	# 無効化のバージョンは読み込む前に取得(読み込み中に削除されたら保存した結果は使われない)
+	versions = await principal_cache.versions(user_id) if user_id else None
 
 	# ユーザーデータを取得
-	statement = select(UserDB).where(UserDB.username == username)
-	db_user = session.exec(statement).first()
+	if payload.get("ver") == TOKEN_VERSION and user_id:
+		# 主キーで取得し、IDの再利用に備えてユーザー名も確認
+		db_user = await session.get(UserDB, user_id)
+		if db_user and (db_user.username != username or db_user.deleted_at):
+			db_user = None
+	else:
+		# 旧形式(ユーザー名のみ)のトークン
+		statement = select(UserDB).where(UserDB.username == username, UserDB.deleted_at.is_(None))
+		db_user = (await session.exec(statement)).first()
 	if not db_user:
 		raise error_detail
+
+	# 共有のキャッシュに置けるよう、ユーザーはdictのスナップショットで保存(パスワードのハッシュは含めない)
+	if versions is None:
+		versions = await principal_cache.versions(db_user.id)
+	await principal_cache.set(token, payload, db_user.model_dump(exclude={"password"}), versions)
 	return db_user
 
-# トークンの発行
+async def get_cur_claims(
+	token: Annotated[str, Depends(oauth2)],
+	session: Annotated[AsyncSession, Depends(get_session)]
+) -> dict:
+	# IDだけが必要なエンドポイント用、新形式のトークンならDBを参照しない
+	cached = await principal_cache.get(token)
+	if cached:
+		return {"uid": cached[1]["id"], "sub": cached[1]["username"]}
+
+	payload = decode_token(token)
+	if payload.get("ver") == TOKEN_VERSION and payload.get("uid"):
+		return {"uid": payload["uid"], "sub": payload["sub"]}
+
+	# 旧形式のトークンはユーザーを引いてIDを得る
+	db_user = await get_cur_users(token, session)
+	return {"uid": db_user.id, "sub": db_user.username}
+
+def hash_refresh_token(refresh_token: str) -> str:
+	# 十分に長いランダム値なので、高速なハッシュで照合できる
+	return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+async def issue_tokens(
+	db_user: UserDB,
+	session: AsyncSession
+) -> Token:
+
+	# 有効期限の設定、トークンの作成
+	token = create_token(
+		user_sub={
+			"sub": db_user.username,
+			"uid": db_user.id,
+			"ver": TOKEN_VERSION
+		},
+		token_expire=ACCESS_TOKEN_EXPIRE
+	)
+
+	# リフレッシュトークンはハッシュのみ保存
+	refresh_token = secrets.token_urlsafe(32)
+	session.add(RefreshTokenDB(
+		user_id=db_user.id,
+		token_hash=hash_refresh_token(refresh_token),
+		expires_at=datetime.now(timezone.utc) + REFRESH_TOKEN_EXPIRE
+	))
+	await session.commit()
+
+	return Token(
+		access_token=token,
+		token_type="Bearer",
+		refresh_token=refresh_token
+	)
+
+# トークンの発行(password / refresh_token)
 @app.post("/token")
 async def handle_token(
-	form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-	session: Annotated[Session, Depends(get_session)]
+	request: Request,
+	session: Annotated[AsyncSession, Depends(get_session)],
+	grant_type: Annotated[str, Form(pattern="^(password|refresh_token)$")] = "password",
+	username: Annotated[str | None, Form()] = None,
+	password: Annotated[str | None, Form()] = None,
+	refresh_token: Annotated[str | None, Form()] = None
 ) -> Token:
+	error_detail = HTTPException(
+		status_code=401,
+		detail="Authentication failed",
+		headers={"WWW-Authenticate": "Bearer"}
+	)
+
+	# リフレッシュトークンの使用(使用済みは削除して再発行)
+	if grant_type == "refresh_token":
+		if not refresh_token:
+			raise error_detail
+		statement = (
+			delete(RefreshTokenDB)
+			.where(RefreshTokenDB.token_hash == hash_refresh_token(refresh_token))
+			.where(RefreshTokenDB.expires_at > datetime.now(timezone.utc))
+			.returning(RefreshTokenDB.user_id)
+		)
+		user_id = (await session.exec(statement)).scalar()
+		db_user = await session.get(UserDB, user_id) if user_id else None
+		if not db_user or db_user.deleted_at:
+			await session.rollback()
+			raise error_detail
+		return await issue_tokens(db_user, session)
+
+	if username is None or password is None:
+		raise HTTPException(
+			status_code=422,
+			detail="username and password are required"
+		)
+
+	# 試行回数の制限(ハッシュ計算の前に弾く)
+	client_ip = request.client.host if request.client else None
+	throttle_keys = login_throttle.keys(username, client_ip)
+	retry_after = await login_throttle.check(throttle_keys)
+	if retry_after:
+		raise HTTPException(
+			status_code=429,
+			detail="Too many login attempts",
+			headers={"Retry-After": str(retry_after)}
+		)
 
 	# ユーザーの承認
-	db_user = auth_users(
-		form_data.username,
-		form_data.password,
+	db_user = await auth_users(
+		username,
+		password,
 		session
 	)
 	if not db_user:
-		raise HTTPException(
-			status_code=401,
-			detail="Authentication failed",
-			headers={"WWW-Authenticate": "Bearer"}
-		)
+		await login_throttle.failure(throttle_keys)
+		raise error_detail
 
-	# 有効期限の設定、トークンの作成
-	token_expire = timedelta(minutes=30)
-	token = create_token(
-		user_sub={"sub": db_user.username},
-		token_expire=token_expire
-	)
-	return Token(
-		access_token=token,
-		token_type="Bearer"
-	)
+	await login_throttle.success(throttle_keys)
+	return await issue_tokens(db_user, session)
 
 # ユーザーの追加(重複排除)
 @app.post("/users/register")
 async def handle_add_users(
 	user: User,
-	session: Annotated[Session, Depends(get_session)]
+	session: Annotated[AsyncSession, Depends(get_session)]
 ) -> UserResponse:
 
 	# ユーザーDB型への変換
 	db_user = UserDB.model_validate(user)
 
-	# 既存ユーザーとの重複確認
-	statement = select(UserDB).where(UserDB.username == db_user.username)
-	in_db_user = session.exec(statement).first()
-	if in_db_user:
+	# パスのハッシュ化
+	db_user.password = await hash_pool.hash(db_user.password, REGISTER)
+
+	# ユーザーデータの保存(重複は削除されていないユーザーのユニーク制約で検出)と総件数の更新
+	session.add(db_user)
+	try:
+		await session.flush()
+		await session.exec(add_counts_statement(session.bind.dialect.name, {"userdb": 1}))
+		await session.commit()
+	except IntegrityError:
+		await session.rollback()
 		raise HTTPException(
 			status_code=409,
 			detail="Username is already used"
 		)
+	await response_cache.bump("users")
+
+	# 新規ユーザーのアイテムは空
+	return UserResponse.model_validate(db_user.model_dump())
+
+# 一覧の総件数(exact: 書き込みと共に管理している件数、estimated: Postgresの統計情報・プランナの推定値)
+CountMode = Literal["exact", "estimated"]
+
+async def total_count(
+	session: AsyncSession,
+	mode: CountMode,
+	table_name: str,
+	statement=None,
+	exact=None
+) -> int:
+	# 推定値は絞り込みが無ければテーブルの行数、あれば問い合わせの推定行数
+	# (Postgres以外や未ANALYZEで推定できない場合は、正確な件数を返す)
+	if mode == "estimated":
+		if statement is None:
+			estimate = await table_estimate(session, table_name)
+		else:
+			estimate = await plan_estimate(session, statement)
+		if estimate is not None:
+			return estimate
+
+	# 正確な件数は管理している件数から求められる場合のみ(COUNT(*)で全件を数えない)
+	if exact is None:
+		raise HTTPException(
+			status_code=400,
+			detail="Total count is not available with these filters"
+		)
+	return await exact()
 
-	# パスのハッシュ化
-	db_user.password = HASHER.hash(db_user.password)
-
-	# ユーザーデータの保存
-	session.add(db_user)
-	session.commit()
-	session.refresh(db_user)
-	return db_user
-
-# 保存されているユーザーデータの取得
-@app.get("/users")
+# 保存されているユーザーデータの取得(HEADは総件数のみ)
+@app.api_route("/users", methods=["GET", "HEAD"], response_model_exclude_unset=True)
 async def handle_all_users(
-	session: Annotated[Session, Depends(get_session)]
+	request: Request,
+	response: Response,
+	session: Annotated[AsyncSession, Depends(get_read_session)],
+	limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+	cursor: str | None = None,
+	sort: Literal["id", "-id", "username", "-username"] = "id",
+	include: Literal["items"] | None = None,
+	count: CountMode | None = None
 ) -> list[UserResponse]:
 
-	db_users = session.exec(select(UserDB)).all()
+	# 総件数はX-Total-Countで返す(HEADでは指定が無ければexact)
+	if request.method == "HEAD":
+		count = count or "exact"
+	if count:
+		total = await total_count(session, count, "userdb", exact=lambda: exact_count(session, "userdb"))
+		response.headers["X-Total-Count"] = str(total)
+	if request.method == "HEAD":
+		return Response(headers={"X-Total-Count": str(total)})
+
+	# アイテムは指定時のみ、ページ内のユーザー分を一度のクエリでまとめて取得
+	statement = select(UserDB).where(UserDB.deleted_at.is_(None))
+	if include == "items":
+		statement = statement.options(selectinload(UserDB.items.and_(ItemDB.deleted_at.is_(None))))
+
+	# カーソル(キーセット)によるページング、続きはX-Next-Cursorで返す
+	statement = apply_keyset(statement, UserDB, sort, cursor, limit)
+	db_users, next_cursor = next_page((await session.exec(statement)).all(), sort, limit)
+	if next_cursor:
+		response.headers["X-Next-Cursor"] = next_cursor
+
+	# 指定が無い場合はitemsを含めない(itemdbに触れない)
+	if include != "items":
+		return [UserResponse.model_validate(db_user.model_dump()) for db_user in db_users]
 	return db_users
 
 # ユーザーの削除
 @app.delete("/users", status_code=204)
 async def handle_delete_users(
 	cur_user: Annotated[UserDB, Depends(get_cur_users)],
-	session: Annotated[Session, Depends(get_session)]
+	session: Annotated[AsyncSession, Depends(get_session)]
 ):
-	# ユーザーアイテムの削除
-	for item in cur_user.items:
-		session.delete(item)
+	# ユーザーを論理削除するだけで、アイテムには触れずに返す
+	# (アイテムは一覧などから除外され、ユーザーと共にpurge_workerが少しずつ物理削除する)
+	# アイテムの名前はpurge_workerが次に動く(PURGE_INTERVAL)まで使用中のまま残り、PURGE_INTERVAL=0では解放されない
+	# 同じトークンで同時に削除された場合は、先に更新した要求だけが件数などを変更する
+	result = await session.exec(
+		update(UserDB)
+		.where(UserDB.id == cur_user.id, UserDB.deleted_at.is_(None))
+		.values(deleted_at=datetime.now(timezone.utc))
+	)
+	if result.rowcount == 0:
+		await session.rollback()
+		raise HTTPException(
+			status_code=404,
+			detail="User not found"
+		)
 
-	session.delete(cur_user)
-	session.commit()
-	return Response(status_code=204)
+	# リフレッシュトークンの失効とアイテム集計の削除(集計の件数だけアイテムの総件数から引く)
+	await session.exec(delete(RefreshTokenDB).where(RefreshTokenDB.user_id == cur_user.id))
+	statement = delete(ItemStatsDB).where(ItemStatsDB.user_id == cur_user.id).returning(ItemStatsDB.item_count)
+	item_count = (await session.exec(statement)).scalar() or 0
+	await session.exec(add_counts_statement(session.bind.dialect.name, {"userdb": -1, "itemdb": -item_count}))
+	await session.commit()
 
-# ユーザーアイテムの追加
-@app.post("/items/register")
-async def handle_add_items(
-	item: Item,
-	cur_user: Annotated[UserDB, Depends(get_cur_users)],
-	session: Annotated[Session, Depends(get_session)]
-) -> ItemResponse:
+	# 認証キャッシュとレスポンスキャッシュの無効化
+	await principal_cache.invalidate_user(cur_user.id)
+	await response_cache.bump("users", "items")
+	return Response(status_code=204)
 
-	# アイテムDB型に変換
-	db_item = ItemDB.model_validate(item)
+async def lock_live_users(session: AsyncSession, user_ids) -> set[int]:
+	# 論理削除されていない所有者を返す(外部キーは論理削除を検出しないので、登録前に確認する)
+	# Postgresでは行を共有ロックし、コミットまで削除のUPDATEを待たせる(削除側が集計と件数から確実に引ける)
+	statement = select(UserDB.id).where(UserDB.id.in_(sorted(set(user_ids))), UserDB.deleted_at.is_(None))
+	if session.bind.dialect.name == "postgresql":
+		statement = statement.order_by(UserDB.id).with_for_update(read=True)
+	return set((await session.exec(statement)).all())
+
+def user_not_found() -> HTTPException:
+	return HTTPException(
+		status_code=404,
+		detail="User not found"
+	)
 
-	# アイテム名の重複を確認
-	statement = select(ItemDB).where(ItemDB.name == db_item.name)
-	in_db_item = session.exec(statement).first()
-	if in_db_item:
+async def insert_item(session: AsyncSession, user_id: int, item: Item) -> ItemDB:
+	# 重複した名前は行を飛ばし、結果が無ければ409(itemdbを分割した場合は名前の重複をトリガーで飛ばす)
+	if not await lock_live_users(session, [user_id]):
+		await session.rollback()
+		raise user_not_found()
+	statement = (
+		dialect_insert(session, ItemDB)
+		.values(user_id=user_id, name=item.name, price=item.price)
+		.on_conflict_do_nothing()
+		.returning(ItemDB.id, ItemDB.user_id, ItemDB.name, ItemDB.price)
+	)
+	try:
+		row = (await session.exec(statement)).first()
+		if row is not None:
+			await session.exec(add_items_statement(session.bind.dialect.name, user_id, [row.price]))
+			await session.exec(add_counts_statement(session.bind.dialect.name, {"itemdb": 1}))
+			await session.commit()
+	except IntegrityError:
+		row = None
+	if row is None:
+		await session.rollback()
 		raise HTTPException(
 			status_code=409,
 			detail="Item name is already used"
 		)
+	return ItemDB(**row._asdict())
+
+async def insert_item_group(requests: list[tuple[int, Item]]) -> list:
+	# まとめて一つのINSERTで登録し、重複した名前は行を飛ばして結果から判定
+	# (競合の対象は指定しない: itemdbを分割した場合は名前の一意インデックスが無く、トリガーが行を飛ばす)
+	async with SessionLocal() as session:
+		# 削除済みのユーザーの要求は404にして、残りを登録
+		live = await lock_live_users(session, [user_id for user_id, _ in requests])
+		if not live:
+			await session.rollback()
+			return [user_not_found() for _ in requests]
+		statement = (
+			dialect_insert(session, ItemDB)
+			.values([
+				{"user_id": user_id, "name": item.name, "price": item.price}
+				for user_id, item in requests if user_id in live
+			])
+			.on_conflict_do_nothing()
+			.returning(ItemDB.id, ItemDB.user_id, ItemDB.name, ItemDB.price)
+		)
+		try:
+			rows = (await session.exec(statement)).all()
+			prices: dict[int, list[int]] = {}
+			for row in rows:
+				prices.setdefault(row.user_id, []).append(row.price)
+			for user_id, user_prices in prices.items():
+				await session.exec(add_items_statement(session.bind.dialect.name, user_id, user_prices))
+			if rows:
+				await session.exec(add_counts_statement(session.bind.dialect.name, {"itemdb": len(rows)}))
+			await session.commit()
+		except IntegrityError:
+			# 登録中にユーザーが削除された場合などはバッチ全体が失敗するので、1件ずつ処理し直す
+			await session.rollback()
+			rows = None
+
+	if rows is None:
+		results = []
+		for user_id, item in requests:
+			async with SessionLocal() as session:
+				try:
+					results.append((await insert_item(session, user_id, item)).model_dump())
+				except HTTPException as e:
+					results.append(e)
+		return results
+
+	# 同じ名前が複数あれば、先に届いた要求が登録され、残りは重複
+	created = {row.name: row._asdict() for row in rows}
+	return [
+		user_not_found() if user_id not in live else created.pop(item.name, None) or HTTPException(
+			status_code=409,
+			detail="Item name is already used"
+		)
+		for user_id, item in requests
+	]
 
-	# ユーザーIDの付与
-	db_item.user_id = cur_user.id
+# アイテム登録のgroup commit(有効な場合、同時に届いた登録を一つのトランザクションにまとめる)
+item_committer = GroupCommitter(
+	insert_item_group,
+	window=float(os.getenv("ITEM_GROUP_COMMIT_WINDOW_MS", 2)) / 1000,
+	max_batch=int(os.getenv("ITEM_GROUP_COMMIT_MAX", 64))
+) if parse_bool(os.getenv("ITEM_GROUP_COMMIT", "false")) else None
 
-	# データの保存
-	session.add(db_item)
-	session.commit()
-	session.refresh(db_item)
+# ユーザーアイテムの追加
+@app.post("/items/register")
+async def handle_add_items(
+	item: Item,
+	cur_user: Annotated[UserDB, Depends(get_cur_users)],
+	session: Annotated[AsyncSession, Depends(get_session)]
+) -> ItemResponse:
+	if item_committer is not None:
+		db_item = await item_committer.submit((cur_user.id, item))
+	else:
+		db_item = await insert_item(session, cur_user.id, item)
+	await response_cache.bump("items")
 	return db_item
 
-# ユーザーアイテムの参照(認証なし)
-@app.get("/items")
+# 一括登録の1トランザクションあたりの件数と、1行の最大長
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1000))
+BULK_MAX_LINE_BYTES = 64 * 1024
+
+async def insert_item_batch(
+	batch: list[tuple[int, Item]],
+	user_id: int,
+	session: AsyncSession,
+	results: list[dict]
+):
+	# 複数行のINSERTで登録し、名前の重複は行を飛ばして結果から判定
+	if not await lock_live_users(session, [user_id]):
+		await session.rollback()
+		raise user_not_found()
+	statement = (
+		dialect_insert(session, ItemDB)
+		.values([{"user_id": user_id, "name": item.name, "price": item.price} for _, item in batch])
+		.on_conflict_do_nothing()
+		.returning(ItemDB.id, ItemDB.name, ItemDB.price)
+	)
+	rows = (await session.exec(statement)).all()
+	created = {row.name: row.id for row in rows}
+	if rows:
+		await session.exec(add_items_statement(session.bind.dialect.name, user_id, [row.price for row in rows]))
+		await session.exec(add_counts_statement(session.bind.dialect.name, {"itemdb": len(rows)}))
+	await session.commit()
+	await response_cache.bump("items")
+
+	for line, item in batch:
+		if item.name in created:
+			results.append({"line": line, "status": "created", "id": created[item.name], "name": item.name})
+		else:
+			results.append({"line": line, "status": "duplicate", "name": item.name})
+
+# アイテムの一括登録(NDJSONを受け取りながら処理する)
+# (結果はJSONResponseで直接返すので、BulkItemResultはドキュメントのためだけに指定)
+@app.post("/items/bulk", responses={200: {"model": list[BulkItemResult]}})
+async def handle_bulk_items(
+	request: Request,
+	cur_user: Annotated[UserDB, Depends(get_cur_users)],
+	session: Annotated[AsyncSession, Depends(get_session)]
+):
+	user_id = cur_user.id
+	results = []
+	batch: list[tuple[int, Item]] = []
+	names = set()	# 同じバッチ内の重複
+	buffer = b""
+	line_no = 0
+
+	async def handle_line(raw: bytes, too_long: bool = False):
+		nonlocal line_no
+		line_no += 1
+		if too_long or len(raw) > BULK_MAX_LINE_BYTES:
+			results.append({"line": line_no, "status": "invalid", "detail": "Line is too long"})
+			return
+		if not raw.strip():
+			return
+		try:
+			item = Item.model_validate_json(raw)
+		except ValidationError as e:
+			results.append({"line": line_no, "status": "invalid", "detail": e.errors()[0]["msg"]})
+			return
+		if item.name in names:
+			results.append({"line": line_no, "status": "duplicate", "name": item.name})
+			return
+		names.add(item.name)
+		batch.append((line_no, item))
+
+		# 一定件数ごとにまとめて登録
+		if len(batch) >= BULK_BATCH_SIZE:
+			await insert_item_batch(batch, user_id, session, results)
+			batch.clear()
+			names.clear()
+
+	# 本文全体は保持せず、改行ごとに処理する
+	# (上限を超えた行は改行まで読み捨て、その行だけを不正として返す)
+	too_long = False
+	async for chunk in request.stream():
+		buffer += chunk
+		*lines, buffer = buffer.split(b"\n")
+		for raw in lines:
+			await handle_line(raw, too_long)
+			too_long = False
+		if len(buffer) > BULK_MAX_LINE_BYTES:
+			buffer = b""
+			too_long = True
+	await handle_line(buffer, too_long)
+	if batch:
+		await insert_item_batch(batch, user_id, session, results)
+
+	results.sort(key=lambda result: result["line"])
+	return JSONResponse(results)
+
+async def count_user_items(session: AsyncSession, user_id: int) -> int:
+	# 所有者ごとの件数はアイテム集計から読む
+	statement = select(ItemStatsDB.item_count).where(ItemStatsDB.user_id == user_id)
+	return (await session.exec(statement)).first() or 0
+
+# ユーザーアイテムの参照(認証なし、HEADは総件数のみ)
+@app.api_route("/items", methods=["GET", "HEAD"])
 async def handle_all_items(
-	session: Annotated[Session, Depends(get_session)]
+	request: Request,
+	response: Response,
+	session: Annotated[AsyncSession, Depends(get_read_session)],
+	limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+	cursor: str | None = None,
+	sort: Literal["id", "-id", "price", "-price"] = "id",
+	user_id: Annotated[int | None, Query(ge=1)] = None,
+	min_price: Annotated[int | None, Query(ge=0)] = None,
+	max_price: Annotated[int | None, Query(ge=0)] = None,
+	name_prefix: Annotated[str | None, Query(min_length=1)] = None,
+	count: CountMode | None = None
 ) -> list[ItemResponse]:
 
-	db_items = session.exec(select(ItemDB)).all()
+	# 絞り込み(ix_itemdb_user_id_id, ix_itemdb_user_id_price, ix_itemdb_priceを使う)
+	conditions = list(live_items())
+	if user_id is not None:
+		conditions.append(ItemDB.user_id == user_id)
+	if min_price is not None:
+		conditions.append(ItemDB.price >= min_price)
+	if max_price is not None:
+		conditions.append(ItemDB.price <= max_price)
+	if name_prefix is not None:
+		conditions.extend(prefix_filter(ItemDB.name, name_prefix))
+
+	# 総件数はX-Total-Countで返す(HEADでは指定が無ければexact)
+	# 正確な件数は絞り込み無し(総件数)か所有者のみ(アイテム集計)の場合に返せる
+	if request.method == "HEAD":
+		count = count or "exact"
+	if count:
+		filtered = any(value is not None for value in (user_id, min_price, max_price, name_prefix))
+		exact = None
+		if not filtered:
+			exact = lambda: exact_count(session, "itemdb")
+		elif min_price is None and max_price is None and name_prefix is None:
+			exact = lambda: count_user_items(session, user_id)
+		total = await total_count(
+			session, count, "itemdb",
+			statement=select(ItemDB.id).where(*conditions) if filtered else None,
+			exact=exact
+		)
+		response.headers["X-Total-Count"] = str(total)
+	if request.method == "HEAD":
+		return Response(headers={"X-Total-Count": str(total)})
+
+	statement = select(ItemDB).where(*conditions)
+
+	# カーソル(キーセット)によるページング、続きはX-Next-Cursorで返す
+	statement = apply_keyset(statement, ItemDB, sort, cursor, limit)
+	db_items, next_cursor = next_page((await session.exec(statement)).all(), sort, limit)
+	if next_cursor:
+		response.headers["X-Next-Cursor"] = next_cursor
 	return db_items
 
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+async def export_items(session: AsyncSession, export_format: str):
+	statement = (
+		select(ItemDB.id, ItemDB.user_id, ItemDB.name, ItemDB.price)
+		.where(*live_items())
+		.order_by(ItemDB.id)
+		.execution_options(yield_per=EXPORT_CHUNK_SIZE)
+	)
+	# サーバーサイドカーソルから一定件数ずつ取り出して書き出す
+	result = await session.stream(statement)
+	first = True
+	if export_format == "json":
+		yield "["
+	async for rows in result.partitions():
+		lines = [json.dumps(row._asdict(), ensure_ascii=False) for row in rows]
+		if export_format == "json":
+			yield ("" if first else ",") + ",".join(lines)
+		else:
+			yield "".join(f"{line}\n" for line in lines)
+		first = False
+	if export_format == "json":
+		yield "]"
+
+# アイテムの全件出力(認証なし、件数に関わらずメモリ使用量は一定)
+@app.get("/items/export")
+async def handle_export_items(
+	session: Annotated[AsyncSession, Depends(get_read_session)],
+	format: Literal["json", "ndjson"] = "ndjson"
+):
+	# セッションはレスポンスの送信が終わるまで開いたまま
+	media_type = "application/json" if format == "json" else "application/x-ndjson"
+	return StreamingResponse(export_items(session, format), media_type=media_type)
+
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 30))
+
+# アイテム名の部分一致・あいまい検索(認証なし)
+@app.get("/items/search")
+async def handle_search_items(
+	session: Annotated[AsyncSession, Depends(get_read_session)],
+	q: Annotated[str, Query(min_length=MIN_QUERY_LENGTH, max_length=MAX_QUERY_LENGTH)],
+	limit: Annotated[int, Query(ge=1, le=100)] = 20
+) -> list[ItemResponse]:
+	async def load() -> bytes:
+		# 部分一致で件数が足りなければ、綴りの誤りを許して検索し直す
+		dialect = session.bind.dialect.name
+		db_items = (await session.exec(search_statement(dialect, q, limit))).all()
+		if len(db_items) < limit:
+			db_items = (await session.exec(search_statement(dialect, q, limit, fuzzy=True))).all()
+		return json.dumps([db_item.model_dump() for db_item in db_items]).encode()
+
+	# 同じ検索が同時に来た場合は一度だけ実行し、アイテムの変更まで結果を使いまわす
+	key = "query:search:" + hashlib.sha256(f"{limit}:{q}".encode()).hexdigest()
+	return json.loads(await cache.get_or_set(key, load, QUERY_CACHE_TTL, tags=("items",)))
+
 @app.delete("/items/{id}", status_code=204)
 async def handle_delete_items(
 	id: Annotated[int, Path(ge=1)],
-	cur_user: Annotated[UserDB, Depends(get_cur_users)],
-	session: Annotated[Session, Depends(get_session)]
+	claims: Annotated[dict, Depends(get_cur_claims)],
+	session: Annotated[AsyncSession, Depends(get_session)]
 ):
-	# アイテムデータの取得
-	db_item = session.get(ItemDB, id)
-	if not db_item:
+	# アイテムデータと所有者名を一度に取得
+	statement = (
+		select(ItemDB, UserDB.username)
+		.join(UserDB)
+		.where(ItemDB.id == id, ItemDB.deleted_at.is_(None), UserDB.deleted_at.is_(None))
+	)
+	row = (await session.exec(statement)).first()
+	if not row:
 		raise HTTPException(
 			status_code=404,
 			detail="Item not found"
 		)
+	db_item, owner = row
 
 	# ユーザー所有のアイテムか確認
-	if not db_item.user_id == cur_user.id:
+	if not (db_item.user_id == claims["uid"] and owner == claims["sub"]):
 		raise HTTPException(
 			status_code=403,
 			detail="Not authorized"
 		)
 
-	# アイテムの削除
-	session.delete(db_item)
-	session.commit()
+	# アイテムの論理削除と集計の更新(物理削除はpurge_workerが行う)
+	# (user_idも条件にし、itemdbを分割した場合は一つのパーティションだけを更新する)
+	await session.exec(
+		update(ItemDB)
+		.where(ItemDB.user_id == db_item.user_id, ItemDB.id == db_item.id)
+		.values(deleted_at=datetime.now(timezone.utc))
+	)
+	await session.exec(remove_items_statement(db_item.user_id, [db_item.price]))
+	await session.exec(add_counts_statement(session.bind.dialect.name, {"itemdb": -1}))
+	await session.commit()
+	await response_cache.bump("items")
 	return Response(status_code=204)
+
+# ユーザーごとのアイテム件数・価格の集計(認証なし、集計テーブルを読むだけ)
+@app.get("/items/stats")
+async def handle_item_stats(
+	response: Response,
+	session: Annotated[AsyncSession, Depends(get_read_session)],
+	user_id: Annotated[int | None, Query(ge=1)] = None,
+	limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+	cursor: str | None = None
+) -> list[ItemStats]:
+	statement = select(ItemStatsDB)
+	if user_id is not None:
+		statement = statement.where(ItemStatsDB.user_id == user_id)
+	statement = apply_keyset(statement, ItemStatsDB, "user_id", cursor, limit, key="user_id")
+	rows, next_cursor = next_page((await session.exec(statement)).all(), "user_id", limit, key="user_id")
+	if next_cursor:
+		response.headers["X-Next-Cursor"] = next_cursor
+	return [to_response(row) for row in rows]
+
+# ハッシュ計算・キャッシュ・接続プールなどの統計
+@app.get("/metrics")
+async def handle_metrics() -> dict:
+	return {
+		"hashing": hash_pool.snapshot(),
+		"cache": cache.snapshot(),
+		"principal_cache": principal_cache.snapshot(),
+		"login_throttle": login_throttle.snapshot(),
+		"db_pool": pool_snapshot(),
+		"db_replicas": replicas.snapshot(),
+		"response_cache": response_cache.snapshot(),
+		"item_group_commit": item_committer.snapshot() if item_committer else None,
+		"purge": purge_worker.snapshot(),
+		"query_budget": {"budget": QUERY_BUDGET, **query_budget_stats}
+	}
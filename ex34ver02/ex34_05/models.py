@@ -1,9 +1,13 @@
+from datetime import datetime
+from typing import Literal
 from pydantic import BaseModel
+from sqlalchemy import BigInteger, Column, DateTime, Index, text
 from sqlmodel import SQLModel, Field, Relationship
 
 class Token(BaseModel):
 	access_token: str
 	token_type: str
+	refresh_token: str | None = None
 
 class Item(BaseModel):
 	name: str
@@ -15,13 +19,60 @@ class ItemResponse(BaseModel):
 	name: str
 	price: int
 
+# 一括登録の行ごとの結果
+class BulkItemResult(BaseModel):
+	line: int
+	status: Literal["created", "duplicate", "invalid"]
+	id: int | None = None
+	name: str | None = None
+	detail: str | None = None
+
+# 論理削除されていない行/論理削除された行だけを含む部分インデックスの条件
+LIVE = text("deleted_at IS NULL")
+DELETED = text("deleted_at IS NOT NULL")
+
+# Postgresではマイグレーション(b58f2e7c0a94)でuser_idのハッシュにより分割する
+# (主キーは(id, user_id)、名前の一意性はトリガーで保証するので、このモデルはそのまま使える)
 class ItemDB(SQLModel, table=True):
+	# GET /itemsの絞り込み・並び替え用(所有者ごとのid順・価格順、全体の価格順)
+	# (user_id, id)は外部キーとパージにも使うので、削除済みの行も含める
+	__table_args__ = (
+		Index("ix_itemdb_user_id_id", "user_id", "id"),
+		Index("ix_itemdb_user_id_price", "user_id", "price", "id", postgresql_where=LIVE, sqlite_where=LIVE),
+		Index("ix_itemdb_price", "price", "id", postgresql_where=LIVE, sqlite_where=LIVE),
+		Index("ix_itemdb_name_live", "name", unique=True, postgresql_where=LIVE, sqlite_where=LIVE),
+		Index("ix_itemdb_deleted_at", "deleted_at", postgresql_where=DELETED, sqlite_where=DELETED)
+	)
 	id: int = Field(default=None, primary_key=True)
-	user_id: int = Field(default=None, foreign_key="userdb.id")
+	user_id: int = Field(default=None, foreign_key="userdb.id", ondelete="CASCADE")
 	name: str
 	price: int
+	deleted_at: datetime | None = Field(default=None, sa_column=Column(DateTime(timezone=True)))
 	owner: "UserDB" = Relationship(back_populates="items")
 
+# ユーザーごとのアイテム集計(アイテムの追加・削除と同じトランザクションで更新)
+class ItemStatsDB(SQLModel, table=True):
+	user_id: int = Field(primary_key=True, foreign_key="userdb.id", ondelete="CASCADE")
+	item_count: int = 0
+	price_total: int = Field(default=0, sa_column=Column(BigInteger, nullable=False))
+	price_min: int | None = None
+	price_max: int | None = None
+
+# 一覧の総件数(論理削除されていない行)
+# 同じ行への書き込みが集中しないよう、shardに分けて加算し、読む時に合計する
+class RowCountDB(SQLModel, table=True):
+	table_name: str = Field(primary_key=True)
+	shard: int = Field(default=0, primary_key=True)
+	row_count: int = Field(default=0, sa_column=Column(BigInteger, nullable=False))
+
+class ItemStats(BaseModel):
+	user_id: int
+	item_count: int
+	price_total: int
+	price_min: int | None
+	price_max: int | None
+	price_avg: float | None
+
 class User(BaseModel):
 	username: str
 	password: str
@@ -36,9 +87,25 @@ class UserResponse(BaseModel):
 	items: list[ItemResponse] = []
 
 class UserDB(SQLModel, table=True):
+	# ユーザー名は削除されていないユーザーの間でのみ一意
+	__table_args__ = (
+		Index("ix_userdb_username_live", "username", unique=True, postgresql_where=LIVE, sqlite_where=LIVE),
+		Index("ix_userdb_deleted_at", "deleted_at", postgresql_where=DELETED, sqlite_where=DELETED)
+	)
 	id: int = Field(default=None, primary_key=True)
 	username: str
 	password: str
 	email: str | None
 	disabled: bool
+	deleted_at: datetime | None = Field(default=None, sa_column=Column(DateTime(timezone=True)))
 	items: list["ItemDB"] = Relationship(back_populates="owner")
+
+# リフレッシュトークン(平文は保存せず、ハッシュのみ保持)
+class RefreshTokenDB(SQLModel, table=True):
+	__table_args__ = (
+		Index("ix_refreshtokendb_expires_at", "expires_at"),	# 期限切れの削除用
+	)
+	id: int = Field(default=None, primary_key=True)
+	user_id: int = Field(foreign_key="userdb.id", ondelete="CASCADE", index=True)
+	token_hash: str = Field(unique=True, index=True)
+	expires_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
@@ -0,0 +1,77 @@
+import base64
+import binascii
+import json
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(data: dict) -> str:
+	raw = json.dumps(data, separators=(",", ":")).encode()
+	return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _is_type(value, value_type: type) -> bool:
+	# JSONのtrue/falseはintとして扱わない
+	return isinstance(value, value_type) and not isinstance(value, bool)
+
+def decode_cursor(cursor: str, value_type: type | None = None) -> dict:
+	# 改ざん・破損したカーソルは400
+	# (idは整数、value_typeを指定した場合はソート列の値"v"がその型であることを確認)
+	try:
+		padded = cursor + "=" * (-len(cursor) % 4)
+		data = json.loads(base64.urlsafe_b64decode(padded))
+		if not isinstance(data, dict) or not _is_type(data.get("id"), int):
+			raise ValueError
+		if value_type is not None and not _is_type(data.get("v"), value_type):
+			raise ValueError
+		return data
+	except (ValueError, binascii.Error):
+		raise HTTPException(
+			status_code=400,
+			detail="Invalid cursor"
+		)
+
+def apply_keyset(statement, model, sort: str, cursor: str | None, limit: int, key: str = "id"):
+	# ソートキー(+同値の場合は主キーのkey)の位置から続きを取得する
+	descending = sort.startswith("-")
+	field = sort.lstrip("-")
+	column = getattr(model, field)
+	primary = getattr(model, key)
+
+	if cursor:
+		data = decode_cursor(cursor, None if field == key else model.model_fields[field].annotation)
+		if data.get("s") != sort:
+			raise HTTPException(
+				status_code=400,
+				detail="Cursor does not match sort order"
+			)
+		if field == key:
+			position, value = primary, data["id"]
+		else:
+			position, value = tuple_(column, primary), tuple_(data["v"], data["id"])
+		statement = statement.where(position < value if descending else position > value)
+
+	order = [primary] if field == key else [column, primary]
+	if descending:
+		order = [col.desc() for col in order]
+
+	# 次のページがあるか判定するため1件多く取得
+	return statement.order_by(*order).limit(limit + 1)
+
+def next_page(rows: list, sort: str, limit: int, key: str = "id") -> tuple[list, str | None]:
+	if len(rows) <= limit:
+		return rows, None
+	rows = rows[:limit]
+	last = rows[-1]
+	field = sort.lstrip("-")
+	cursor = {"s": sort, "id": getattr(last, key)}
+	if field != key:
+		cursor["v"] = getattr(last, field)
+	return rows, encode_cursor(cursor)
+
+def prefix_filter(column, prefix: str) -> list:
+	# 前方一致はLIKEだけで判定する(Postgresではpg_trgmのGINインデックスが使われる)
+	# 大文字・小文字は区別する(SQLiteは接続時にcase_sensitive_likeを有効にしている)
+	# (範囲条件を併用すると、照合順序が"C"以外のDBでは文字列の大小がコードポイント順にならず行を取りこぼす)
+	return [column.startswith(prefix, autoescape=True)]
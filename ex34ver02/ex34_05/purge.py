@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import exists
+from sqlmodel import delete, select, update
+
+from models import ItemDB, RefreshTokenDB, UserDB
+
+logger = logging.getLogger(__name__)
+
+def live_items() -> list:
+	# 削除済みのアイテムと、削除済みのユーザーのアイテム(削除時には更新せず、release_batchで削除日時を付ける)を除く条件
+	# (削除済みのユーザーは少数なので、ix_userdb_deleted_atで引いた集合との比較で済む)
+	deleted_users = select(UserDB.id).where(UserDB.deleted_at.is_not(None))
+	return [ItemDB.deleted_at.is_(None), ItemDB.user_id.not_in(deleted_users)]
+
+async def release_batch(session, batch_size: int) -> int:
+	# 削除済みのユーザーのアイテムにユーザーの削除日時を付け、batch_size件までの名前を再登録できるようにする
+	# (アイテムの名前は論理削除されていない行の間で一意なので、付けるまでは使用中のまま残る)
+	skip_locked = session.bind.dialect.name == "postgresql"
+	live = [ItemDB.user_id == UserDB.id, ItemDB.deleted_at.is_(None)]
+	statement = (
+		select(UserDB.id, UserDB.deleted_at)
+		.where(UserDB.deleted_at.is_not(None))
+		.where(exists().where(*live))
+		.order_by(UserDB.id)
+		.limit(batch_size)
+	)
+	released = 0
+	for user_id, deleted_at in (await session.exec(statement)).all():
+		conditions = [ItemDB.user_id == user_id, ItemDB.deleted_at.is_(None)]
+		ids = select(ItemDB.id).where(*conditions).limit(batch_size - released)
+		if skip_locked:
+			ids = ids.with_for_update(skip_locked=True)
+		result = await session.exec(
+			update(ItemDB).where(*conditions, ItemDB.id.in_(ids.scalar_subquery())).values(deleted_at=deleted_at)
+		)
+		released += result.rowcount
+		if released >= batch_size:
+			break
+	await session.commit()
+	return released
+
+async def purge_batch(session, batch_size: int, before: datetime) -> tuple[int, int]:
+	# 削除済みの行をbatch_size件まで物理削除し、(アイテム数, ユーザー数)を返す
+	# (Postgresでは複数のワーカーが同じ行を取り合わないよう、ロック中の行は飛ばす)
+	skip_locked = session.bind.dialect.name == "postgresql"
+
+	async def delete_items(*conditions) -> int:
+		ids = select(ItemDB.id).where(*conditions).limit(remaining)
+		if skip_locked:
+			ids = ids.with_for_update(skip_locked=True)
+		result = await session.exec(delete(ItemDB).where(*conditions, ItemDB.id.in_(ids.scalar_subquery())))
+		return result.rowcount
+
+	# 個別に削除されたアイテム
+	remaining = batch_size
+	items = await delete_items(ItemDB.deleted_at <= before)
+	remaining -= items
+
+	# 削除されたユーザーのアイテム(ユーザーごとに削除し、itemdbを分割した場合は一つのパーティションだけを触る)
+	if remaining > 0:
+		statement = select(UserDB.id).where(UserDB.deleted_at <= before).order_by(UserDB.id).limit(remaining)
+		for user_id in (await session.exec(statement)).all():
+			deleted = await delete_items(ItemDB.user_id == user_id)
+			items += deleted
+			remaining -= deleted
+			if remaining <= 0:
+				break
+
+	# アイテムが残っていないユーザーを削除(トークンと集計は外部キーのCASCADEで消える)
+	users = 0
+	if remaining > 0:
+		ids = (
+			select(UserDB.id)
+			.where(UserDB.deleted_at <= before)
+			.where(~exists().where(ItemDB.user_id == UserDB.id))
+			.limit(remaining)
+		)
+		if skip_locked:
+			ids = ids.with_for_update(skip_locked=True)
+		result = await session.exec(delete(UserDB).where(UserDB.id.in_(ids.scalar_subquery())))
+		users = result.rowcount
+	await session.commit()
+	return items, users
+
+async def purge_tokens(session, batch_size: int, now: datetime) -> int:
+	# 期限切れのリフレッシュトークンをbatch_size件まで削除し、件数を返す
+	ids = select(RefreshTokenDB.id).where(RefreshTokenDB.expires_at <= now).limit(batch_size)
+	if session.bind.dialect.name == "postgresql":
+		ids = ids.with_for_update(skip_locked=True)
+	result = await session.exec(delete(RefreshTokenDB).where(RefreshTokenDB.id.in_(ids.scalar_subquery())))
+	await session.commit()
+	return result.rowcount
+
+class PurgeWorker:
+	"""論理削除した行と期限切れのリフレッシュトークンを、小さなトランザクションに分けて少しずつ物理削除する"""
+
+	def __init__(self, session_factory, interval: float, batch_size: int, pause: float, grace: float):
+		self.session_factory = session_factory
+		self.interval = interval	# 削除対象が無くなってから次に確認するまでの秒数
+		self.batch_size = max(1, batch_size)
+		self.pause = pause	# バッチ間の待ち時間(プライマリとレプリケーションへの負荷を抑える)
+		self.grace = grace	# 論理削除から物理削除までの最短の秒数
+		self._task: asyncio.Task | None = None
+		self.runs = 0
+		self.batches = 0
+		self.items = 0
+		self.users = 0
+		self.released = 0
+		self.tokens = 0
+		self.failures = 0
+		self.batch_ms_max = 0.0
+		self.last_run: datetime | None = None
+
+	async def run_once(self) -> tuple[int, int]:
+		# 削除対象が無くなるまでバッチを繰り返す
+		self.runs += 1
+
+		# 削除済みのユーザーのアイテムの名前(猶予期間を待たずに解放する)
+		while True:
+			async with self.session_factory() as session:
+				released = await release_batch(session, self.batch_size)
+			self.released += released
+			if released < self.batch_size:
+				break
+			await asyncio.sleep(self.pause)
+
+		total_items = total_users = 0
+		while True:
+			before = datetime.now(timezone.utc) - timedelta(seconds=self.grace)
+			start = time.perf_counter()
+			async with self.session_factory() as session:
+				items, users = await purge_batch(session, self.batch_size, before)
+			self.batch_ms_max = max(self.batch_ms_max, (time.perf_counter() - start) * 1000)
+			self.batches += 1
+			self.items += items
+			self.users += users
+			total_items += items
+			total_users += users
+			if items + users < self.batch_size:
+				break
+			await asyncio.sleep(self.pause)
+
+		# 期限切れのリフレッシュトークン(発行のたびに増えるので、ユーザーの削除とは別に消す)
+		while True:
+			async with self.session_factory() as session:
+				tokens = await purge_tokens(session, self.batch_size, datetime.now(timezone.utc))
+			self.tokens += tokens
+			if tokens < self.batch_size:
+				break
+			await asyncio.sleep(self.pause)
+		self.last_run = datetime.now(timezone.utc)
+		return total_items, total_users
+
+	async def _loop(self):
+		while True:
+			try:
+				await self.run_once()
+			except Exception:
+				self.failures += 1
+				logger.exception("purge failed")
+			await asyncio.sleep(self.interval)
+
+	def start(self):
+		if self._task is None:
+			self._task = asyncio.create_task(self._loop())
+
+	async def close(self):
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+	def snapshot(self) -> dict:
+		return {
+			"running": self._task is not None,
+			"interval": self.interval,
+			"batch_size": self.batch_size,
+			"grace": self.grace,
+			"runs": self.runs,
+			"batches": self.batches,
+			"items": self.items,
+			"users": self.users,
+			"released": self.released,
+			"tokens": self.tokens,
+			"failures": self.failures,
+			"batch_ms_max": self.batch_ms_max,
+			"last_run": self.last_run.isoformat() if self.last_run else None
+		}
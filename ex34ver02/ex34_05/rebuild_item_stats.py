@@ -0,0 +1,56 @@
+"""
+	アイテム集計(itemstatsdb)の再構築
+
+	itemdbを集計し直した結果と集計テーブルを比較してずれを表示し、
+	--checkが無ければ一つのトランザクションで集計テーブルを作り直す
+
+	使い方:
+	 python rebuild_item_stats.py --check	(ずれの確認のみ)
+	 python rebuild_item_stats.py
+"""
+import argparse
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+from sqlmodel import Session, create_engine, select
+
+from models import ItemStatsDB
+from stats import aggregate_statement, rebuild_statements
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare and rebuild per-user item aggregates")
+	parser.add_argument("--check", action="store_true", help="only report drifted users")
+	args = parser.parse_args()
+
+	load_dotenv()
+	url = make_url(os.environ["DATABASE_URL"])
+	engine = create_engine(url.set(drivername=url.get_backend_name()))
+
+	with Session(engine) as session:
+		# 正しい集計と現在の集計を比較
+		expected = {row[0]: tuple(row[1:]) for row in session.exec(aggregate_statement())}
+		current = {
+			row.user_id: (row.item_count, row.price_total, row.price_min, row.price_max)
+			for row in session.exec(select(ItemStatsDB))
+			if row.item_count	# アイテムを全て削除したユーザーの行は件数0で残る
+		}
+		drifted = sorted(
+			user_id for user_id in expected.keys() | current.keys()
+			if expected.get(user_id) != current.get(user_id)
+		)
+		for user_id in drifted:
+			print(f"user {user_id}: expected {expected.get(user_id)}, stored {current.get(user_id)}")
+		print(f"drifted: {len(drifted)} of {len(expected)} users")
+
+		if args.check:
+			return 1 if drifted else 0
+
+		for statement in rebuild_statements():
+			session.exec(statement)
+		session.commit()
+		print("rebuilt")
+	return 0
+
+if __name__ == "__main__":
+	raise SystemExit(main())
@@ -0,0 +1,55 @@
+"""
+	行数(rowcountdb)の再構築
+
+	テーブルを数え直した行数とshardの合計を比較してずれを表示し、
+	--checkが無ければ一つのトランザクションで行数を置き換える
+	(数え直している間の登録・削除は反映されないので、書き込みの少ない時間に実行する)
+
+	使い方:
+	 python rebuild_row_counts.py --check	(ずれの確認のみ)
+	 python rebuild_row_counts.py
+"""
+import argparse
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy.engine import make_url
+from sqlmodel import Session, create_engine, select
+
+from counts import rebuild_counts_statements, recount_statements
+from models import RowCountDB
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare and rebuild the sharded row counts")
+	parser.add_argument("--check", action="store_true", help="only report drifted tables")
+	args = parser.parse_args()
+
+	load_dotenv()
+	url = make_url(os.environ["DATABASE_URL"])
+	engine = create_engine(url.set(drivername=url.get_backend_name()))
+
+	with Session(engine) as session:
+		# 数え直した行数と現在の合計を比較
+		expected = {
+			table_name: session.exec(statement).one()
+			for table_name, statement in recount_statements().items()
+		}
+		statement = select(RowCountDB.table_name, func.sum(RowCountDB.row_count)).group_by(RowCountDB.table_name)
+		current = {table_name: int(count) for table_name, count in session.exec(statement)}
+		drifted = sorted(table_name for table_name in expected if expected[table_name] != current.get(table_name, 0))
+		for table_name in drifted:
+			print(f"{table_name}: expected {expected[table_name]}, stored {current.get(table_name, 0)}")
+		print(f"drifted: {len(drifted)} of {len(expected)} tables")
+
+		if args.check:
+			return 1 if drifted else 0
+
+		for statement in rebuild_counts_statements(expected):
+			session.exec(statement)
+		session.commit()
+		print("rebuilt")
+	return 0
+
+if __name__ == "__main__":
+	raise SystemExit(main())
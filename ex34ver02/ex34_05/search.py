@@ -0,0 +1,83 @@
+from sqlalchemy import DDL, case, column, event, func, literal_column, or_, table
+from sqlmodel import select
+
+from models import ItemDB
+from purge import live_items
+
+# 3文字未満はトライグラムのインデックスが使えない
+MIN_QUERY_LENGTH = 3
+MAX_QUERY_LENGTH = 100
+
+FTS_TABLE = "itemdb_fts"
+TRGM_INDEX = "ix_itemdb_name_trgm"
+
+# SQLite: itemdbを外部コンテンツとするFTS5(trigram)をトリガーで同期する
+SQLITE_DDL = [
+	f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+	"name, content='itemdb', content_rowid='id', tokenize='trigram')",
+	f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON itemdb BEGIN "
+	f"INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END",
+	f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON itemdb BEGIN "
+	f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); END",
+	f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name ON itemdb BEGIN "
+	f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); "
+	f"INSERT INTO {FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END"
+]
+
+# Postgres: pg_trgmのGINインデックス(部分一致と類似度検索の両方に使える)
+POSTGRES_DDL = [
+	"CREATE EXTENSION IF NOT EXISTS pg_trgm",
+	f"CREATE INDEX IF NOT EXISTS {TRGM_INDEX} ON itemdb USING gin (name gin_trgm_ops)"
+]
+
+# create_all(テスト・単体構成)でも検索用のオブジェクトを作る(本番はalembicで作成)
+for statement in SQLITE_DDL:
+	event.listen(ItemDB.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+for statement in POSTGRES_DDL:
+	event.listen(ItemDB.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+event.listen(ItemDB.__table__, "before_drop", DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}").execute_if(dialect="sqlite"))
+
+fts = table(FTS_TABLE, column("rowid"))
+
+def phrase(text: str) -> str:
+	return '"' + text.replace('"', '""') + '"'
+
+def fuzzy_match(query: str) -> str:
+	# 1文字の誤り(欠落・余分・置換)を許す: 誤りの位置の前後がそれぞれ名前に含まれること
+	# (3文字未満の側はトライグラムで絞れないので条件にせず、残りが短すぎる分け方は使わない)
+	terms = [phrase(query)]
+	for n in range(1, len(query)):
+		for left, right in ((query[:n], query[n:]), (query[:n], query[n + 1:])):
+			parts = [part for part in (left, right) if len(part) >= MIN_QUERY_LENGTH]
+			if parts and sum(map(len, parts)) >= max(MIN_QUERY_LENGTH, len(query) - 2):
+				terms.append("(" + " AND ".join(map(phrase, parts)) + ")")
+	return " OR ".join(dict.fromkeys(terms))
+
+def search_statement(dialect: str, query: str, limit: int, fuzzy: bool = False):
+	# 部分一致を先頭に、続けて似ている順(同順位はid順)
+	# fuzzy=Falseは部分一致のみ(件数が足りない場合に呼び出し側でfuzzy=Trueを使う)
+	substring = ItemDB.name.icontains(query, autoescape=True)
+
+	if dialect == "postgresql":
+		# パターンを一つの値で渡し、プランナがトライグラムのインデックスを使えるようにする
+		escaped = query.replace("/", "//").replace("%", "/%").replace("_", "/_")
+		substring = ItemDB.name.ilike(f"%{escaped}%", escape="/")
+		similarity = func.similarity(ItemDB.name, query)
+		condition = or_(substring, ItemDB.name.bool_op("%")(query)) if fuzzy else substring
+		return (
+			select(ItemDB)
+			.where(condition, *live_items())
+			.order_by(case((substring, 0), else_=1), similarity.desc(), ItemDB.id)
+			.limit(limit)
+		)
+
+	# FTS5のトライグラムで候補を絞り、bm25で順位付けする
+	fts_table = literal_column(FTS_TABLE)
+	match = fuzzy_match(query) if fuzzy else phrase(query)
+	return (
+		select(ItemDB)
+		.join(fts, fts.c.rowid == ItemDB.id)
+		.where(fts_table.op("MATCH")(match), *live_items())
+		.order_by(case((substring, 0), else_=1), func.bm25(fts_table), ItemDB.id)
+		.limit(limit)
+	)
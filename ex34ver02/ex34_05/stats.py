@@ -0,0 +1,67 @@
+from sqlalchemy import func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import delete, insert, select
+
+from models import ItemDB, ItemStatsDB
+from purge import live_items
+
+def add_items_statement(dialect: str, user_id: int, prices: list[int]):
+	# 追加したアイテムを集計に加える(行が無ければ作成)
+	statement = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(ItemStatsDB).values(
+		user_id=user_id,
+		item_count=len(prices),
+		price_total=sum(prices),
+		price_min=min(prices),
+		price_max=max(prices)
+	)
+	# 2値のmin/maxはPostgresではLEAST/GREATEST(NULLは無視される)
+	least, greatest = (func.least, func.greatest) if dialect == "postgresql" else (func.min, func.max)
+	current, new = ItemStatsDB.__table__.c, statement.excluded
+	return statement.on_conflict_do_update(
+		index_elements=["user_id"],
+		set_={
+			"item_count": current.item_count + new.item_count,
+			"price_total": current.price_total + new.price_total,
+			"price_min": least(func.coalesce(current.price_min, new.price_min), new.price_min),
+			"price_max": greatest(func.coalesce(current.price_max, new.price_max), new.price_max)
+		}
+	)
+
+def remove_items_statement(user_id: int, prices: list[int]):
+	# 件数と合計は差し引き、最小・最大は(user_id, price)のインデックスで引き直す
+	# (アイテムを論理削除した後に実行する)
+	remaining = (ItemDB.user_id == user_id, ItemDB.deleted_at.is_(None))
+	return (
+		update(ItemStatsDB)
+		.where(ItemStatsDB.user_id == user_id)
+		.values(
+			item_count=ItemStatsDB.item_count - len(prices),
+			price_total=ItemStatsDB.price_total - sum(prices),
+			price_min=select(func.min(ItemDB.price)).where(*remaining).scalar_subquery(),
+			price_max=select(func.max(ItemDB.price)).where(*remaining).scalar_subquery()
+		)
+	)
+
+def aggregate_statement():
+	# 論理削除されていないアイテムのユーザーごとの集計
+	return select(
+		ItemDB.user_id,
+		func.count(),
+		func.sum(ItemDB.price),
+		func.min(ItemDB.price),
+		func.max(ItemDB.price)
+	).where(*live_items()).group_by(ItemDB.user_id)
+
+def rebuild_statements() -> list:
+	# 集計をitemdbから作り直す(ずれた場合の修復用、全件を走査する)
+	return [
+		delete(ItemStatsDB),
+		insert(ItemStatsDB).from_select(
+			["user_id", "item_count", "price_total", "price_min", "price_max"],
+			aggregate_statement()
+		)
+	]
+
+def to_response(row: ItemStatsDB) -> dict:
+	average = row.price_total / row.item_count if row.item_count else None
+	return {**row.model_dump(), "price_avg": average}
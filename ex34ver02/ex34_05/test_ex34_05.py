@@ -1,3 +1,29 @@
+import asyncio
+import json
+import threading
+import pytest
+import jwt
+import main
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sqlmodel import Session, SQLModel, create_engine, select, update
+from sqlalchemy import event, func, text
+from sqlalchemy.exc import OperationalError, TimeoutError
+import database
+from database import ReplicaSet, create_engine_from_url, engine, pool_stats
+from hashing import HASHER, HashPool, HashQueueFull, LOGIN, REGISTER, build_hasher
+from models import Item, ItemDB, ItemStatsDB, RefreshTokenDB, RowCountDB, UserDB
+from pagination import encode_cursor
+from stats import rebuild_statements
+from counts import rebuild_counts_statements, recount_statements
+from throttle import CacheThrottleBackend, LoginThrottle, MemoryThrottleBackend
+from cache import Cache, MemoryCacheBackend, PrincipalCache, RedisCacheBackend, SharedMemoryCacheBackend
+from cache_server import start_server
+from group_commit import GroupCommitter
+import import_users as import_users_module
+from import_users import import_users, load_state, save_state
+import httpx
+
 def test_main(client):
 
 	# ユーザーの登録
@@ -16,7 +42,7 @@ def test_main(client):
 	assert res.status_code == 409
 
 	# ユーザーの参照
-	res = client.get("/users")
+	res = client.get("/users", params={"include": "items"})
 	assert res.json() == [{"id": 1, "username": "kimera", "email": None, "disabled": False, "items": []}]
 
 	# トークンの取得
@@ -63,3 +89,1018 @@ def test_main(client):
 	)
 	res = client.get("/users")
 	assert res.json() == []
+
+def test_hash_pool_priority():
+	async def scenario():
+		pool = HashPool(workers=1, max_queue=2, executor="thread")
+		gate = threading.Event()
+		order = []
+
+		# ワーカーを塞いだ状態で登録→ログインの順に積む
+		blocker = asyncio.create_task(pool.run(LOGIN, gate.wait))
+		await asyncio.sleep(0.05)
+		register = asyncio.create_task(pool.run(REGISTER, order.append, "register"))
+		login = asyncio.create_task(pool.run(LOGIN, order.append, "login"))
+		await asyncio.sleep(0)
+
+		# 待ち行列が満杯なら即座に拒否
+		with pytest.raises(HashQueueFull):
+			await pool.run(LOGIN, order.append, "rejected")
+
+		gate.set()
+		await asyncio.gather(blocker, register, login)
+		pool.shutdown()
+		return order, pool.snapshot()
+
+	order, stats = asyncio.run(scenario())
+	assert order == ["login", "register"]
+	assert stats["rejected"] == 1
+	assert stats["operations"]["append"]["count"] == 2
+
+def test_hash_pool_cancel_released():
+	async def scenario():
+		pool = HashPool(workers=1, max_queue=2, executor="thread")
+		await pool._acquire(LOGIN)
+		waiting = asyncio.create_task(pool.run(LOGIN, str))
+		await asyncio.sleep(0)
+
+		# キャンセルが届く前に、枠の解放が取り消し済みの待ちを取り出した場合
+		waiting.cancel()
+		pool._release()
+		with pytest.raises(asyncio.CancelledError):
+			await waiting
+		return pool.snapshot()
+
+	stats = asyncio.run(scenario())
+	assert stats["running"] == 0
+	assert stats["queued"] == 0
+
+def test_hash_queue_full(client, monkeypatch):
+
+	# 待ち行列が満杯の場合は503とRetry-Afterを返す
+	async def full(*args):
+		raise HashQueueFull(3)
+	monkeypatch.setattr(main.hash_pool, "verify", full)
+
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	assert res.status_code == 503
+	assert res.headers["Retry-After"] == "3"
+
+def test_principal_cache(client, login):
+	headers = login("kimera")
+
+	# 2回目以降の認証はキャッシュから返す
+	before = client.get("/metrics").json()["principal_cache"]
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	res = client.post("/items/register", headers=headers, json={"name": "lemon", "price": 100})
+	assert res.status_code == 200
+	stats = client.get("/metrics").json()["principal_cache"]
+	assert stats["misses"] - before["misses"] == 1
+	assert stats["hits"] - before["hits"] == 1
+
+	# 共有のキャッシュにパスワードのハッシュは残さない
+	token = headers["Authorization"].split()[1]
+	claims, user = client.portal.call(main.principal_cache.get, token)
+	assert user["username"] == "kimera"
+	assert "password" not in user
+
+	# ユーザー削除後はキャッシュが無効化され、認証に失敗する
+	res = client.delete("/users", headers=headers)
+	assert res.status_code == 204
+	res = client.delete("/users", headers=headers)
+	assert res.status_code == 401
+	stats = client.get("/metrics").json()["principal_cache"]
+	assert stats["invalidations"] - before["invalidations"] == 1
+
+def test_token_claims(client):
+	client.post(
+		"/users/register",
+		json={"username": "kimera", "password": "secret"}
+	)
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	token = res.json()["access_token"]
+
+	# 新形式のトークンはユーザーIDとバージョンを含む
+	payload = jwt.decode(token, main.KEY, [main.ALGORITHM])
+	assert payload["uid"] == 1
+	assert payload["ver"] == main.TOKEN_VERSION
+
+	# 旧形式(subのみ)のトークンも移行期間中は使える
+	legacy = main.create_token({"sub": "kimera"})
+	headers = {"Authorization": f"Bearer {legacy}"}
+	res = client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	assert res.status_code == 200
+	res = client.delete("/items/1", headers=headers)
+	assert res.status_code == 204
+
+	# 他人のアイテムは削除できない
+	client.post(
+		"/users/register",
+		json={"username": "other", "password": "secret"}
+	)
+	other = main.create_token({"sub": "other", "uid": 2, "ver": main.TOKEN_VERSION})
+	res = client.post("/items/register", headers=headers, json={"name": "lemon", "price": 100})
+	res = client.delete(f"/items/{res.json()['id']}", headers={"Authorization": f"Bearer {other}"})
+	assert res.status_code == 403
+
+def test_rehash_on_login(client, run_db):
+
+	# 古いパラメータでハッシュ化されたユーザーを用意
+	old_hasher = build_hasher(time_cost=1, memory_cost=8192, parallelism=1)
+	async def add_user(session):
+		session.add(UserDB(
+			username="kimera",
+			password=old_hasher.hash("secret"),
+			email=None,
+			disabled=False
+		))
+		await session.commit()
+	run_db(add_user)
+
+	# ログイン成功時に現在のパラメータで再ハッシュされる
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	assert res.status_code == 200
+
+	async def get_user(session):
+		return (await session.exec(select(UserDB))).one()
+	db_user = run_db(get_user)
+	assert not HASHER.current_hasher.check_needs_rehash(db_user.password)
+	assert HASHER.verify("secret", db_user.password)
+
+def test_login_throttle(client, monkeypatch):
+	client.post(
+		"/users/register",
+		json={"username": "kimera", "password": "secret"}
+	)
+	before = client.get("/metrics").json()["login_throttle"]
+
+	# 失敗が続くとロックされ、ハッシュ計算をせずに429を返す
+	monkeypatch.setattr(main.login_throttle, "lockout_threshold", 2)
+	for _ in range(2):
+		res = client.post(
+			"/token",
+			data={"username": "kimera", "password": "wrong"}
+		)
+		assert res.status_code == 401
+
+	async def fail(*args):
+		raise AssertionError("hash should not run")
+	monkeypatch.setattr(main.hash_pool, "verify_and_update", fail)
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	assert res.status_code == 429
+	assert int(res.headers["Retry-After"]) >= 1
+
+	stats = client.get("/metrics").json()["login_throttle"]
+	assert stats["rejected"] - before["rejected"] == 1
+	assert stats["lockouts"] - before["lockouts"] == 1
+
+def test_token_bucket():
+	throttle = LoginThrottle(MemoryThrottleBackend(), {"user": (1, 2), "ip": (1, 2)})
+	keys = throttle.keys("kimera", "127.0.0.1")
+
+	# バケット容量まで許可し、その後は補充を待つ
+	async def attempts():
+		return [await throttle.check(keys) for _ in range(3)]
+	assert asyncio.run(attempts()) == [None, None, 1]
+
+def test_token_bucket_shared():
+	# 共有の保存先では、同時の試行もロックで一つずつ消費される
+	throttle = LoginThrottle(CacheThrottleBackend(MemoryCacheBackend(100)), {"user": (0.001, 3)})
+	keys = throttle.keys("kimera", None)
+
+	async def attempts():
+		return await asyncio.gather(*(throttle.check(keys) for _ in range(5)))
+	results = asyncio.run(attempts())
+	assert results.count(None) == 3
+	assert throttle.snapshot()["allowed"] == 3
+
+def write_users(path, usernames):
+	path.write_text("username,password\n" + "".join(f"{username},secret\n" for username in usernames))
+
+@pytest.fixture
+def import_engine(tmp_path):
+	# インポートは同期ドライバで行うので、一時ファイルのSQLiteに作成
+	engine = create_engine(f"sqlite:///{tmp_path}/import.db")
+	SQLModel.metadata.create_all(engine)
+	yield engine
+	engine.dispose()
+
+def imported_usernames(engine):
+	with Session(engine) as session:
+		return sorted(session.exec(select(UserDB.username)).all())
+
+def test_import_users_batches(import_engine, tmp_path):
+	path = tmp_path / "users.csv"
+	write_users(path, ["a1", "a2", "a3", "a4", "a5"])
+
+	# バッチごとにexecutemanyで登録し、完了したバッチ数を記録
+	with ThreadPoolExecutor(1) as executor:
+		stats = import_users(import_engine, executor, str(path), "csv", batch_size=2, workers=1)
+	assert stats.imported == 5
+	assert load_state(f"{path}.import-state") == 3
+	assert imported_usernames(import_engine) == ["a1", "a2", "a3", "a4", "a5"]
+	with Session(import_engine) as session:
+		assert session.exec(select(func.sum(RowCountDB.row_count))).one() == 5
+	with Session(import_engine) as session:
+		assert HASHER.verify("secret", session.exec(select(UserDB.password)).first())
+
+def test_import_users_resume(import_engine, tmp_path):
+	path = tmp_path / "users.csv"
+	write_users(path, ["a1", "a2", "a3", "a4", "a5"])
+
+	# 前回の実行で2バッチまで完了していれば、残りのバッチだけを登録
+	save_state(f"{path}.import-state", 2)
+	with ThreadPoolExecutor(1) as executor:
+		stats = import_users(import_engine, executor, str(path), "csv", batch_size=2, workers=1, resume=True)
+	assert stats.imported == 1
+	assert imported_usernames(import_engine) == ["a5"]
+	assert load_state(f"{path}.import-state") == 3
+
+def test_import_users_conflicts(import_engine, tmp_path):
+	with Session(import_engine) as session:
+		session.add(UserDB(username="a1", password="x", disabled=False))
+		session.commit()
+	path = tmp_path / "users.csv"
+	write_users(path, ["a1", "a2", "a2", "a3"])
+
+	# バッチ内の重複と登録済みのユーザー名は、一意制約違反で止まらずに飛ばして報告
+	with ThreadPoolExecutor(1) as executor:
+		stats = import_users(import_engine, executor, str(path), "csv", batch_size=10, workers=1)
+	assert (stats.imported, stats.duplicate, stats.existing) == (2, 1, 1)
+	assert imported_usernames(import_engine) == ["a1", "a2", "a3"]
+
+	# 登録した分だけ行数に加算され(a1はテストで直接追加)、数え直すと全件になる
+	with Session(import_engine) as session:
+		assert session.exec(select(func.sum(RowCountDB.row_count))).one() == 2
+		counts = {name: session.exec(statement).one() for name, statement in recount_statements().items()}
+		assert counts == {"userdb": 3, "itemdb": 0}
+		for statement in rebuild_counts_statements(counts):
+			session.exec(statement)
+		session.commit()
+		assert session.exec(select(func.sum(RowCountDB.row_count))).one() == 3
+
+	# --skip-existingでは登録前に除く
+	write_users(path, ["a3", "a4"])
+	with ThreadPoolExecutor(1) as executor:
+		stats = import_users(import_engine, executor, str(path), "csv", batch_size=10, workers=1, skip_existing=True)
+	assert (stats.imported, stats.existing) == (1, 1)
+
+def test_import_users_copy_conflicts(import_engine, monkeypatch):
+	with Session(import_engine) as session:
+		session.add(UserDB(username="a1", password="x", disabled=False))
+		session.commit()
+
+	# COPYと同じく生のカーソルで流し込み、一意制約違反をDBAPIの例外のまま送出する
+	def copy_rows(session, rows):
+		cursor = session.connection().connection.cursor()
+		cursor.executemany(
+			"INSERT INTO userdb (username, password, email, disabled) VALUES (?, ?, ?, ?)",
+			[(row["username"], row["password"], row["email"], row["disabled"]) for row in rows]
+		)
+	monkeypatch.setattr(import_users_module, "copy_rows", copy_rows)
+
+	rows = [
+		(line, {"username": username, "password": "x", "email": None, "disabled": False})
+		for line, username in enumerate(["a1", "a2"], start=2)
+	]
+	with Session(import_engine) as session:
+		assert import_users_module.load_batch(session, rows, use_copy=True) == [2]
+	assert imported_usernames(import_engine) == ["a1", "a2"]
+
+def test_refresh_token(client):
+	client.post(
+		"/users/register",
+		json={"username": "kimera", "password": "secret"}
+	)
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	refresh_token = res.json()["refresh_token"]
+
+	# リフレッシュトークンで新しいトークンを取得
+	res = client.post(
+		"/token",
+		data={"grant_type": "refresh_token", "refresh_token": refresh_token}
+	)
+	assert res.status_code == 200, res.json()
+	rotated = res.json()["refresh_token"]
+	assert rotated != refresh_token
+	headers = {"Authorization": f"Bearer {res.json()['access_token']}"}
+	res = client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	assert res.status_code == 200
+
+	# 使用済みのリフレッシュトークンは使えない
+	res = client.post(
+		"/token",
+		data={"grant_type": "refresh_token", "refresh_token": refresh_token}
+	)
+	assert res.status_code == 401
+
+	# ユーザー削除で失効する
+	client.delete("/users", headers=headers)
+	res = client.post(
+		"/token",
+		data={"grant_type": "refresh_token", "refresh_token": rotated}
+	)
+	assert res.status_code == 401
+
+def test_pool_stats(tmp_path):
+	async def scenario():
+		engine = create_engine_from_url(
+			f"sqlite:///{tmp_path}/pool.db",
+			name="test",
+			pool_options={"pool_size": 1, "max_overflow": 0, "pool_timeout": 0.1}
+		)
+
+		# 接続を使用中にすると、次のチェックアウトはタイムアウトする
+		async with engine.connect() as conn:
+			await conn.execute(text("select 1"))
+			stats = pool_stats["test"].snapshot(engine.pool)
+			assert stats["size"] == 1
+			assert stats["checked_out"] == 1
+			with pytest.raises(TimeoutError):
+				async with engine.connect():
+					pass
+		await engine.dispose()
+
+		# 接続できない場合はエラーとして数える
+		broken = create_engine_from_url(f"sqlite:///{tmp_path}/missing/pool.db", name="broken")
+		threads = set(threading.enumerate())
+		with pytest.raises(OperationalError):
+			async with broken.connect():
+				pass
+		await broken.dispose()
+
+		# 接続に失敗したaiosqliteのスレッドは停止の結果をこのループに返してから終わるので、ループを閉じる前に待つ
+		for thread in set(threading.enumerate()) - threads:
+			await asyncio.to_thread(thread.join, 1.0)
+
+	asyncio.run(scenario())
+	stats = pool_stats["test"].snapshot(None)
+	assert stats["checkouts"] == 2
+	assert stats["timeouts"] == 1
+	assert sum(stats["wait_ms_histogram"].values()) == 2
+	assert pool_stats["broken"].errors == 1
+
+def test_metrics_pool(client):
+	res = client.get("/metrics")
+	assert res.json()["db_pool"]["primary"]["pool"] == "StaticPool"
+
+def test_unique_constraints(client, login):
+	headers = login("kimera")
+
+	# 重複したアイテム名は制約違反として409になる
+	res = client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	assert res.status_code == 200
+	res = client.post("/items/register", headers=headers, json={"name": "apple", "price": 100})
+	assert res.status_code == 409
+
+	# 失敗後も同じセッションの利用に支障がない
+	res = client.post("/items/register", headers=headers, json={"name": "lemon", "price": 100})
+	assert res.status_code == 200
+	assert res.json()["name"] == "lemon"
+
+def test_pagination(client):
+	for name in ["carol", "alice", "bob"]:
+		client.post(
+			"/users/register",
+			json={"username": name, "password": "secret"}
+		)
+
+	# 次のページのカーソルをヘッダーでたどる
+	res = client.get("/users", params={"limit": 2})
+	assert [user["username"] for user in res.json()] == ["carol", "alice"]
+	res = client.get("/users", params={"limit": 2, "cursor": res.headers["X-Next-Cursor"]})
+	assert [user["username"] for user in res.json()] == ["bob"]
+	assert "X-Next-Cursor" not in res.headers
+
+	# ソートキーを指定した場合
+	res = client.get("/users", params={"limit": 2, "sort": "-username"})
+	assert [user["username"] for user in res.json()] == ["carol", "bob"]
+	cursor = res.headers["X-Next-Cursor"]
+	res = client.get("/users", params={"limit": 2, "sort": "-username", "cursor": cursor})
+	assert [user["username"] for user in res.json()] == ["alice"]
+
+	# ソート順が異なるカーソルや壊れたカーソルは400
+	assert client.get("/users", params={"cursor": cursor}).status_code == 400
+	assert client.get("/users", params={"cursor": "broken"}).status_code == 400
+
+	# 値の型がソート列と異なるカーソルも400
+	for data in ({"s": "-username", "id": 1, "v": {"a": 1}}, {"s": "-username", "id": "1", "v": "bob"}, {"s": "-username", "id": 1}):
+		res = client.get("/users", params={"sort": "-username", "cursor": encode_cursor(data)})
+		assert res.status_code == 400
+
+	# 上限を超える件数は指定できない
+	assert client.get("/items", params={"limit": 100000}).status_code == 422
+
+def test_users_query_count(client, login):
+	def register(names):
+		for name in names:
+			headers = login(name)
+			for n in range(2):
+				client.post("/items/register", headers=headers, json={"name": f"{name}-{n}", "price": n})
+
+	def count(params):
+		statements = []
+		def listener(conn, cursor, statement, *args):
+			statements.append(statement)
+		event.listen(engine.sync_engine, "before_cursor_execute", listener)
+		try:
+			res = client.get("/users", params=params)
+		finally:
+			event.remove(engine.sync_engine, "before_cursor_execute", listener)
+		return res.json(), statements
+
+	# ユーザー数が増えてもSQLの発行数は変わらない
+	register(["alice", "bob"])
+	users, few = count({"include": "items"})
+	assert [len(user["items"]) for user in users] == [2, 2]
+	register(["carol", "dave", "erin"])
+	users, many = count({"include": "items"})
+	assert [len(user["items"]) for user in users] == [2, 2, 2, 2, 2]
+	assert len(few) == len(many) == 2
+
+	# 既定ではitemdbを参照しない
+	users, statements = count({})
+	assert "items" not in users[0]
+	assert len(statements) == 1
+	assert not any("itemdb" in statement for statement in statements)
+
+	# ミドルウェアでルートごとの最大発行数を記録
+	stats = client.get("/metrics").json()["query_budget"]
+	assert stats["max_queries"]["GET /users"] == 2
+
+def test_delete_users_bulk(client, login, run_db, monkeypatch):
+	headers = login("kimera")
+	for n in range(5):
+		client.post("/items/register", headers=headers, json={"name": f"item-{n}", "price": n})
+
+	# アイテムには触れず、ユーザーの論理削除とトークン・集計の削除、総件数の更新だけで返す
+	statements = []
+	def listener(conn, cursor, statement, *args):
+		statements.append(statement)
+	event.listen(engine.sync_engine, "before_cursor_execute", listener)
+	try:
+		res = client.delete("/users", headers=headers)
+	finally:
+		event.remove(engine.sync_engine, "before_cursor_execute", listener)
+	assert res.status_code == 204
+	assert [statement.split()[0] for statement in statements] == ["UPDATE", "DELETE", "DELETE", "INSERT"]
+	assert client.get("/items").json() == []
+	assert client.get("/users").json() == []
+	assert client.get("/items/stats").json() == []
+	assert client.delete("/users", headers=headers).status_code == 401
+
+	# 削除済みのユーザー名はすぐに再登録できる
+	res = client.post(
+		"/users/register",
+		json={"username": "kimera", "password": "secret"}
+	)
+	assert res.status_code == 200
+	res = client.post(
+		"/token",
+		data={"username": "kimera", "password": "secret"}
+	)
+	headers = {"Authorization": f"Bearer {res.json()['access_token']}"}
+	item_id = client.post("/items/register", headers=headers, json={"name": "kept", "price": 1}).json()["id"]
+	deleted_id = client.post("/items/register", headers=headers, json={"name": "gone", "price": 2}).json()["id"]
+	assert client.delete(f"/items/{deleted_id}", headers=headers).status_code == 204
+	assert client.delete(f"/items/{deleted_id}", headers=headers).status_code == 404
+	assert [item["id"] for item in client.get("/items").json()] == [item_id]
+
+	# 物理削除は一定件数ずつ(削除済みのアイテム6件とユーザー1件が消え、残りはそのまま)
+	monkeypatch.setattr(main.purge_worker, "batch_size", 2)
+	monkeypatch.setattr(main.purge_worker, "pause", 0)
+	assert client.portal.call(main.purge_worker.run_once) == (6, 1)
+	assert main.purge_worker.batches == 4
+
+	async def count(session):
+		users = (await session.exec(select(func.count()).select_from(UserDB))).one()
+		items = (await session.exec(select(func.count()).select_from(ItemDB))).one()
+		return users, items
+	assert run_db(count) == (1, 1)
+	assert client.get("/items/stats").json()[0]["item_count"] == 1
+
+	# SQLiteでも外部キー制約が有効(物理削除したユーザーの行はCASCADEで消える)
+	async def foreign_keys(session):
+		return (await session.exec(text("PRAGMA foreign_keys"))).scalar()
+	assert run_db(foreign_keys) == 1
+
+def test_delete_users_twice(client, login, monkeypatch):
+	headers = login("kimera")
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+
+	# 認証キャッシュが残ったまま同じトークンで削除が重なっても、件数は一度だけ減らす
+	async def keep(user_id):
+		pass
+	monkeypatch.setattr(main.principal_cache, "invalidate_user", keep)
+	assert client.delete("/users", headers=headers).status_code == 204
+	assert client.delete("/users", headers=headers).status_code == 404
+	assert client.head("/users").headers["X-Total-Count"] == "0"
+	assert client.head("/items").headers["X-Total-Count"] == "0"
+
+	# 削除済みのユーザーのアイテムは登録せず、件数も増やさない
+	res = client.post("/items/register", headers=headers, json={"name": "lemon", "price": 100})
+	assert res.status_code == 404
+	res = client.post("/items/bulk", headers=headers, content=b'{"name": "melon", "price": 800}\n')
+	assert res.status_code == 404
+
+	# group commitでは削除済みのユーザーの要求だけが404になる
+	other = client.post("/users/register", json={"username": "other", "password": "secret"}).json()["id"]
+	results = client.portal.call(main.insert_item_group, [(1, Item(name="peach", price=1)), (other, Item(name="grape", price=2))])
+	assert results[0].status_code == 404
+	assert results[1]["name"] == "grape"
+	assert client.head("/items").headers["X-Total-Count"] == "1"
+
+def test_release_item_names(client, login, monkeypatch):
+	headers = login("kimera")
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	client.delete("/users", headers=headers)
+
+	# 削除済みのユーザーのアイテム名は、purge_workerが解放するまで使用中
+	other = login("other")
+	assert client.post("/items/register", headers=other, json={"name": "apple", "price": 100}).status_code == 409
+
+	# 猶予期間中で物理削除されなくても、名前は解放される
+	monkeypatch.setattr(main.purge_worker, "grace", 3600)
+	before = main.purge_worker.released
+	assert client.portal.call(main.purge_worker.run_once) == (0, 0)
+	assert main.purge_worker.released - before == 1
+	assert client.post("/items/register", headers=other, json={"name": "apple", "price": 100}).status_code == 200
+	assert [item["name"] for item in client.get("/items").json()] == ["apple"]
+
+def test_purge_expired_tokens(client, login, run_db):
+	login("kimera")
+
+	# 発行済みのトークンを期限切れにしてから、もう一度ログイン
+	async def expire(session):
+		await session.exec(update(RefreshTokenDB).values(expires_at=datetime.now(timezone.utc) - timedelta(seconds=1)))
+		await session.commit()
+	run_db(expire)
+	client.post("/token", data={"username": "kimera", "password": "secret"})
+
+	# 期限切れのトークンだけを削除する
+	assert client.portal.call(main.purge_worker.run_once) == (0, 0)
+	async def tokens(session):
+		return (await session.exec(select(RefreshTokenDB.id))).all()
+	assert len(run_db(tokens)) == 1
+	assert main.purge_worker.snapshot()["tokens"] >= 1
+
+def test_bulk_items(client, login, monkeypatch):
+	headers = login("kimera")
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+
+	# 2件ずつのトランザクションで登録
+	monkeypatch.setattr(main, "BULK_BATCH_SIZE", 2)
+	lines = [
+		'{"name": "lemon", "price": 100}',
+		'{"name": "apple", "price": 200}',		# 登録済み
+		'{"name": "melon", "price": -1}',		# 不正な価格
+		'not json',
+		'',
+		'{"name": "grape", "price": 500}',
+		'{"name": "grape", "price": 600}',		# 同じリクエスト内で重複
+		'{"name": "peach", "price": 700}'
+	]
+	def body():
+		# 行の途中で区切って送る
+		data = "\n".join(lines).encode()
+		for n in range(0, len(data), 7):
+			yield data[n:n + 7]
+
+	res = client.post("/items/bulk", headers=headers, content=body())
+	assert res.status_code == 200
+	assert [(result["line"], result["status"]) for result in res.json()] == [
+		(1, "created"),
+		(2, "duplicate"),
+		(3, "invalid"),
+		(4, "invalid"),
+		(6, "created"),
+		(7, "duplicate"),
+		(8, "created")
+	]
+	res = client.get("/items")
+	assert [item["name"] for item in res.json()] == ["apple", "lemon", "grape", "peach"]
+
+	# 長すぎる行は、チャンクの中で終わる場合も途中で終わらない場合も、その行だけが不正になる
+	monkeypatch.setattr(main, "BULK_MAX_LINE_BYTES", 40)
+	long_line = '{"name": "' + "x" * 50 + '", "price": 1}'
+	res = client.post("/items/bulk", headers=headers, content=[
+		('{"name": "kiwi", "price": 1}\n' + long_line + '\n{"name": "plum", "price": 2}\n').encode(),
+		long_line[:30].encode(), long_line[30:].encode(), b'\n{"name": "fig", "price": 3}'
+	])
+	assert res.status_code == 200
+	assert [(result["line"], result["status"]) for result in res.json()] == [
+		(1, "created"),
+		(2, "invalid"),
+		(3, "created"),
+		(4, "invalid"),
+		(5, "created")
+	]
+	assert "id" not in res.json()[1]
+
+def test_export_items(client, login, monkeypatch):
+	headers = login("kimera")
+	lines = "\n".join(f'{{"name": "item-{n}", "price": {n}}}' for n in range(5))
+	client.post("/items/bulk", headers=headers, content=lines)
+
+	# 2件ずつ読み込みながら書き出す
+	monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+	res = client.get("/items/export")
+	assert res.status_code == 200
+	assert res.headers["content-type"] == "application/x-ndjson"
+	rows = [json.loads(line) for line in res.text.splitlines()]
+	assert [row["name"] for row in rows] == [f"item-{n}" for n in range(5)]
+	assert set(rows[0]) == {"id", "user_id", "name", "price"}
+
+	res = client.get("/items/export", params={"format": "json"})
+	assert res.json() == rows
+
+	# 空のテーブル
+	client.delete("/users", headers=headers)
+	assert client.get("/items/export", params={"format": "json"}).json() == []
+	assert client.get("/items/export").text == ""
+
+def test_read_replicas(client, monkeypatch, tmp_path):
+	# レプリカには別のデータを入れておき、どちらから読んだか判定する
+	up = create_engine_from_url(f"sqlite:///{tmp_path}/replica.db", name="replica-up")
+	down = create_engine_from_url(f"sqlite:///{tmp_path}/missing/replica.db", name="replica-down")
+	async def seed():
+		async with up.begin() as conn:
+			await conn.run_sync(SQLModel.metadata.create_all)
+			await conn.execute(text("insert into userdb (username, password, disabled) values ('r', '-', 0)"))
+			await conn.execute(text("insert into itemdb (user_id, name, price) values (1, 'replica', 1)"))
+	client.portal.call(seed)
+
+	replicas = ReplicaSet({"replica-down": down, "replica-up": up}, retry_after=60)
+	monkeypatch.setattr(database, "replicas", replicas)
+	monkeypatch.setattr(main, "replicas", replicas)
+	monkeypatch.setattr(main.response_cache, "ttl", 0)	# 読み先を確認するためキャッシュしない
+
+	# 接続できないレプリカは外して、もう一方から読む
+	res = client.get("/items")
+	assert [item["name"] for item in res.json()] == ["replica"]
+	assert "db_primary_until" not in res.cookies
+	res = client.get("/items/export")
+	assert res.text.count("replica") == 1
+	stats = replicas.snapshot()["replicas"]
+	assert stats["replica-down"] == {"reads": 0, "failures": 1, "down": True}
+	assert stats["replica-up"]["reads"] == 2
+
+	# 書き込んだクライアントはしばらくプライマリから読む
+	res = client.post(
+		"/users/register",
+		json={"username": "kimera", "password": "secret"}
+	)
+	assert "db_primary_until" in res.cookies
+	res = client.get("/users")
+	assert [user["username"] for user in res.json()] == ["kimera"]
+	client.cookies.clear()
+	res = client.get("/users")
+	assert [user["username"] for user in res.json()] == ["r"]
+
+	# 全てのレプリカが使えない場合はプライマリから読む
+	replicas = ReplicaSet({"replica-down": down}, retry_after=60)
+	monkeypatch.setattr(database, "replicas", replicas)
+	res = client.get("/users")
+	assert [user["username"] for user in res.json()] == ["kimera"]
+	assert replicas.snapshot()["fallbacks"] == 1
+	assert "replica-down" in client.get("/metrics").json()["db_pool"]
+
+	client.portal.call(up.dispose)
+	client.portal.call(down.dispose)
+
+def test_item_filters(client, login, run_db):
+	owners = {}
+	for name, items in [("kimera", [("apple", 300), ("apricot", 100), ("a%b", 200)]), ("taro", [("banana", 200), ("avocado", 500)])]:
+		headers = login(name)
+		for item, price in items:
+			res = client.post("/items/register", headers=headers, json={"name": item, "price": price})
+			owners[name] = res.json()["user_id"]
+
+	def names(params):
+		res = client.get("/items", params=params)
+		assert res.status_code == 200
+		return [item["name"] for item in res.json()]
+
+	assert names({"user_id": owners["kimera"]}) == ["apple", "apricot", "a%b"]
+	assert names({"min_price": 200, "max_price": 300, "sort": "price"}) == ["a%b", "banana", "apple"]
+	assert names({"user_id": owners["kimera"], "sort": "-price"}) == ["apple", "a%b", "apricot"]
+	assert names({"name_prefix": "ap"}) == ["apple", "apricot"]
+	assert names({"name_prefix": "a%"}) == ["a%b"]		# ワイルドカードはエスケープ
+	assert names({"name_prefix": "AP"}) == []			# 大文字・小文字は区別(Postgresと同じ)
+	assert names({"name_prefix": "ap", "max_price": 150}) == ["apricot"]
+
+	# 価格順のページング(同じ価格はidの順)
+	res = client.get("/items", params={"sort": "price", "limit": 2})
+	assert [item["name"] for item in res.json()] == ["apricot", "a%b"]
+	res = client.get("/items", params={"sort": "price", "limit": 2, "cursor": res.headers["X-Next-Cursor"]})
+	assert [item["name"] for item in res.json()] == ["banana", "apple"]
+
+	assert client.get("/items", params={"min_price": -1}).status_code == 422
+
+	# 価格の範囲指定は複合インデックス(削除済みを除く部分インデックス)を使う
+	async def plan(session):
+		statement = main.apply_keyset(
+			select(ItemDB).where(ItemDB.price >= 100, *main.live_items()), ItemDB, "price", None, 10
+		).compile(engine.sync_engine, compile_kwargs={"literal_binds": True})
+		rows = await session.exec(text(f"EXPLAIN QUERY PLAN {statement}"))
+		return " ".join(row[-1] for row in rows)
+	assert "ix_itemdb_price" in run_db(plan)
+
+def test_total_counts(client, login):
+	headers = {}
+	for username in ("kimera", "other"):
+		headers[username] = login(username)
+	ids = [
+		client.post("/items/register", headers=headers["kimera"], json={"name": f"item-{n}", "price": n}).json()["id"]
+		for n in range(3)
+	]
+	client.post("/items/register", headers=headers["other"], json={"name": "other-0", "price": 10})
+	client.post("/items/register", headers=headers["other"], json={"name": "item-0", "price": 10})	# 重複は数えない
+	client.post(
+		"/items/bulk",
+		headers={**headers["other"], "Content-Type": "application/x-ndjson"},
+		content=b'{"name": "other-1", "price": 11}\n{"name": "item-1", "price": 11}\n'
+	)
+	owner = client.get("/items", params={"limit": 1}).json()[0]["user_id"]
+
+	def total(path, params=None):
+		res = client.get(path, params=params)
+		return res.headers.get("X-Total-Count") if res.status_code == 200 else res.status_code
+
+	# 指定した場合のみ、ページとは別に総件数を返す
+	assert total("/items") is None
+	assert total("/users", {"count": "exact"}) == "2"
+	assert total("/items", {"count": "exact", "limit": 1}) == "5"
+	assert total("/items", {"count": "exact", "user_id": owner}) == "3"
+
+	# 管理していない絞り込みの正確な件数は数えない(SQLiteでは推定もできない)
+	assert total("/items", {"count": "exact", "min_price": 1}) == 400
+	assert total("/items", {"count": "estimated", "min_price": 1}) == 400
+	assert total("/items", {"count": "estimated"}) == "5"	# 推定できなければ正確な件数
+	assert total("/items", {"count": "approx"}) == 422
+
+	# HEADはページを読み込まず、ヘッダーのみ
+	res = client.head("/items", params={"user_id": owner})
+	assert res.status_code == 200
+	assert res.headers["X-Total-Count"] == "3"
+	assert res.content == b""
+	assert client.head("/users").headers["X-Total-Count"] == "2"
+
+	# 削除で減る(ユーザーの削除ではそのユーザーのアイテムもまとめて減る)
+	client.delete(f"/items/{ids[0]}", headers=headers["kimera"])
+	assert total("/items", {"count": "exact"}) == "4"
+	client.delete("/users", headers=headers["kimera"])
+	assert total("/items", {"count": "exact"}) == "2"
+	assert total("/users", {"count": "exact"}) == "1"
+	assert len(client.get("/items").json()) == 2
+
+def test_search_items(client, login):
+	headers = login("kimera")
+	for name in ["green apple", "pineapple", "apricot", "banana", "100%_juice"]:
+		client.post("/items/register", headers=headers, json={"name": name, "price": 100})
+
+	def search(q, **params):
+		res = client.get("/items/search", params={"q": q, **params})
+		assert res.status_code == 200
+		return [item["name"] for item in res.json()]
+
+	# 部分一致が先頭(大文字小文字は区別しない)
+	assert set(search("APPLE")[:2]) == {"green apple", "pineapple"}
+	assert len(search("apple", limit=1)) == 1
+
+	# 綴りの誤りは似ている名前を返す
+	assert search("aple")[0] in ("green apple", "pineapple")
+	assert "banana" not in search("aple")
+	assert search("%_j")[0] == "100%_juice"
+
+	# 削除が検索結果に反映される
+	client.delete("/items/3", headers=headers)
+	assert "apricot" not in search("apr")
+	assert client.get("/items/search", params={"q": "ap"}).status_code == 422
+
+def test_item_stats(client, login, run_db):
+	headers = {}
+	for name in ["kimera", "taro"]:
+		headers[name] = login(name)
+
+	# 追加(単体・一括)で集計が更新される
+	ids = [
+		client.post("/items/register", headers=headers["kimera"], json={"name": name, "price": price}).json()["id"]
+		for name, price in [("apple", 300), ("lemon", 100)]
+	]
+	client.post("/items/register", headers=headers["kimera"], json={"name": "apple", "price": 999})	# 重複は数えない
+	client.post("/items/bulk", headers=headers["kimera"], content='{"name": "melon", "price": 800}\n{"name": "lemon", "price": 1}')
+	client.post("/items/register", headers=headers["taro"], json={"name": "grape", "price": 50})
+
+	res = client.get("/items/stats")
+	assert res.json() == [
+		{"user_id": 1, "item_count": 3, "price_total": 1200, "price_min": 100, "price_max": 800, "price_avg": 400.0},
+		{"user_id": 2, "item_count": 1, "price_total": 50, "price_min": 50, "price_max": 50, "price_avg": 50.0}
+	]
+
+	# 最小値のアイテムを削除すると引き直される
+	client.delete(f"/items/{ids[1]}", headers=headers["kimera"])
+	res = client.get("/items/stats", params={"user_id": 1})
+	assert res.json() == [
+		{"user_id": 1, "item_count": 2, "price_total": 1100, "price_min": 300, "price_max": 800, "price_avg": 550.0}
+	]
+
+	# ページング
+	res = client.get("/items/stats", params={"limit": 1})
+	assert [row["user_id"] for row in res.json()] == [1]
+	res = client.get("/items/stats", params={"limit": 1, "cursor": res.headers["X-Next-Cursor"]})
+	assert [row["user_id"] for row in res.json()] == [2]
+
+	# ユーザーの削除で集計も消える
+	client.delete("/users", headers=headers["taro"])
+	assert [row["user_id"] for row in client.get("/items/stats").json()] == [1]
+
+	# 集計テーブルから再構築した結果と一致する
+	async def rebuild(session):
+		before = (await session.exec(select(ItemStatsDB))).all()
+		for statement in rebuild_statements():
+			await session.exec(statement)
+		await session.commit()
+		return before, (await session.exec(select(ItemStatsDB))).all()
+	before, after = run_db(rebuild)
+	assert [row.model_dump() for row in before] == [row.model_dump() for row in after]
+
+def test_response_cache(client, login):
+	headers = login("kimera")
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})
+	before = client.get("/metrics").json()["response_cache"]
+
+	# 2回目はキャッシュから返し、SQLを発行しない
+	res = client.get("/items", params={"limit": 10, "sort": "id"})
+	etag = res.headers["ETag"]
+	assert res.headers["Cache-Control"] == "public, max-age=0, must-revalidate"
+	statements = []
+	def listener(conn, cursor, statement, *args):
+		statements.append(statement)
+	event.listen(engine.sync_engine, "before_cursor_execute", listener)
+	res = client.get("/items", params={"sort": "id", "limit": 10})	# クエリの順序は問わない
+	event.remove(engine.sync_engine, "before_cursor_execute", listener)
+	assert statements == []
+	assert res.headers["ETag"] == etag
+	assert res.json()[0]["name"] == "apple"
+
+	# ETagが一致すれば304
+	res = client.get("/items", params={"limit": 10, "sort": "id"}, headers={"If-None-Match": etag})
+	assert res.status_code == 304
+	assert res.content == b""
+
+	# 書き込みでバージョンが進み、新しい結果になる
+	client.post("/items/register", headers=headers, json={"name": "lemon", "price": 100})
+	res = client.get("/items", params={"limit": 10, "sort": "id"}, headers={"If-None-Match": etag})
+	assert res.status_code == 200
+	assert [item["name"] for item in res.json()] == ["apple", "lemon"]
+	assert res.headers["ETag"] != etag
+
+	# アイテムの変更はユーザー一覧(アイテムを含む)も無効化する
+	res = client.get("/users", params={"include": "items"})
+	client.delete("/items/1", headers=headers)
+	res = client.get("/users", params={"include": "items"})
+	assert [item["name"] for item in res.json()[0]["items"]] == ["lemon"]
+
+	# エラーはキャッシュしない
+	assert client.get("/items", params={"cursor": "broken"}).status_code == 400
+	cursor = encode_cursor({"s": "price", "id": 1, "v": "100"})
+	assert client.get("/items", params={"sort": "price", "cursor": cursor}).status_code == 400
+
+	stats = client.get("/metrics").json()["response_cache"]
+	assert stats["hits"] - before["hits"] == 2
+	assert stats["not_modified"] - before["not_modified"] == 1
+
+@pytest.mark.parametrize("kind", ["memory", "shm", "redis"])
+def test_cache_backends(kind, tmp_path):
+	async def scenario():
+		server = None
+		if kind == "memory":
+			backend = MemoryCacheBackend()
+			other = backend
+		elif kind == "shm":
+			# 同じファイルを開いた別のインスタンス(別のワーカー)と共有される
+			backend = SharedMemoryCacheBackend(f"{tmp_path}/cache.db")
+			other = SharedMemoryCacheBackend(f"{tmp_path}/cache.db")
+		else:
+			server = await start_server()
+			url = f"redis://127.0.0.1:{server.sockets[0].getsockname()[1]}/0"
+			backend, other = RedisCacheBackend(url), RedisCacheBackend(url)
+		cache, other_cache = Cache(backend), Cache(other)
+
+		# TTL
+		await cache.set("a", b"1", ttl=0.05)
+		assert await other_cache.get("a") == b"1"
+		await asyncio.sleep(0.1)
+		assert await cache.get("a") is None
+
+		# タグの無効化は他のインスタンスにも反映される
+		versions = await cache.versions(["items"])
+		await cache.set("b", b"2", ttl=60, versions=versions)
+		assert await other_cache.get("b") == b"2"
+		await other_cache.invalidate("items")
+		assert await cache.get("b") is None
+		assert cache.stale == 1
+
+		# 同時にミスしても計算は一度だけ(別インスタンスはロックで待つ)
+		calls = []
+		async def loader():
+			calls.append(1)
+			await asyncio.sleep(0.1)
+			return b"3"
+		results = await asyncio.gather(
+			*(cache.get_or_set("c", loader, ttl=60, tags=("items",)) for _ in range(5)),
+			other_cache.get_or_set("c", loader, ttl=60, tags=("items",))
+		)
+		assert results == [b"3"] * 6
+		assert len(calls) == 1
+
+		await cache.clear()
+		assert await other_cache.get("c") is None
+		await backend.close()
+		await other.close()
+		if server:
+			server.close()
+			await server.wait_closed()
+
+	asyncio.run(scenario())
+
+def test_cache_unavailable():
+	async def scenario():
+		# 接続できないサーバーはキャッシュ無しとして扱う
+		cache = Cache(RedisCacheBackend("redis://127.0.0.1:1/0", timeout=0.2))
+		await cache.set("a", b"1", ttl=60)
+		assert await cache.get("a") is None
+		async def loader():
+			return b"2"
+		assert await cache.get_or_set("b", loader, ttl=60, tags=("items",)) == b"2"
+		return cache.errors
+	assert asyncio.run(scenario()) >= 3
+
+def test_memory_cache_bounds():
+	async def scenario():
+		# 認証のエントリが上限を超えて追い出された数は、認証キャッシュの統計にも出す
+		cache = Cache(MemoryCacheBackend(max_size=2))
+		principals = PrincipalCache(cache, ttl=60)
+		await cache.set("response:/items", b"[]", 60)
+		for n in range(3):
+			await principals.set(f"token-{n}", {}, {"id": n}, {})
+		assert cache.backend.evictions == 2
+		assert principals.snapshot()["evictions"] == 1
+
+		# タグのバージョンも上限件数までで、追い出した後も無効化済みの値は一致しない
+		cache = Cache(MemoryCacheBackend(max_size=2))
+		versions = await cache.versions(["user:1"])
+		await cache.set("entry", b"1", 60, versions)
+		await cache.invalidate("user:1")
+		for n in range(2, 5):
+			await cache.invalidate(f"user:{n}")
+		assert cache.backend.snapshot()["tags"] == 2
+		assert await cache.get("entry") is None
+	asyncio.run(scenario())
+
+def test_item_group_commit(client, login, monkeypatch):
+	headers = login("kimera")
+	client.post("/items/register", headers=headers, json={"name": "apple", "price": 300})	# 認証をキャッシュしておく
+
+	# 同時に届いた登録は一つのトランザクションにまとめる
+	committer = GroupCommitter(main.insert_item_group, window=0.05, max_batch=4)
+	monkeypatch.setattr(main, "item_committer", committer)
+	names = ["lemon", "melon", "apple", "lemon", "grape", "peach"]
+	async def post_all():
+		transport = httpx.ASGITransport(app=main.app)
+		async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+			return await asyncio.gather(*(
+				ac.post("/items/register", headers=headers, json={"name": name, "price": n})
+				for n, name in enumerate(names)
+			))
+	responses = client.portal.call(post_all)
+
+	# 要求ごとに自分のidか重複のエラーを受け取る
+	assert [res.status_code for res in responses] == [200, 200, 409, 409, 200, 200]
+	ids = [res.json()["id"] for res in responses if res.status_code == 200]
+	assert len(set(ids)) == 4
+	assert responses[0].json()["name"] == "lemon" and responses[0].json()["price"] == 0
+
+	stats = committer.snapshot()
+	assert stats["batches"] == 2	# 4件で締め切り、残りは時間で締め切り
+	assert stats["items"] == 6
+	assert stats["batch_size_histogram"]["le_4"] == 1
+	assert stats["batch_size_histogram"]["le_2"] == 1
+	res = client.get("/items/stats")
+	assert res.json()[0]["item_count"] == 5
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+from cache import BACKEND_ERRORS, CacheBackend
+
+@dataclass
+class BucketState:
+	tokens: float
+	updated: float
+	failures: int = 0
+	locked_until: float = 0.0
+
+class ThrottleBusy(Exception):
+	"""他のワーカーが同じキーを更新中で、待ち時間内にロックを取れなかった"""
+
+# apply(states)は{キー: 保存済みの状態(無ければNone)}を受け取り、({キー: (新しい状態, ttl)}, 結果)を返す
+Apply = Callable[[dict[str, dict | None]], tuple[dict[str, tuple[dict, float]], object]]
+
+class ThrottleBackend(ABC):
+	"""バケットの状態を保存する先(複数ワーカーで共有する場合は共有ストアを実装する)"""
+
+	@abstractmethod
+	async def update(self, keys: list[str], apply: Apply) -> object:
+		# 読み込み・変更・保存を、同じキーを扱う他の要求と重ならないように行い、applyの結果を返す
+		...
+
+	async def clear(self):
+		pass
+
+	def snapshot(self) -> dict:
+		return {}
+
+class MemoryThrottleBackend(ThrottleBackend):
+	def __init__(self, max_keys: int = 100_000):
+		self.max_keys = max_keys
+		self._states: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+	def _load(self, key: str) -> dict | None:
+		entry = self._states.get(key)
+		if entry is None:
+			return None
+		if entry[0] <= time.time():
+			del self._states[key]
+			return None
+		return entry[1]
+
+	def _store(self, key: str, state: dict, ttl: float):
+		self._states[key] = (time.time() + ttl, state)
+		self._states.move_to_end(key)
+		while len(self._states) > self.max_keys:
+			self._states.popitem(last=False)
+
+	async def update(self, keys: list[str], apply: Apply) -> object:
+		# 途中でawaitしないので、同じプロセスの他の要求とは重ならない
+		changes, result = apply({key: self._load(key) for key in keys})
+		for key, (state, ttl) in changes.items():
+			self._store(key, state, ttl)
+		return result
+
+	async def clear(self):
+		self._states.clear()
+
+class CacheThrottleBackend(ThrottleBackend):
+	"""キャッシュの保存先(shm, redis)に状態を置き、ワーカー間で共有する
+	キーごとのロック(存在しない場合のみ保存)を取ってから読み込み・保存する"""
+
+	def __init__(self, backend: CacheBackend, lock_ttl: float = 1.0, lock_wait: float = 0.2, prefix: str = "throttle:"):
+		self.backend = backend
+		self.lock_ttl = lock_ttl	# ロックの期限(取ったプロセスが落ちた場合に備える)
+		self.lock_wait = lock_wait	# ロックを待つ上限
+		self.prefix = prefix
+		self.contended = 0
+
+	async def _acquire(self, lock: str) -> bool:
+		deadline = time.monotonic() + self.lock_wait
+		while not await self.backend.add(lock, b"1", self.lock_ttl):
+			if time.monotonic() >= deadline:
+				return False
+			await asyncio.sleep(0.005)
+		return True
+
+	async def update(self, keys: list[str], apply: Apply) -> object:
+		# 複数のワーカーが互いを待ち続けないよう、ロックは常に同じ順で取る
+		acquired = []
+		try:
+			for key in sorted(keys):
+				lock = f"{self.prefix}lock:{key}"
+				if not await self._acquire(lock):
+					self.contended += 1
+					raise ThrottleBusy(key)
+				acquired.append(lock)
+			values = await self.backend.get_many([self.prefix + key for key in keys])
+			changes, result = apply({
+				key: json.loads(value) if value is not None else None
+				for key, value in zip(keys, values)
+			})
+			for key, (state, ttl) in changes.items():
+				await self.backend.set(self.prefix + key, json.dumps(state).encode(), ttl)
+			return result
+		finally:
+			for lock in acquired:
+				try:
+					await self.backend.delete(lock)
+				except BACKEND_ERRORS:
+					pass	# 期限で消える
+
+	# 状態はキャッシュの他の値と共に破棄する(Cache.clear)
+
+	def snapshot(self) -> dict:
+		return {"contended": self.contended}
+
+class LoginThrottle:
+	"""ユーザー名とIPごとのトークンバケットと、失敗回数に応じた指数的なロックアウト"""
+
+	def __init__(
+		self,
+		backend: ThrottleBackend,
+		limits: dict[str, tuple[float, float]],
+		lockout_threshold: int = 5,
+		lockout_base: float = 1.0,
+		lockout_max: float = 900.0
+	):
+		self.backend = backend
+		self.limits = limits	# 種別ごとの(毎秒の補充量, バケット容量)
+		self.lockout_threshold = lockout_threshold
+		self.lockout_base = lockout_base
+		self.lockout_max = lockout_max
+		self.allowed = 0
+		self.rejected = 0
+		self.lockouts = 0
+		self.errors = 0
+
+	@staticmethod
+	def keys(username: str, client_ip: str | None) -> list[str]:
+		keys = [f"user:{username.lower()}"]
+		if client_ip:
+			keys.append(f"ip:{client_ip}")
+		return keys
+
+	def _load(self, key: str, state: dict | None, now: float) -> BucketState:
+		if state is None:
+			return BucketState(tokens=self.limits[key.split(":", 1)[0]][1], updated=now)
+		return BucketState(**state)
+
+	def _entry(self, key: str, state: BucketState, now: float) -> tuple[dict, float]:
+		# 満タンに戻るまでか、ロック解除までの長い方だけ保持
+		rate, burst = self.limits[key.split(":", 1)[0]]
+		ttl = max((burst - state.tokens) / rate, state.locked_until - now, 1.0)
+		if state.failures:
+			ttl = max(ttl, self.lockout_max)
+		return asdict(state), ttl
+
+	async def _update(self, keys: list[str], apply: Apply, fallback: object) -> object:
+		# 保存先が使えない場合は数えてfallbackを返す(キャッシュと同じく、障害でログインを止めない)
+		try:
+			return await self.backend.update(keys, apply)
+		except BACKEND_ERRORS:
+			self.errors += 1
+			return fallback
+
+	async def check(self, keys: list[str]) -> int | None:
+		# 許可ならNone、拒否なら再試行までの秒数を返す
+		now = time.time()
+
+		def apply(stored):
+			states = {key: self._load(key, stored[key], now) for key in keys}
+
+			# ロック中のキーがあれば拒否
+			locked_until = max(state.locked_until for state in states.values())
+			if locked_until > now:
+				return {}, math.ceil(locked_until - now)
+
+			# 経過時間分のトークンを補充
+			for key, state in states.items():
+				rate, burst = self.limits[key.split(":", 1)[0]]
+				state.tokens = min(burst, state.tokens + (now - state.updated) * rate)
+				state.updated = now
+
+			# どれか一つでも空なら拒否
+			for key, state in states.items():
+				if state.tokens < 1:
+					rate = self.limits[key.split(":", 1)[0]][0]
+					return {}, max(1, math.ceil((1 - state.tokens) / rate))
+
+			for state in states.values():
+				state.tokens -= 1
+			return {key: self._entry(key, state, now) for key, state in states.items()}, None
+
+		try:
+			retry_after = await self._update(keys, apply, None)
+		except ThrottleBusy:
+			# 同じキーへの試行が同時に集中している(通常の利用では起きない)
+			retry_after = 1
+		if retry_after:
+			self.rejected += 1
+		else:
+			self.allowed += 1
+		return retry_after
+
+	async def failure(self, keys: list[str]):
+		# 閾値を超えた失敗ごとにロック時間を倍にする
+		now = time.time()
+
+		def apply(stored):
+			changes = {}
+			locked = False
+			for key in keys:
+				state = self._load(key, stored[key], now)
+				state.failures += 1
+				over = state.failures - self.lockout_threshold
+				if over >= 0:
+					lock = min(self.lockout_max, self.lockout_base * 2 ** over)
+					state.locked_until = now + lock
+					locked = True
+				changes[key] = self._entry(key, state, now)
+			return changes, locked
+
+		try:
+			locked = await self._update(keys, apply, False)
+		except ThrottleBusy:
+			return
+		if locked:
+			self.lockouts += 1
+
+	async def success(self, keys: list[str]):
+		# 共有IPを使った解除を防ぐため、リセットするのはユーザー名のみ
+		now = time.time()
+		user_keys = [key for key in keys if key.startswith("user:")]
+
+		def apply(stored):
+			changes = {}
+			for key in user_keys:
+				state = self._load(key, stored[key], now)
+				state.failures = 0
+				state.locked_until = 0.0
+				changes[key] = self._entry(key, state, now)
+			return changes, None
+
+		try:
+			await self._update(user_keys, apply, None)
+		except ThrottleBusy:
+			pass
+
+	async def reset(self):
+		await self.backend.clear()
+
+	def snapshot(self) -> dict:
+		return {
+			"allowed": self.allowed,
+			"rejected": self.rejected,
+			"lockouts": self.lockouts,
+			"errors": self.errors,
+			**self.backend.snapshot()
+		}
@@ -0,0 +1,17 @@
+import subprocess
+import sys
+
+import pytest
+
+from conftest import PROJECTS, ROOT
+
+@pytest.mark.parametrize("project", PROJECTS, ids=[str(path.relative_to(ROOT)) for path in PROJECTS])
+def test_project(project):
+	# プロジェクトのディレクトリで実行し、そのプロジェクトのmainを読み込ませる
+	result = subprocess.run(
+		[sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider"],
+		cwd=project,
+		capture_output=True,
+		text=True
+	)
+	assert result.returncode == 0, result.stdout[-5000:] + result.stderr[-2000:]